@@ -1,2 +1,8 @@
 # -*- coding: utf-8 -*-
-stats_feat_flag = True
\ No newline at end of file
+stats_feat_flag = True
+# stats 特征按块计算距离的行数，峰值内存与块大小成正比；None 表示一次生成完整的 test*train 距离矩阵
+stats_block_size = 1000
+# run/fold 特征并行生成的进程数，<=0 表示使用全部 cpu；1 表示串行
+fold_n_jobs = -1
+# 合并特征时是否同时导出 svmlight 文本格式（train.feat/valid.feat/test.feat），默认只保存二进制格式
+export_svmlight = False
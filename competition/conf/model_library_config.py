@@ -30,11 +30,31 @@ debug = False
 xgb_random_seed = 2015
 xgb_nthread = 2
 xgb_dmatrix_silent = True
+# 以 valid kappa 早停的轮数，None 表示训练完整的 num_round；All 使用 run/fold 最优轮数的均值
+xgb_early_stopping_rounds = None
+# bagging 时所有 bag 共用的 base booster 轮数比例（xgb_model 继续训练），0 表示每个 bag 从头训练；warm start 的 bag 不早停
+xgb_warm_start_ratio = 0.
 
 ## sklearn
 skl_random_seed = 2015
 skl_n_jobs = 2
 
+## hyperopt
+hyperopt_random_seed = 2015
+# 并行 trial 的进程数，1 表示使用 fmin 串行搜索；>1 时所有 feat_name 的搜索共用一个进程池（batched TPE suggest）
+hyperopt_n_jobs = 1
+
+## run/fold/bag 并行训练
+# 一个 trial 可以使用的 cpu 个数，xgboost nthread / sklearn n_jobs 也计算在内，线程数 = cpu_budget / nthread
+# <=0 表示 cpu 个数 / hyperopt_n_jobs；1 表示串行（默认，多线程训练的 kappa 与串行核对一致后再调大）
+cpu_budget = 1
+
+## ensemble selection
+# bag 并行的进程数，1 表示串行；预测值通过 mmap 文件共享，结果与串行相同
+ensemble_n_jobs = 1
+# 预测值使用 float32 保存，内存减半
+ensemble_float32 = False
+
 if debug:
     xgb_nthread = 1
     skl_n_jobs = 1
@@ -2,12 +2,15 @@
 import numpy as np
 
 num_of_class = 4
+n_classes = num_of_class
 bootstrap_ratio = 1
 bootstrap_replacement = False
 bagging_size = 1
 
 ebc_hard_threshold = False
 verbose_level = 1
+# 读取合并后特征矩阵（train.feat/valid.feat/test.feat）的 mmap_mode，None 表示读入内存，"r" 表示只读 mmap
+feat_mmap_mode = None
 
 
 # 模型算法包路径 libfm rgf
@@ -18,6 +21,8 @@ rgf_exe = "../../rgf1.2/bin/rgf.exe"
 ## cv交叉验证配置
 n_runs = 3
 n_folds = 3
+# BaseModel 进程内数据集缓存最多保留的 run/fold（以及 All）个数，超过后淘汰最久未使用的
+set_obj_cache_size = n_runs * n_folds + 1
 stratified_label = "query"
 
 # 路径配置
@@ -29,16 +34,36 @@ processed_train_data_path = "%s/train.processed.csv.pkl" % feat_folder
 processed_test_data_path = "%s/test.processed.csv.pkl" % feat_folder
 pos_tagged_train_data_path = "%s/train.pos_tagged.csv.pkl" % feat_folder
 pos_tagged_test_data_path = "%s/test.pos_tagged.csv.pkl" % feat_folder
+# unigram/bigram/trigram 缓存目录
+token_cache_folder = "%s/Cache/tokens" % feat_folder
 
 output_path = "../../Output"
 
 # nlp related
 drop_html_flag = True
+# preprocess 清洗文本的进程数（<=0 表示使用全部 cpu，1 表示串行）和每个 chunk 的行数
+preprocess_n_jobs = -1
+preprocess_chunk_size = 2000
 basic_tfidf_ngram_range = (1, 3)
 basic_tfidf_vocabulary_type = "common"
+# basic tfidf/bow 的 vocabulary 和 idf 按照训练行集合缓存到 vectorizer_cache_folder
+vectorizer_cache_persist = True
+vectorizer_cache_folder = "%s/Cache/vectorizer" % feat_folder
+# bow/tfidf svd：随机化分解的过采样列数、幂迭代次数（warm start 的 run/fold 使用 svd_warm_start_n_iter），分解结果缓存到 svd_cache_folder
+svd_n_oversamples = 10
+svd_n_iter = 15
+svd_warm_start_n_iter = 4
+svd_random_state = 2015
+svd_cache_persist = True
+svd_cache_folder = "%s/Cache/svd" % feat_folder
 cooccurrence_tfidf_ngram_range = (1, 1)
 cooccurrence_word_exclude_stopword = False
 stemmer_type = "porter"  # "snowball"
+# stemmer 缓存：最多缓存的词数；persist 为 True 时 preprocess 后保存到 stemmer_cache_folder，下次运行时读取
+# 文件名包含 nlp_utils 实际使用的 stemmer（stemmer.<stemmer_type>.pkl）
+stemmer_cache_size = 200000
+stemmer_cache_persist = False
+stemmer_cache_folder = "%s/Cache" % feat_folder
 
 # transform for count features
 count_feat_transform = np.sqrt
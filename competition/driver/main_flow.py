@@ -3,6 +3,7 @@ __author__ = 'songquanwang'
 from competition.preprocess.preprocess import preprocess
 from competition.preprocess.init_path import init_path
 from competition.preprocess.kfold import gen_stratified_kfold
+from competition.feat.token_cache import gen_token_cache
 from competition.info.gen_info import gen_info
 import competition.models.model_manager as model_manager
 
@@ -28,11 +29,13 @@ def preprocess():
      1.构建必要的目录
      2.预处理
      3.交叉验证
+     4.生成 n-gram 缓存，所有特征生成器共用
     :return:
     """
     init_path()
     preprocess()
     gen_stratified_kfold()
+    gen_token_cache()
 
 
 def gen_info():
@@ -52,8 +55,9 @@ def gen_info():
 def gen_feat():
     # 生成所有的特征+label
     stats_feat_flag = feat_param_conf.stats_feat_flag
+    stats_block_size = feat_param_conf.stats_block_size
     # 生成basic tfidf feat
-    basic_tfidf_feat = BasicTfidfFeat(stats_feat_flag)
+    basic_tfidf_feat = BasicTfidfFeat(stats_feat_flag, stats_block_size)
     basic_tfidf_feat.gen_basic_tfidf_feat()
     # 生成coocrrence tfidf feat
     cooccurence_tfidf_feat = CooccurenceTfidfFeat()
@@ -62,21 +66,22 @@ def gen_feat():
     counting_feat = CountingFeat()
     counting_feat.gen_counting_feat()
     # 生成 distance feat
-    distance_feat = DistanceFeat(stats_feat_flag)
+    distance_feat = DistanceFeat(stats_feat_flag, stats_block_size)
     distance_feat.gen_distance_feat()
     # 生成id feat
     id_feat = IdFeat()
     id_feat.gen_id_feat()
 
     # 合并所有的feat 生成四个目录，文件名字 train.feat valid.feat test.feat
-    BaseFeat.combine_feat(LSA_and_stats_feat_Jun09_Low.feat_names, feat_path_name="LSA_and_stats_feat_Jun09")
+    export_svmlight = feat_param_conf.export_svmlight
+    BaseFeat.combine_feat(LSA_and_stats_feat_Jun09_Low.feat_names, feat_path_name="LSA_and_stats_feat_Jun09", export_svmlight=export_svmlight)
 
     BaseFeat.combine_feat(LSA_svd150_and_Jaccard_coef_Jun14_Low.feat_names,
-                          feat_path_name="LSA_svd150_and_Jaccard_coef_Jun14")
+                          feat_path_name="LSA_svd150_and_Jaccard_coef_Jun14", export_svmlight=export_svmlight)
 
-    BaseFeat.combine_feat(svd100_and_bow_Jun23_Low.feat_names, feat_path_name="svd100_and_bow_Jun23")
+    BaseFeat.combine_feat(svd100_and_bow_Jun23_Low.feat_names, feat_path_name="svd100_and_bow_Jun23", export_svmlight=export_svmlight)
 
-    BaseFeat.combine_feat(svd100_and_bow_Jun27_High.feat_names, feat_path_name="svd100_and_bow_Jun27")
+    BaseFeat.combine_feat(svd100_and_bow_Jun27_High.feat_names, feat_path_name="svd100_and_bow_Jun27", export_svmlight=export_svmlight)
 
 
 def predict(specified_models):
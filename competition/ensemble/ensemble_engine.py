@@ -0,0 +1,145 @@
+# coding:utf-8
+"""
+__file__
+
+    ensemble_engine.py
+
+__description__
+
+    This file provides the incremental engine used by ensemble selection.
+
+        1. all the validation predictions are held in one contiguous (model, run, fold, n) array,
+           numValidMatrix gives the valid length of every run/fold
+
+        2. the current ensemble is kept as a running weighted sum (run, fold, n) and the total weight,
+           adding a model is one axpy, the blend is never recomputed from the model list
+
+        3. candidates are scored together: for every run/fold the blended predictions of all the
+           candidates form a (n_candidates, numValid) matrix, which is decoded by getScoreBatch and
+           scored by batch_quadratic_weighted_kappa in one call
+
+        4. save()/load() store the read-only arrays as .npy files, the bag workers of the parallel
+           ensemble selection open them with mmap_mode='r' and share the pages
+
+__author__
+
+    songquanwang
+
+"""
+
+import numpy as np
+
+from competition.utils.utils import getScoreBatch
+from competition.utils.ml_metrics import batch_quadratic_weighted_kappa
+import competition.conf.model_params_conf as config
+
+# save()/load() 的数组，顺序与 __init__ 参数相同
+array_names = ["pred_list_valid", "Y_list_valid", "cdf_list_valid", "numValidMatrix"]
+
+
+class EnsembleEngine(object):
+    def __init__(self, pred_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix):
+        """
+        :param pred_list_valid: (model, run, fold, n)
+        :param Y_list_valid: (run, fold, n)
+        :param cdf_list_valid: (run, fold, n_classes)
+        :param numValidMatrix: (run, fold)
+        """
+        # 保持 float32/float64，累加使用 float64
+        self.pred_list_valid = np.ascontiguousarray(pred_list_valid)
+        self.Y_list_valid = Y_list_valid
+        self.cdf_list_valid = cdf_list_valid
+        self.numValidMatrix = numValidMatrix
+        self.n_runs, self.n_folds = numValidMatrix.shape
+        self.reset()
+
+    def save(self, path):
+        """
+        保存只读的预测值、label、cdf，供 load(mmap_mode='r') 共享
+        """
+        for name in array_names:
+            np.save("%s/%s.npy" % (path, name), getattr(self, name))
+
+    @staticmethod
+    def load(path, mmap_mode="r"):
+        arrays = [np.load("%s/%s.npy" % (path, name), mmap_mode=mmap_mode) for name in array_names]
+        return EnsembleEngine(*arrays)
+
+    def reset(self):
+        """
+        清空当前集成（每个 bag 开始时调用）
+        """
+        self.p_ens_sum = np.zeros(self.pred_list_valid.shape[1:], dtype=float)
+        self.w_ens = 0.
+
+    def add(self, model_id, w):
+        """
+        把模型按照权重 w 加入集成：累加 w * pred
+        """
+        self.p_ens_sum += w * self.pred_list_valid[model_id]
+        self.w_ens += w
+
+    def set_models(self, model_ids, weights):
+        """
+        按照顺序重新累加模型列表，与逐个 add() 的结果完全相同
+        """
+        self.reset()
+        for model_id, w in zip(model_ids, weights):
+            self.add(model_id, w)
+
+    def get_ens(self):
+        """
+        当前集成的加权平均预测值 (run, fold, n)
+        """
+        return self.p_ens_sum / self.w_ens
+
+    def kappa_cv(self, get_preds):
+        """
+        每个 run/fold 一次解码、一次计算所有候选的 kappa
+        :param get_preds: get_preds(run, fold, numValid) 返回 (n_candidates, numValid) 预测值
+        :return: (n_candidates, run, fold) kappa
+        """
+        kappa_cv = None
+        for run in range(self.n_runs):
+            for fold in range(self.n_folds):
+                numValid = self.numValidMatrix[run][fold]
+                preds = get_preds(run, fold, numValid)
+                score = getScoreBatch(preds, self.cdf_list_valid[run, fold, :])
+                true_label = self.Y_list_valid[run, fold, :numValid]
+                kappa = batch_quadratic_weighted_kappa(true_label, score, 1, config.n_classes)
+                if kappa_cv is None:
+                    kappa_cv = np.zeros((len(kappa), self.n_runs, self.n_folds), dtype=float)
+                kappa_cv[:, run, fold] = kappa
+        return kappa_cv
+
+    def model_kappa_cv(self, model_ids):
+        """
+        单个模型的 kappa
+        :return: (len(model_ids), run, fold)
+        """
+        model_ids = np.asarray(model_ids, dtype=int)
+        return self.kappa_cv(lambda run, fold, numValid: self.pred_list_valid[model_ids, run, fold, :numValid])
+
+    def ens_kappa_cv(self):
+        """
+        当前集成的 kappa
+        :return: (run, fold)
+        """
+        return self.kappa_cv(lambda run, fold, numValid: self.p_ens_sum[np.newaxis, run, fold, :numValid] / self.w_ens)[0]
+
+    def candidate_kappa_cv(self, model_ids, weights):
+        """
+        把每个候选模型按照各自的权重加入当前集成后的 kappa，当前集成不变
+        :param model_ids: 候选模型
+        :param weights: 候选模型的权重（与 w_ens 同一尺度）
+        :return: (len(model_ids), run, fold)
+        """
+        model_ids = np.asarray(model_ids, dtype=int)
+        weights = np.asarray(weights, dtype=float)[:, np.newaxis]
+        total = self.w_ens + weights
+
+        def get_preds(run, fold, numValid):
+            p_sum = self.p_ens_sum[np.newaxis, run, fold, :numValid]
+            return (p_sum + weights * self.pred_list_valid[model_ids, run, fold, :numValid]) / total
+
+        return self.kappa_cv(get_preds)
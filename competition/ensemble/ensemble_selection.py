@@ -17,6 +17,9 @@ __author__
 import numpy as np
 import pandas as pd
 import os
+import shutil
+import tempfile
+import multiprocessing
 from hyperopt import fmin, tpe, hp, STATUS_OK, Trials
 
 from competition.utils.utils import getScore, getTestScore
@@ -24,6 +27,11 @@ from competition.utils.ml_metrics import quadratic_weighted_kappa
 import competition.conf.model_params_conf as config
 import competition.conf.model_library_config as model_library_config
 import competition.utils.utils as utils
+from competition.ensemble.ensemble_engine import EnsembleEngine
+from competition.models import pred_store
+
+# 并行 bag 的参数，在进程池 fork 之前设置，子进程继承
+_bag_shared = dict()
 
 
 def ensembleSelectionPrediction(model_folder, best_bagged_model_list, best_bagged_model_weight, cdf, cutoff=None):
@@ -44,15 +52,12 @@ def ensembleSelectionPrediction(model_folder, best_bagged_model_list, best_bagge
         # 多个模型集成结果
         for model, w in zip(best_bagged_model_list[bagging_iter], best_bagged_model_weight[bagging_iter]):
             iter += 1
-            pred_file = "%s/All/test.pred.%s.csv" % (model_folder, model)
-            # 获取当前模型预测值
-            this_p_valid = pd.read_csv(pred_file, dtype=float)["prediction"].values
+            # 获取当前模型预测值，所有 bag 共用缓存
+            id_test, this_p_valid = pred_store.load_test_pred(model_folder, model)
             this_w = w
             if iter == 1:
                 # 初始化整合预测值是0
                 p_ens_valid = np.zeros((this_p_valid.shape[0]), dtype=float)
-                id_test = pd.read_csv(pred_file, dtype=float)["id"].values
-                id_test = np.asarray(id_test, dtype=int)
             # 按照权重比值相加，然后再归一化
             p_ens_valid = (w_ens * p_ens_valid + this_w * this_p_valid) / (w_ens + this_w)
             # 累计权重
@@ -74,6 +79,21 @@ def ensembleSelectionPrediction(model_folder, best_bagged_model_list, best_bagge
     return output
 
 
+def get_data_sizes(feat_folder):
+    """
+    从 info 文件获取每个 run/fold 的 valid 行数和 test 行数
+    :param feat_folder:
+    :return: numValidMatrix (run, fold), numTest
+    """
+    numValidMatrix = np.zeros((config.n_runs, config.n_folds), dtype=int)
+    for run in range(config.n_runs):
+        for fold in range(config.n_folds):
+            info_valid = pd.read_csv("%s/Run%d/Fold%d/valid.info" % (feat_folder, run + 1, fold + 1))
+            numValidMatrix[run][fold] = info_valid.shape[0]
+    numTest = pd.read_csv("%s/All/test.info" % feat_folder).shape[0]
+    return numValidMatrix, numTest
+
+
 def gen_kappa_list(model_list, model2idx, model_folder, feat_folder, cdf, pred_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix, kappa_list):
     """
 
@@ -82,142 +102,116 @@ def gen_kappa_list(model_list, model2idx, model_folder, feat_folder, cdf, pred_l
     :param model_folder:
     :param feat_folder:
     :param cdf:
-    :param numValidMatrix:  引用
+    :param numValidMatrix: 每个 run/fold 的 valid 行数（get_data_sizes）
     :param pred_list_valid: 引用
     :param Y_list_valid: 引用
     :param cdf_list_valid: 引用
     :param kappa_list: 引用
-    :return:
+    :return: EnsembleEngine
     """
     print("Load model...")
-    for model in model_list:
-        model_id = model2idx[model]
-        print("model: %s" % model)
-        kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
+    ## load cdf
+    for run in range(config.n_runs):
+        for fold in range(config.n_folds):
+            if cdf == None:
+                cdf_file = "%s/Run%d/Fold%d/valid.cdf" % (feat_folder, run + 1, fold + 1)
+                cdf_list_valid[run, fold, :] = np.loadtxt(cdf_file, dtype=float)
+            else:
+                cdf_list_valid[run, fold, :] = cdf
+    # 二进制预测值一次读入，没有 .npy 的模型读取 csv
+    missing = pred_store.load_valid_preds(model_folder, model_list, numValidMatrix, pred_list_valid, Y_list_valid)
+    for model_id in missing:
+        model = model_list[model_id]
         ## load cvf
         for run in range(config.n_runs):
             for fold in range(config.n_folds):
                 path = "%s/Run%d/Fold%d" % (model_folder, run + 1, fold + 1)
                 pred_file = "%s/valid.pred.%s.csv" % (path, model)
-                cdf_file = "%s/Run%d/Fold%d/valid.cdf" % (feat_folder, run + 1, fold + 1)
                 this_p_valid = pd.read_csv(pred_file, dtype=float)
-                numValidMatrix[run][fold] = this_p_valid.shape[0]
+                if this_p_valid.shape[0] != numValidMatrix[run][fold]:
+                    raise ValueError("%s has %d rows, valid.info has %d rows" % (pred_file, this_p_valid.shape[0], numValidMatrix[run][fold]))
                 pred_list_valid[model_id, run, fold, :numValidMatrix[run][fold]] = this_p_valid["prediction"].values
                 Y_list_valid[run, fold, :numValidMatrix[run][fold]] = this_p_valid["target"].values
-                ## load cdf
-                if cdf == None:
-                    cdf_list_valid[run, fold, :] = np.loadtxt(cdf_file, dtype=float)
-                else:
-                    cdf_list_valid[run, fold, :] = cdf
-                ##
-                score = getScore(pred_list_valid[model_id, run, fold, :numValidMatrix[run][fold]], cdf_list_valid[run, fold, :])
-                kappa_cv[run][fold] = quadratic_weighted_kappa(score, Y_list_valid[run, fold, :numValidMatrix[run][fold]])
-
-        print("kappa: %.6f" % np.mean(kappa_cv))
+
+    engine = EnsembleEngine(pred_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix)
+    # 所有模型的 kappa 一次计算
+    kappa_cv = engine.model_kappa_cv([model2idx[model] for model in model_list])
+    for model, this_kappa_cv in zip(model_list, kappa_cv):
+        print("model: %s" % model)
+        print("kappa: %.6f" % np.mean(this_kappa_cv))
         # 算出每个模型的平均kappa_cv
-        kappa_list[model] = np.mean(kappa_cv)
+        kappa_list[model] = np.mean(this_kappa_cv)
+    return engine
 
 
-def gen_ens_temp(init_top_k, this_sorted_models, model2idx, pred_list_valid, numValidMatrix, cdf_list_valid, Y_list_valid, p_ens_list_valid_tmp, best_model_list, best_model_weight):
+def gen_ens_temp(init_top_k, this_sorted_models, model2idx, engine, best_model_list, best_model_weight):
     """
-
+    清空 engine，把 kappa 最大的 init_top_k 个模型以权重 1 加入集成
     :param init_top_k:
     :param this_sorted_models:
     :param model2idx:
-    :param pred_list_valid:
-    :param numValidMatrix:
-    :param cdf_list_valid:
-    :param Y_list_valid:
-    :param p_ens_list_valid_tmp: 引用
+    :param engine: EnsembleEngine
     :param best_model_list: 引用
     :param best_model_weight: 引用
-    :return:
+    :return: 初始集成的 kappa（init_top_k 为 0 时为 0）
     """
     #### initialization
-    w_ens, this_w = 0, 1.0
+    engine.reset()
+    this_w = 1.0
+    init_kappa = 0
     if init_top_k > 0:
-        cnt = 0
-        kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
-        for model, kappa in this_sorted_models:
-            if cnt >= init_top_k:
-                continue
+        for model, kappa in this_sorted_models[:init_top_k]:
             print("add to the ensembles the following model")
             print("model: %s" % model)
             print("kappa: %.6f" % kappa)
-            this_p_list_valid = pred_list_valid[model2idx[model]]
-            for run in range(config.n_runs):
-                for fold in range(config.n_folds):
-                    numValid = numValidMatrix[run][fold]
-                    if cnt == 0:
-                        this_w = 1.0
-                    else:
-                        pass
-                    p_ens_list_valid_tmp[run, fold, :numValid] = (w_ens * p_ens_list_valid_tmp[run, fold, :numValid] + this_w * this_p_list_valid[run, fold, :numValid]) / (w_ens + this_w)
-                    # p_ens_list_valid_tmp[run,fold,:numValid] = p_ens_list_valid_tmp[run,fold,:numValid].argsort().argsort()
-                    if cnt == init_top_k - 1:
-                        cdf = cdf_list_valid[run, fold, :]
-                        true_label = Y_list_valid[run, fold, :numValid]
-                        score = getScore(p_ens_list_valid_tmp[run, fold, :numValid], cdf)
-                        kappa_cv[run][fold] = quadratic_weighted_kappa(score, true_label)
+            engine.add(model2idx[model], this_w)
             best_model_list.append(model)
             best_model_weight.append(this_w)
-            w_ens += this_w
-            cnt += 1
-        print("Init kappa: %.6f (%.6f)" % (np.mean(kappa_cv), np.std(kappa_cv)))
-    return w_ens
+        kappa_cv = engine.ens_kappa_cv()
+        init_kappa = np.mean(kappa_cv)
+        print("Init kappa: %.6f (%.6f)" % (init_kappa, np.std(kappa_cv)))
+    return init_kappa
 
 
-def ensembleSelectionObj(param, p1_list, weight1, p2_list, true_label_list, cdf_list, numValidMatrix):
+def ensembleSelectionObj(param, engine, model_id):
     """
     优化param中的weight2参数，使其平均kappa_cv_mean
+    当前集成（权重 1）与模型 model_id（权重 weight2）加权平均
     :param param:
-    :param p1_list:
-    :param weight1:
-    :param p2_list:
-    :param true_label_list:
-    :param cdf_list:
-    :param numValidMatrix:
+    :param engine: EnsembleEngine
+    :param model_id:
     :return:
     """
     weight2 = param['weight2']
-    kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
-    for run in range(config.n_runs):
-        for fold in range(config.n_folds):
-            numValid = numValidMatrix[run][fold]
-            p1 = p1_list[run, fold, :numValid]
-            p2 = p2_list[run, fold, :numValid]
-            true_label = true_label_list[run, fold, :numValid]
-            cdf = cdf_list[run, fold, :]
-            p_ens = (weight1 * p1 + weight2 * p2) / (weight1 + weight2)
-            p_ens_score = getScore(p_ens, cdf)
-            kappa_cv[run][fold] = quadratic_weighted_kappa(p_ens_score, true_label)
+    kappa_cv = engine.candidate_kappa_cv([model_id], [weight2 * engine.w_ens])[0]
     kappa_cv_mean = np.mean(kappa_cv)
     return {'loss': -kappa_cv_mean, 'status': STATUS_OK}
 
 
-def gen_best_weight(this_sorted_models, model2idx, w_min, w_max, pred_list_valid, hypteropt_max_evals, w_ens, Y_list_valid, cdf_list_valid, numValidMatrix, p_ens_list_valid_tmp, best_model_list, best_model_weight):
+def gen_best_weight(this_sorted_models, model2idx, w_min, w_max, hypteropt_max_evals, engine, best_model_list, best_model_weight, init_kappa, rstate=None):
     """
-
+    greedy：每一步为每个候选模型搜索权重（fmin 的最优 trial 即该权重下加入后的 kappa），加入 kappa 最大的模型，kappa 不再提高时停止
     :param this_sorted_models:
     :param model2idx:
     :param w_min:
     :param w_max:
-    :param pred_list_valid:
     :param hypteropt_max_evals:
-    :param w_ens:
-    :param Y_list_valid:
-    :param cdf_list_valid:
-    :param numValidMatrix:
-    :param p_ens_list_valid_tmp:
+    :param engine: EnsembleEngine，当前集成
     :param best_model_list: 引用
     :param best_model_weight: 引用
+    :param init_kappa: 初始集成的 kappa，加入的模型必须超过它
+    :param rstate: hyperopt 的 RandomState，固定后结果可以复现
     :return:
     """
     iter = 0
+    best_kappa = init_kappa
     while True:
         iter += 1
+        model_ids = []
+        weights = []
+        kappa_mean = []
         for model, _ in this_sorted_models:
-            this_p_list_valid = pred_list_valid[model2idx[model]]
+            model_id = model2idx[model]
 
             ## hyperopt for the best weight
             trials = Trials()
@@ -225,26 +219,17 @@ def gen_best_weight(this_sorted_models, model2idx, w_min, w_max, pred_list_valid
             param_space = {
                 'weight2': hp.uniform('weight2', w_min, w_max)
             }
-            obj = lambda param: ensembleSelectionObj(param, p_ens_list_valid_tmp, 1., this_p_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix)
-            best_params = fmin(obj, param_space, algo=tpe.suggest, trials=trials, max_evals=hypteropt_max_evals)
-            this_w = best_params['weight2']
-            this_w *= w_ens
-            # all the current prediction to the ensemble
-            kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
-            for run in range(config.n_runs):
-                for fold in range(config.n_folds):
-                    numValid = numValidMatrix[run][fold]
-                    p1 = p_ens_list_valid_tmp[run, fold, :numValid]
-                    p2 = this_p_list_valid[run, fold, :numValid]
-                    true_label = Y_list_valid[run, fold, :numValid]
-                    cdf = cdf_list_valid[run, fold, :]
-                    p_ens = (w_ens * p1 + this_w * p2) / (w_ens + this_w)
-                    score = getScore(p_ens, cdf)
-                    kappa_cv[run][fold] = quadratic_weighted_kappa(score, true_label)
-            if np.mean(kappa_cv) > best_kappa:
-                best_kappa, best_model, best_weight = np.mean(kappa_cv), model, this_w
-        if best_model == None:
+            obj = lambda param: ensembleSelectionObj(param, engine, model_id)
+            best_params = fmin(obj, param_space, algo=tpe.suggest, trials=trials, max_evals=hypteropt_max_evals, rstate=rstate)
+            model_ids.append(model_id)
+            weights.append(best_params['weight2'] * engine.w_ens)
+            # fmin 已经计算过最优权重的 kappa，不需要再计算一次
+            kappa_mean.append(-trials.best_trial['result']['loss'])
+        # 第一个最大值，与逐个比较 > best_kappa 相同
+        best_index = np.argmax(kappa_mean)
+        if not kappa_mean[best_index] > best_kappa:
             break
+        best_kappa, best_model, best_weight = kappa_mean[best_index], this_sorted_models[best_index][0], weights[best_index]
         print("Iter: %d" % iter)
         print("    model: %s" % best_model)
         print("    weight: %s" % best_weight)
@@ -253,48 +238,93 @@ def gen_best_weight(this_sorted_models, model2idx, w_min, w_max, pred_list_valid
         best_model_list.append(best_model)
         best_model_weight.append(best_weight)
         # valid
-        this_p_list_valid = pred_list_valid[model2idx[best_model]]
-        for run in range(config.n_runs):
-            for fold in range(config.n_folds):
-                numValid = numValidMatrix[run][fold]
-                p_ens_list_valid_tmp[run, fold, :numValid] = (w_ens * p_ens_list_valid_tmp[run, fold, :numValid] + best_weight * this_p_list_valid[run, fold, :numValid]) / (w_ens + best_weight)
-        best_model = None
-        w_ens += best_weight
+        engine.add(model_ids[best_index], best_weight)
 
 
-def gen_kappa_cv(bagging_iter, Y_list_valid, cdf_list_valid, numValidMatrix, p_ens_list_valid, p_ens_list_valid_tmp):
+def select_bag(bagging_iter, engine, sorted_models, model2idx, init_top_k, w_min, w_max, hypteropt_max_evals, bagging_replacement, bagging_fraction):
+    """
+    一个 bag 的 greedy ensemble selection，只依赖 bagging_iter 的种子，不同 bag 之间互不影响
+    :return: best_model_list, best_model_weight
+    """
+    seed = 2015 + 100 * bagging_iter
+    index_base, index_meta = utils.bootstrap_data(seed, bagging_replacement, len(sorted_models), bagging_fraction)
+    this_sorted_models = [sorted_models[i] for i in sorted(index_base)]
+
+    # print this_model_list
+    best_model_list = []
+    best_model_weight = []
+    # initialization
+    init_kappa = gen_ens_temp(init_top_k, this_sorted_models, model2idx, engine, best_model_list, best_model_weight)
+
+    #### ensemble selection with replacement
+    gen_best_weight(this_sorted_models, model2idx, w_min, w_max, hypteropt_max_evals, engine, best_model_list, best_model_weight, init_kappa, np.random.RandomState(seed))
+    return best_model_list, best_model_weight
+
+
+def _run_bag(bagging_iter):
+    engine = EnsembleEngine.load(_bag_shared["path"])
+    return select_bag(bagging_iter, engine, *_bag_shared["args"])
+
+
+def select_bags(bagging_size, engine, n_jobs, *args):
+    """
+    所有 bag 的 ensemble selection
+        n_jobs > 1 时，预测值、label、cdf 保存到临时目录，worker 以 mmap 只读共享；结果按 bag 顺序返回
+    :param bagging_size:
+    :param engine:
+    :param n_jobs:
+    :param args: select_bag 的其他参数
+    :return: [(best_model_list, best_model_weight)]
+    """
+    global _bag_shared
+    n_jobs = min(n_jobs, bagging_size)
+    if n_jobs <= 1:
+        return [select_bag(bagging_iter, engine, *args) for bagging_iter in range(bagging_size)]
+    path = tempfile.mkdtemp(prefix="ensemble_selection_")
+    try:
+        engine.save(path)
+        _bag_shared = {"path": path, "args": args}
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_run_bag, range(bagging_size), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _bag_shared = dict()
+        shutil.rmtree(path)
+    return results
+
+
+def gen_kappa_cv(bagging_iter, engine, p_ens_list_valid, numTest):
     """
 
     :param bagging_iter:
-    :param Y_list_valid:
-    :param cdf_list_valid:
-    :param numValidMatrix:
-    :param p_ens_list_valid:
-    :param p_ens_list_valid_tmp:
+    :param engine: EnsembleEngine，当前 bag 的集成
+    :param p_ens_list_valid: 引用，所有 bag 的平均
+    :param numTest: test 行数，cutoff 按照 test/valid 行数的比例缩放
     :return:
     """
     kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
     cutoff = np.zeros((3), dtype=float)
+    p_ens_list_valid[:] = (bagging_iter * p_ens_list_valid + engine.get_ens()) / (bagging_iter + 1.)
     for run in range(config.n_runs):
         for fold in range(config.n_folds):
-            numValid = numValidMatrix[run][fold]
-            true_label = Y_list_valid[run, fold, :numValid]
-            cdf = cdf_list_valid[run, fold, :]
-            p_ens_list_valid[run, fold, :numValid] = (bagging_iter * p_ens_list_valid[run, fold,
-                                                                     :numValid] + p_ens_list_valid_tmp[run, fold,
-                                                                                  :numValid]) / (bagging_iter + 1.)
+            numValid = engine.numValidMatrix[run][fold]
+            true_label = engine.Y_list_valid[run, fold, :numValid]
+            cdf = engine.cdf_list_valid[run, fold, :]
             score, cutoff_tmp = getScore(p_ens_list_valid[run, fold, :numValid], cdf, "valid")
             kappa_cv[run][fold] = quadratic_weighted_kappa(score, true_label)
 
             cutoff += cutoff_tmp
     cutoff /= float(config.n_runs * config.n_folds)
-    cutoff *= (22513 / ((2. / 3) * 10158))
+    cutoff *= (numTest / np.mean(engine.numValidMatrix))
     print("Bag %d, kappa: %.6f (%.6f)" % (bagging_iter + 1, np.mean(kappa_cv), np.std(kappa_cv)))
     return kappa_cv, cutoff
 
 
 def ensembleSelection(feat_folder, model_folder, model_list, cdf, cdf_test, subm_prefix, hypteropt_max_evals=10, w_min=-1., w_max=1., bagging_replacement=False, bagging_fraction=0.5, bagging_size=10, init_top_k=5,
-                      prunning_fraction=0.2):
+                      prunning_fraction=0.2, n_jobs=1):
     """
 
     :param feat_folder:
@@ -311,22 +341,23 @@ def ensembleSelection(feat_folder, model_folder, model_list, cdf, cdf_test, subm
     :param bagging_size:
     :param init_top_k:
     :param prunning_fraction:
+    :param n_jobs: bag 并行的进程数
     :return:
     """
-    ## load all the prediction :maxNumValid 预测结果假定是12000行
-    maxNumValid = 12000
+    ## load all the prediction :行数从 info 文件获取，maxNumValid 是最大的 valid 行数
+    # run-fold
+    numValidMatrix, numTest = get_data_sizes(feat_folder)
+    maxNumValid = np.max(numValidMatrix)
+    pred_dtype = np.float32 if model_library_config.ensemble_float32 else np.float64
     # 模型-run-fold-行
-    pred_list_valid = np.zeros((len(model_list), config.n_runs, config.n_folds, maxNumValid), dtype=float)
+    pred_list_valid = np.zeros((len(model_list), config.n_runs, config.n_folds, maxNumValid), dtype=pred_dtype)
     # run-fold-行
     Y_list_valid = np.zeros((config.n_runs, config.n_folds, maxNumValid), dtype=float)
     # run-fold-4类别
     cdf_list_valid = np.zeros((config.n_runs, config.n_folds, config.n_classes), dtype=float)
-    # run-fold
-    numValidMatrix = np.zeros((config.n_runs, config.n_folds), dtype=int)
     # run-fold-行
     p_ens_list_valid = np.zeros((config.n_runs, config.n_folds, maxNumValid), dtype=float)
 
-    numTest = 22513
     # model 从0开始编号
     model2idx = dict()
     # 每个model的kappa值
@@ -336,7 +367,7 @@ def ensembleSelection(feat_folder, model_folder, model_list, cdf, cdf_test, subm
         kappa_list[model] = 0
     print("============================================================")
     print("Load model...")
-    gen_kappa_list(model_list, model2idx, model_folder, feat_folder, cdf, pred_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix, kappa_list)
+    engine = gen_kappa_list(model_list, model2idx, model_folder, feat_folder, cdf, pred_list_valid, Y_list_valid, cdf_list_valid, numValidMatrix, kappa_list)
 
     cdf_mean_init = np.mean(np.mean(cdf_list_valid, axis=0), axis=0)
     cdf_mean_init = cdf_mean_init.tolist()
@@ -351,25 +382,12 @@ def ensembleSelection(feat_folder, model_folder, model_list, cdf, cdf_test, subm
     print("Perform ensemble selection...")
     best_bagged_model_list = [[]] * bagging_size
     best_bagged_model_weight = [[]] * bagging_size
-    num_model = len(model_list)
+    bag_results = select_bags(bagging_size, engine, n_jobs, sorted_models, model2idx, init_top_k, w_min, w_max, hypteropt_max_evals, bagging_replacement, bagging_fraction)
     # print bagging_size
-    for bagging_iter in range(bagging_size):
-        index_base, index_meta =utils.bootstrap_data(2015 + 100 * bagging_iter, bagging_replacement, num_model, bagging_fraction)
-        this_sorted_models = [sorted_models[i] for i in sorted(index_base)]
-
-        # print this_model_list
-        best_model_list = []
-        best_model_weight = []
-        best_kappa = 0
-        best_model = None
-        p_ens_list_valid_tmp = np.zeros((config.n_runs, config.n_folds, maxNumValid), dtype=float)
-        # initialization
-        w_ens = gen_ens_temp(init_top_k, this_sorted_models, model2idx, pred_list_valid, numValidMatrix, cdf_list_valid, Y_list_valid, p_ens_list_valid_tmp, best_model_list, best_model_weight)
-
-        #### ensemble selection with replacement
-        gen_best_weight(this_sorted_models, model2idx, w_min, w_max, pred_list_valid, hypteropt_max_evals, w_ens, Y_list_valid, cdf_list_valid, numValidMatrix, p_ens_list_valid_tmp, best_model_list, best_model_weight)
-
-        kappa_cv, cutoff = gen_kappa_cv(bagging_iter, Y_list_valid, cdf_list_valid, numValidMatrix, p_ens_list_valid, p_ens_list_valid_tmp)
+    for bagging_iter, (best_model_list, best_model_weight) in enumerate(bag_results):
+        # 按照 bag 的模型列表重新累加，与 bag 内的集成完全相同
+        engine.set_models([model2idx[model] for model in best_model_list], best_model_weight)
+        kappa_cv, cutoff = gen_kappa_cv(bagging_iter, engine, p_ens_list_valid, numTest)
 
         best_kappa_mean = np.mean(kappa_cv)
         best_kappa_std = np.std(kappa_cv)
@@ -443,4 +461,4 @@ def gen_ensemble(feat_folder):
     best_kappa_mean, best_kappa_std, best_bagged_model_list, best_bagged_model_weight = ensembleSelection(feat_folder, model_folder, model_list, cdf=cdf_valid, cdf_test=cdf_test, subm_prefix=subm_prefix, \
                           hypteropt_max_evals=1, w_min=-1, w_max=1, bagging_replacement=bagging_replacement,
                           bagging_fraction=bagging_fraction, \
-                          bagging_size=bagging_size, init_top_k=init_top_k, prunning_fraction=prunning_fraction)
\ No newline at end of file
+                          bagging_size=bagging_size, init_top_k=init_top_k, prunning_fraction=prunning_fraction, n_jobs=model_library_config.ensemble_n_jobs)
\ No newline at end of file
@@ -40,11 +40,15 @@ from copy import copy
 
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import TruncatedSVD
-from sklearn.metrics.pairwise import cosine_similarity, pairwise_distances
+from sklearn.metrics.pairwise import pairwise_distances
 
 from scipy.sparse import vstack
 from competition.feat.nlp.nlp_utils import getTFV, getBOW
+from competition.feat import stats_engine
+from competition.feat import fold_scheduler
+from competition.feat import feat_store
+from competition.feat.vectorizer_cache import VectorizerCache
+from competition.feat.svd_service import SVDService
 
 import competition.conf.model_params_conf as config
 import abc
@@ -54,15 +58,17 @@ from  competition.feat.base_feat import BaseFeat
 class BasicTfidfFeat(BaseFeat):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, stats_feat_flag=True):
+    def __init__(self, stats_feat_flag=True, stats_block_size=None):
         # 分位数，分别计算 0 0.5 1 分位数。 也就是 最小值、中位数、最大值
-        quantiles_range = np.arange(0, 1.5, 0.5)
+        self.quantiles_range = np.arange(0, 1.5, 0.5)
         # 是否计算统计特征
         self.stats_feat_flag = stats_feat_flag
+        # 统计特征按块计算的行数，None 表示一次生成完整的距离矩阵
+        self.stats_block_size = stats_block_size
         # 平均值 、标准差
         self.stats_func = [np.mean, np.std]
         # 特征包括 最小值 中位数 最大值，平均值、标准差 五个
-        self.stats_feat_num = len(quantiles_range) + len(self.stats_func)
+        self.stats_feat_num = len(self.quantiles_range) + len(self.stats_func)
         # tfidf bow两种
         self.vec_types = ["tfidf", "bow"]
         # 1-3
@@ -76,23 +82,10 @@ class BasicTfidfFeat(BaseFeat):
 
         # 三个列名
         self.column_names = ["query", "product_title", "product_description"]
-
-    @staticmethod
-    def cosine_sim(x, y):
-        """
-        计算余弦相似性距离
-        :param x:
-        :param y:
-        :return:
-        """
-        try:
-            d = cosine_similarity(x, y)
-            d = d[0][0]
-        except:
-            print x
-            print y
-            d = 0.
-        return d
+        # 所有 run/fold 和 All 共用的 doc-term 计数矩阵，gen_basic_tfidf_feat 中生成
+        self.vectorizer_cache = None
+        # 以最大的 n_components 分解一次，run/fold 从 All 的分解 warm start
+        self.svd_service = SVDService(max(self.svd_n_components))
 
     ## generate distance stats feat
     def generate_dist_stats_feat(self, metric, X_train, ids_train, X_test, ids_test, indices_dict, qids_test=None):
@@ -113,40 +106,21 @@ class BasicTfidfFeat(BaseFeat):
         """
 
         if metric == "cosine":
-            # 生成 len(ids_test)行，class(分类个数)列的 多维数组
-            stats_feat = 0 * np.ones((len(ids_test), self.stats_feat_num * config.n_classes), dtype=float)
+            default = 0.
             # sim 0-1 1完全相同
-            sim = 1. - pairwise_distances(X_test, X_train, metric=metric, n_jobs=1)
+            sim_func = lambda A, B: 1. - pairwise_distances(A, B, metric=metric, n_jobs=1)
         elif metric == "euclidean":
-            stats_feat = -1 * np.ones((len(ids_test), self.stats_feat_num * config.n_classes), dtype=float)
+            default = -1.
             # 返回xtest行 xtrain列的array
-            sim = pairwise_distances(X_test, X_train, metric=metric, n_jobs=1)
-
-        for i in range(len(ids_test)):
-            id = ids_test[i]
-            if qids_test is not None:
-                qid = qids_test[i]
-            # 一行分别于某一类的距离做比较
-            for j in range(config.n_classes):
-                # if赋值语句
-                key = (qid, j + 1) if qids_test is not None else j + 1
-                if indices_dict.has_key(key):
-                    inds = indices_dict[key]
-                    # exclude this sample itself from the list of indices
-
-                    inds = [ind for ind in inds if id != ids_train[ind]]
-                    sim_tmp = sim[i][inds]
-                    if len(sim_tmp) != 0:
-                        # 距离的平均值、方差
-                        feat = [func(sim_tmp) for func in self.stats_func]
-                        ## quantile
-                        sim_tmp = pd.Series(sim_tmp)
-                        # 距离的最小值、中位数、最大值
-                        quantiles = sim_tmp.quantile(self.quantiles_range)
-                        feat = np.hstack((feat, quantiles))
-                        # 每一行生成 [五个值的数组]
-                        stats_feat[i, j * self.stats_feat_num:(j + 1) * self.stats_feat_num] = feat
-        return stats_feat
+            sim_func = lambda A, B: pairwise_distances(A, B, metric=metric, n_jobs=1)
+
+        if self.stats_block_size:
+            # 分块计算，不生成完整的距离矩阵
+            return stats_engine.gen_blocked_dist_stats_feat(sim_func, X_train, ids_train, X_test, ids_test, indices_dict, config.n_classes, self.quantiles_range, qids_test, default,
+                                                            self.stats_block_size)
+        sim = sim_func(X_test, X_train)
+        # 每个分组的所有行一次计算：最小值、中位数、最大值、平均值、方差
+        return stats_engine.gen_dist_stats_feat(sim, ids_train, ids_test, indices_dict, config.n_classes, self.quantiles_range, qids_test, default)
 
     def extract_bow_tfidf_cosine_sim_stats_feat(self, path, dfTrain, dfTest, feat_name, column_name, X_train, X_test, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict):
         """
@@ -170,23 +144,20 @@ class BasicTfidfFeat(BaseFeat):
             ## train
             cosine_sim_stats_feat_by_relevance_train = self.generate_dist_stats_feat("cosine", X_train, dfTrain["id"].values, X_train, dfTrain["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_train = self.generate_dist_stats_feat("cosine", X_train, dfTrain["id"].values, X_train, dfTrain["id"].values, query_relevance_indices_dict, dfTrain["qid"].values)
-            with open("%s/train.%s_cosine_sim_stats_feat_by_relevance.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_train, f, -1)
-            with open("%s/train.%s_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_train, f, -1)
+            feat_store.dump_feat("%s/train.%s_cosine_sim_stats_feat_by_relevance" % (path, feat_name), cosine_sim_stats_feat_by_relevance_train)
+            feat_store.dump_feat("%s/train.%s_cosine_sim_stats_feat_by_query_relevance" % (path, feat_name), cosine_sim_stats_feat_by_query_relevance_train)
             ## test
             cosine_sim_stats_feat_by_relevance_test = self.generate_dist_stats_feat("cosine", X_train, dfTrain["id"].values, X_test, dfTest["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_test = self.generate_dist_stats_feat("cosine", X_train, dfTrain["id"].values, X_test, dfTest["id"].values, query_relevance_indices_dict, dfTest["qid"].values)
-            with open("%s/%s.%s_cosine_sim_stats_feat_by_relevance.feat.pkl" % (path, mode, feat_name), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_test, f, -1)
-            with open("%s/%s.%s_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (path, mode, feat_name),
-                      "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_test, f, -1)
+            feat_store.dump_feat("%s/%s.%s_cosine_sim_stats_feat_by_relevance" % (path, mode, feat_name), cosine_sim_stats_feat_by_relevance_test)
+            feat_store.dump_feat("%s/%s.%s_cosine_sim_stats_feat_by_query_relevance" % (path, mode, feat_name), cosine_sim_stats_feat_by_query_relevance_test)
 
             new_feat_names.append("%s_cosine_sim_stats_feat_by_relevance" % feat_name)
             new_feat_names.append("%s_cosine_sim_stats_feat_by_query_relevance" % feat_name)
-            return new_feat_names
 
+        return new_feat_names
+
+    @staticmethod
     def extract_cosine_sim_feat(path, feat_names, mode, vec_type):
         """
         cosine sim feat
@@ -206,21 +177,18 @@ class BasicTfidfFeat(BaseFeat):
             for j in range(i + 1, len(feat_names)):
                 print "generate common %s cosine sim feat for %s and %s" % (vec_type, feat_names[i], feat_names[j])
                 for mod in ["train", mode]:
-                    with open("%s/%s.%s.feat.pkl" % (path, mod, feat_names[i]), "rb") as f:
-                        target_vec = cPickle.load(f)
-                    with open("%s/%s.%s.feat.pkl" % (path, mod, feat_names[j]), "rb") as f:
-                        obs_vec = cPickle.load(f)
-                    sim = np.asarray(map(BasicTfidfModel.cosine_sim, target_vec, obs_vec))[:, np.newaxis]
+                    target_vec = feat_store.load_feat("%s/%s.%s" % (path, mod, feat_names[i]))
+                    obs_vec = feat_store.load_feat("%s/%s.%s" % (path, mod, feat_names[j]))
+                    # 所有行一次计算
+                    sim = stats_engine.row_cosine_sim(target_vec, obs_vec)[:, np.newaxis]
                     # 计算两个特征之间的余弦相似度
-                    with open("%s/%s.%s_%s_%s_cosine_sim.feat.pkl" % (path, mod, feat_names[i], feat_names[j], vec_type),
-                              "wb") as f:
-                        cPickle.dump(sim, f, -1)
+                    feat_store.dump_feat("%s/%s.%s_%s_%s_cosine_sim" % (path, mod, feat_names[i], feat_names[j], vec_type), sim)
                 ## update feat names
                 new_feat_names.append("%s_%s_%s_cosine_sim" % (feat_names[i], feat_names[j], vec_type))
 
         return new_feat_names
 
-    def extract_svd_cosine_sim_stats_feat(self, path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, mode, n_components, relevance_indices_dict, query_relevance_indices_dict):
+    def extract_svd_cosine_sim_stats_feat(self, path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, vec_type, mode, n_components, relevance_indices_dict, query_relevance_indices_dict):
         """
         svd sim stats feat
         :param path:
@@ -228,6 +196,7 @@ class BasicTfidfFeat(BaseFeat):
         :param column_name:
         :param X_svd_train:
         :param X_svd_test:
+        :param vec_type:
         :param mode:
         :param n_components:
         :param relevance_indices_dict:
@@ -238,28 +207,25 @@ class BasicTfidfFeat(BaseFeat):
         # 方法生成的新特征名字
         new_feat_names = []
         if column_name in ["product_title", "product_description"]:
-            print "generate common %s-svd%d stats feat for %s" % (self.vec_type, n_components, column_name)
+            print "generate common %s-svd%d stats feat for %s" % (vec_type, n_components, column_name)
             ## train
             cosine_sim_stats_feat_by_relevance_train = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_train, dfTrain["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_train = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_train, dfTrain["id"].values, query_relevance_indices_dict,
                                                                                            dfTrain["qid"].values)
-            with open("%s/train.%s_common_svd%d_cosine_sim_stats_feat_by_relevance.feat.pkl" % (path, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_train, f, -1)
-            with open("%s/train.%s_common_svd%d_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (path, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_train, f, -1)
+            feat_store.dump_feat("%s/train.%s_common_svd%d_cosine_sim_stats_feat_by_relevance" % (path, feat_name, n_components), cosine_sim_stats_feat_by_relevance_train)
+            feat_store.dump_feat("%s/train.%s_common_svd%d_cosine_sim_stats_feat_by_query_relevance" % (path, feat_name, n_components), cosine_sim_stats_feat_by_query_relevance_train)
             ## test
             cosine_sim_stats_feat_by_relevance_test = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_test, dfTest["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_test = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_test, dfTest["id"].values, query_relevance_indices_dict, dfTest["qid"].values)
-            with open("%s/%s.%s_common_svd%d_cosine_sim_stats_feat_by_relevance.feat.pkl" % (path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_test, f, -1)
-            with open("%s/%s.%s_common_svd%d_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_test, f, -1)
+            feat_store.dump_feat("%s/%s.%s_common_svd%d_cosine_sim_stats_feat_by_relevance" % (path, mode, feat_name, n_components), cosine_sim_stats_feat_by_relevance_test)
+            feat_store.dump_feat("%s/%s.%s_common_svd%d_cosine_sim_stats_feat_by_query_relevance" % (path, mode, feat_name, n_components), cosine_sim_stats_feat_by_query_relevance_test)
             ## update feat names
             new_feat_names.append("%s_common_svd%d_cosine_sim_stats_feat_by_relevance" % (feat_name, n_components))
             new_feat_names.append("%s_common_svd%d_cosine_sim_stats_feat_by_query_relevance" % (feat_name, n_components))
 
         return new_feat_names
 
+    @staticmethod
     def extract_svd_cosine_sim_feat(path, feat_names, vec_type, mode, n_components):
         """
         svd cosine sim feat
@@ -275,17 +241,17 @@ class BasicTfidfFeat(BaseFeat):
         for i in range(len(feat_names) - 1):
             for j in range(i + 1, len(feat_names)):
                 print "generate common %s-svd%d cosine sim feat for %s and %s" % (vec_type, n_components, feat_names[i], feat_names[j])
-            for mod in ["train", mode]:
-                with open("%s/%s.%s_common_svd%d.feat.pkl" % (path, mod, feat_names[i], n_components), "rb") as f:
-                    target_vec = cPickle.load(f)
-                with open("%s/%s.%s_common_svd%d.feat.pkl" % (path, mod, feat_names[j], n_components), "rb") as f:
-                    obs_vec = cPickle.load(f)
-                sim = np.asarray(map(BasicTfidfModel.cosine_sim, target_vec, obs_vec))[:, np.newaxis]
-                ## dump feat
-                with open("%s/%s.%s_%s_%s_common_svd%d_cosine_sim.feat.pkl" % (path, mod, feat_names[i], feat_names[j], vec_type, n_components), "wb") as f:
-                    cPickle.dump(sim, f, -1)
-            ## update feat names
-            new_feat_names.append("%s_%s_%s_common_svd%d_cosine_sim" % (feat_names[i], feat_names[j], vec_type, n_components))
+                for mod in ["train", mode]:
+                    target_vec = feat_store.load_feat("%s/%s.%s_common_svd%d" % (path, mod, feat_names[i], n_components))
+                    obs_vec = feat_store.load_feat("%s/%s.%s_common_svd%d" % (path, mod, feat_names[j], n_components))
+                    # 所有行一次计算
+                    sim = stats_engine.row_cosine_sim(target_vec, obs_vec)[:, np.newaxis]
+                    ## dump feat
+                    feat_store.dump_feat("%s/%s.%s_%s_%s_common_svd%d_cosine_sim" % (path, mod, feat_names[i], feat_names[j], vec_type, n_components), sim)
+                ## update feat names
+                new_feat_names.append("%s_%s_%s_common_svd%d_cosine_sim" % (feat_names[i], feat_names[j], vec_type, n_components))
+
+        return new_feat_names
 
     def extract_svd_cosine_sim_stats_feat_individual(self, path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, vec_type, mode, n_components, relevance_indices_dict, query_relevance_indices_dict):
         """
@@ -310,21 +276,13 @@ class BasicTfidfFeat(BaseFeat):
             cosine_sim_stats_feat_by_relevance_train = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_train, dfTrain["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_train = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_train, dfTrain["id"].values, query_relevance_indices_dict,
                                                                                            dfTrain["qid"].values)
-            with open("%s/train.%s_individual_svd%d_cosine_sim_stats_feat_by_relevance.feat.pkl" % (
-                    path, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_train, f, -1)
-            with open("%s/train.%s_individual_svd%d_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (
-                    path, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_train, f, -1)
+            feat_store.dump_feat("%s/train.%s_individual_svd%d_cosine_sim_stats_feat_by_relevance" % (path, feat_name, n_components), cosine_sim_stats_feat_by_relevance_train)
+            feat_store.dump_feat("%s/train.%s_individual_svd%d_cosine_sim_stats_feat_by_query_relevance" % (path, feat_name, n_components), cosine_sim_stats_feat_by_query_relevance_train)
             ## test
             cosine_sim_stats_feat_by_relevance_test = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_test, dfTest["id"].values, relevance_indices_dict)
             cosine_sim_stats_feat_by_query_relevance_test = self.generate_dist_stats_feat("cosine", X_svd_train, dfTrain["id"].values, X_svd_test, dfTest["id"].values, query_relevance_indices_dict, dfTest["qid"].values)
-            with open("%s/%s.%s_individual_svd%d_cosine_sim_stats_feat_by_relevance.feat.pkl" % (
-                    path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_relevance_test, f, -1)
-            with open("%s/%s.%s_individual_svd%d_cosine_sim_stats_feat_by_query_relevance.feat.pkl" % (
-                    path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(cosine_sim_stats_feat_by_query_relevance_test, f, -1)
+            feat_store.dump_feat("%s/%s.%s_individual_svd%d_cosine_sim_stats_feat_by_relevance" % (path, mode, feat_name, n_components), cosine_sim_stats_feat_by_relevance_test)
+            feat_store.dump_feat("%s/%s.%s_individual_svd%d_cosine_sim_stats_feat_by_query_relevance" % (path, mode, feat_name, n_components), cosine_sim_stats_feat_by_query_relevance_test)
 
             ## update feat names
             new_feat_names.append(
@@ -334,31 +292,25 @@ class BasicTfidfFeat(BaseFeat):
 
         return new_feat_names
 
-    def create_vocabulary(dfTrain, vocabulary_type, vec_type, ngram_range):
+    def get_vectorizer(self, vec_type):
         """
-        根据vocabulary_type 生成
-        :param vocabulary_type:common  individual
-        :param vec_type:tfidf tfidf
+        根据vec_type 生成 vectorizer（只使用参数，fit/transform 由 vectorizer_cache 完成）
+        :param vec_type:tfidf bow
         :return:
         """
-        # 生成 vocabulary
-        if vocabulary_type == "common":
-            if vec_type == "tfidf":
-                vec = getTFV(ngram_range=ngram_range)
-            elif vec_type == "bow":
-                vec = getBOW(ngram_range=ngram_range)
-            vec.fit(dfTrain["all_text"])
-            vocabulary = vec.vocabulary_
-        elif vocabulary_type == "individual":
-            vocabulary = None
-        return vocabulary
-
-    def gen_bow_tfidf_by_feat_column_names(self, path, dfTrain, dfTest, vec_type, mode, vocabulary, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
+        if vec_type == "tfidf":
+            vec = getTFV(ngram_range=self.ngram_range)
+        elif vec_type == "bow":
+            vec = getBOW(ngram_range=self.ngram_range)
+        return vec
+
+    def gen_bow_tfidf_by_feat_column_names(self, path, dfTrain, dfTest, vec_type, mode, vocabulary_type, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
         """
-        根据vec_type mode vocabulary 生成
+        根据vec_type mode vocabulary_type 生成
+        vocabulary/idf 由 vectorizer_cache 根据训练行的 document frequency 得到，不需要重新分词
         :param vec_type:'tfidf'/'bow'
         :param mode: 'valid' / 'test'
-        :param vocabulary:
+        :param vocabulary_type:common  individual
         :param relevance_indices_dict:
         :param query_relevance_indices_dict:
         :param feat_names:
@@ -366,97 +318,87 @@ class BasicTfidfFeat(BaseFeat):
         :return:
         """
         new_feat_names = []
+        vec = self.get_vectorizer(vec_type)
         for feat_name, column_name in zip(feat_names, column_names):
             # 根据 vec_type  bow/tfidf 生成不同的特征
-            if vec_type == "tfidf":
-                vec = getTFV(ngram_range=self.ngram_range, vocabulary=vocabulary)
-            elif vec_type == "bow":
-                vec = getBOW(ngram_range=self.ngram_range, vocabulary=vocabulary)
-            X_train = vec.fit_transform(dfTrain[column_name])
-            X_test = vec.transform(dfTest[column_name])
+            X_train, X_test = self.vectorizer_cache.fit_transform(vec, vec_type, vocabulary_type, column_name, dfTrain["id"].values, dfTest["id"].values)
             # 生成basic bow tfidf 特征
             ##########################
             print "generate %s feat for %s" % (vec_type, column_name)
 
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(X_train, f, -1)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "wb") as f:
-                cPickle.dump(X_test, f, -1)
+            feat_store.dump_feat("%s/train.%s" % (path, feat_name), X_train)
+            feat_store.dump_feat("%s/%s.%s" % (path, mode, feat_name), X_test)
 
-            if stats_feat_flag:
+            if self.stats_feat_flag:
                 feat_list = self.extract_bow_tfidf_cosine_sim_stats_feat(path, dfTrain, dfTest, feat_name, column_name, X_train, X_test, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict)
                 new_feat_names.extend(feat_list)
         return new_feat_names
 
-    def gen_common_svd_by_feat_column_names(self, path, dfTrain, dfTest, X_vec_all_train, n_components, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
+    def gen_common_svd_by_feat_column_names(self, path, dfTrain, dfTest, X_vec_all_train, n_components, vec_type, mode, vocabulary_columns, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
         """
 
         :param X_vec_all_train:
         :param n_components:
         :param mode:
+        :param vocabulary_columns: 每一列 bow/tfidf 在全局 vocabulary 中的列（warm start 对齐）
         :param relevance_indices_dict:
         :param query_relevance_indices_dict:
         :return:
         """
         new_feat_names = []
-        svd = TruncatedSVD(n_components=n_components, n_iter=15)
-        svd.fit(X_vec_all_train)
+        # 所有 n_components 共用一次分解
+        components, _ = self.svd_service.fit(X_vec_all_train, "%s_common_svd" % vec_type, vocabulary_columns[0])
         for feat_name, column_name in zip(feat_names, column_names):
             print "generate common %s-svd%d feat for %s" % (vec_type, n_components, column_name)
             # 生成common svd 特征
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "rb") as f:
-                X_vec_train = cPickle.load(f)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "rb") as f:
-                X_vec_test = cPickle.load(f)
-            X_svd_train = svd.transform(X_vec_train)
-            X_svd_test = svd.transform(X_vec_test)
-            with open("%s/train.%s_common_svd%d.feat.pkl" % (path, feat_name, n_components), "wb") as f:
-                cPickle.dump(X_svd_train, f, -1)
-            with open("%s/%s.%s_common_svd%d.feat.pkl" % (path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(X_svd_test, f, -1)
+            X_vec_train = feat_store.load_feat("%s/train.%s" % (path, feat_name))
+            X_vec_test = feat_store.load_feat("%s/%s.%s" % (path, mode, feat_name))
+            X_svd_train = self.svd_service.transform(X_vec_train, components, n_components)
+            X_svd_test = self.svd_service.transform(X_vec_test, components, n_components)
+            feat_store.dump_feat("%s/train.%s_common_svd%d" % (path, feat_name, n_components), X_svd_train)
+            feat_store.dump_feat("%s/%s.%s_common_svd%d" % (path, mode, feat_name, n_components), X_svd_test)
             ## update feat names
             new_feat_names.append("%s_common_svd%d" % (feat_name, n_components))
 
-            if stats_feat_flag:
+            if self.stats_feat_flag:
                 #####################################
                 ## bow/tfidf-svd cosine sim stats feat ##
                 #####################################
-                feat_list = self.extract_svd_cosine_sim_stats_feat(path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, mode, n_components, relevance_indices_dict, query_relevance_indices_dict)
+                feat_list = self.extract_svd_cosine_sim_stats_feat(path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, vec_type, mode, n_components, relevance_indices_dict,
+                                                                   query_relevance_indices_dict)
                 new_feat_names.extend(feat_list)
         return new_feat_names
 
-    def gen_individual_svd_by_feat_column_names(self, path, dfTrain, dfTest, n_components, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
+    def gen_individual_svd_by_feat_column_names(self, path, dfTrain, dfTest, n_components, vec_type, mode, vocabulary_columns, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names):
         """
         generate individual svd feat
         :param n_components:
         :param mode:
+        :param vocabulary_columns: 每一列 bow/tfidf 在全局 vocabulary 中的列（warm start 对齐）
         :param relevance_indices_dict:
         :param query_relevance_indices_dict:
         :return:
         """
         new_feat_names = []
-        for feat_name, column_name in zip(feat_names, column_names):
+        for feat_name, column_name, columns in zip(feat_names, column_names, vocabulary_columns):
             print "generate individual %s-svd%d feat for %s" % (vec_type, n_components, column_name)
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "rb") as f:
-                X_vec_train = cPickle.load(f)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "rb") as f:
-                X_vec_test = cPickle.load(f)
-            svd = TruncatedSVD(n_components=n_components, n_iter=15)
-            X_svd_train = svd.fit_transform(X_vec_train)
-            X_svd_test = svd.transform(X_vec_test)
-            with open("%s/train.%s_individual_svd%d.feat.pkl" % (path, feat_name, n_components), "wb") as f:
-                cPickle.dump(X_svd_train, f, -1)
-            with open("%s/%s.%s_individual_svd%d.feat.pkl" % (path, mode, feat_name, n_components), "wb") as f:
-                cPickle.dump(X_svd_test, f, -1)
+            X_vec_train = feat_store.load_feat("%s/train.%s" % (path, feat_name))
+            X_vec_test = feat_store.load_feat("%s/%s.%s" % (path, mode, feat_name))
+            components, _ = self.svd_service.fit(X_vec_train, feat_name, columns)
+            X_svd_train = self.svd_service.transform(X_vec_train, components, n_components)
+            X_svd_test = self.svd_service.transform(X_vec_test, components, n_components)
+            feat_store.dump_feat("%s/train.%s_individual_svd%d" % (path, feat_name, n_components), X_svd_train)
+            feat_store.dump_feat("%s/%s.%s_individual_svd%d" % (path, mode, feat_name, n_components), X_svd_test)
             ## update feat names
             new_feat_names.append("%s_individual_svd%d" % (feat_name, n_components))
 
-            if stats_feat_flag:
+            if self.stats_feat_flag:
                 #########################################
                 ## bow/tfidf-svd cosine sim stats feat ##
                 #########################################
-                self.extract_svd_cosine_sim_stats_feat_individual(path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, vec_type, mode,
-                                                                  n_components, relevance_indices_dict, query_relevance_indices_dict, new_feat_names)
+                feat_list = self.extract_svd_cosine_sim_stats_feat_individual(path, dfTrain, dfTest, feat_name, column_name, X_svd_train, X_svd_test, vec_type, mode,
+                                                                              n_components, relevance_indices_dict, query_relevance_indices_dict)
+                new_feat_names.extend(feat_list)
         return new_feat_names
 
     def extract_feat(self, path, dfTrain, dfTest, vec_type, mode, feat_names, column_names, vocabulary_type, svd_n_components):
@@ -476,42 +418,65 @@ class BasicTfidfFeat(BaseFeat):
         """
         # 保留最基本的三个特征： 'query_tfidf_common_vocabulary'，'title_tfidf_common_vocabulary'，'description_tfidf_common_vocabulary
         new_feat_names = copy(feat_names)
-        # 找出所有的词汇
-        vocabulary = self.create_vocabulary(vocabulary_type, vec_type)
-        if stats_feat_flag:
+        relevance_indices_dict = query_relevance_indices_dict = None
+        if self.stats_feat_flag:
             # 返回 类别为键，序号数组为值的字典
-            relevance_indices_dict = self.get_sample_indices_by_relevance(dfTrain)
+            relevance_indices_dict = stats_engine.gen_group_indices(self.get_sample_indices_by_relevance(dfTrain))
             # 返回 类别-qid为键，序号数组为值的字典
-            query_relevance_indices_dict = self.get_sample_indices_by_relevance(dfTrain, "qid")
+            query_relevance_indices_dict = stats_engine.gen_group_indices(self.get_sample_indices_by_relevance(dfTrain, "qid"))
 
-        feat_list = self.gen_bow_tfidf_by_feat_column_names(vec_type, mode, vocabulary, feat_names, column_names)
+        feat_list = self.gen_bow_tfidf_by_feat_column_names(path, dfTrain, dfTest, vec_type, mode, vocabulary_type, relevance_indices_dict, query_relevance_indices_dict, feat_names, column_names)
         new_feat_names.extend(feat_list)
 
         # cosine sim feat
-        feat_list = self.extract_cosine_sim_feat(path, feat_names, mode)
+        feat_list = self.extract_cosine_sim_feat(path, feat_names, mode, vec_type)
         new_feat_names.extend(feat_list)
 
         # vstack 所有的feat
         for i, feat_name in enumerate(feat_names):
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "rb") as f:
-                X_vec_train = cPickle.load(f)
+            X_vec_train = feat_store.load_feat("%s/train.%s" % (path, feat_name))
             if i == 0:
                 X_vec_all_train = X_vec_train
             else:
                 X_vec_all_train = vstack([X_vec_all_train, X_vec_train])
 
+        # bow/tfidf 的列在全局 vocabulary 中的位置，run/fold 的 svd 据此从 All 的分解 warm start
+        vec = self.get_vectorizer(vec_type)
+        vocabulary_columns = [self.vectorizer_cache.get_columns(vec, vec_type, vocabulary_type, column_name, dfTrain["id"].values) for column_name in column_names]
         for n_components in svd_n_components:
-            feat_list = self.gen_common_svd_by_feat_column_names(dfTrain, dfTest, X_vec_all_train, n_components, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict)
+            feat_list = self.gen_common_svd_by_feat_column_names(path, dfTrain, dfTest, X_vec_all_train, n_components, vec_type, mode, vocabulary_columns, relevance_indices_dict, query_relevance_indices_dict,
+                                                                 feat_names, column_names)
             new_feat_names.extend(feat_list)
             # cosine sim feat ##
             feat_list = self.extract_svd_cosine_sim_feat(path, feat_names, vec_type, mode, n_components)
             new_feat_names.extend(feat_list)
 
-            feat_list = self.gen_individual_svd_by_feat_column_names(dfTrain, dfTest, n_components, vec_type, mode, relevance_indices_dict, query_relevance_indices_dict)
+            feat_list = self.gen_individual_svd_by_feat_column_names(path, dfTrain, dfTest, n_components, vec_type, mode, vocabulary_columns, relevance_indices_dict, query_relevance_indices_dict,
+                                                                     feat_names, column_names)
             new_feat_names.extend(feat_list)
 
         return new_feat_names
 
+    def add_svd_warm_starts(self, df_train, df_test, vec_type, feat_names):
+        """
+        分解 All 的 common/individual bow/tfidf 矩阵，登记为 run/fold svd 的 warm start
+        :param df_train:
+        :param df_test:
+        :param vec_type:
+        :param feat_names:
+        :return:
+        """
+        print "generate All %s-svd%d for warm start" % (vec_type, self.svd_service.max_n_components)
+        vec = self.get_vectorizer(vec_type)
+        X_vec_train_list = []
+        for feat_name, column_name in zip(feat_names, self.column_names):
+            X_vec_train, _ = self.vectorizer_cache.fit_transform(vec, vec_type, self.vocabulary_type, column_name, df_train["id"].values, df_test["id"].values)
+            columns = self.vectorizer_cache.get_columns(vec, vec_type, self.vocabulary_type, column_name, df_train["id"].values)
+            self.svd_service.add_warm_start(feat_name, X_vec_train, columns)
+            X_vec_train_list.append(X_vec_train)
+        if self.vocabulary_type == "common":
+            self.svd_service.add_warm_start("%s_common_svd" % vec_type, vstack(X_vec_train_list), columns)
+
     def gen_basic_tfidf_feat(self):
         """
         入口函数
@@ -536,34 +501,39 @@ class BasicTfidfFeat(BaseFeat):
         df_train["all_text"] = list(df_train.apply(cat_text, axis=1))
         df_test["all_text"] = list(df_test.apply(cat_text, axis=1))
 
-        # vec_type: "tfidf", "bow"] ; vocabulary_type："common"
+        # train + test 只分词一次，fork 出的 fold worker 共享计数矩阵
+        columns = ["id"] + self.column_names + ["all_text"]
+        self.vectorizer_cache = VectorizerCache(pd.concat([df_train[columns], df_test[columns]], ignore_index=True), self.column_names, self.ngram_range)
+        # fork 之前分解 All 的矩阵，run/fold 从 All 的分解 warm start，All task 直接使用缓存
         for vec_type in self.vec_types:
-            ## save feat names
             feat_names = ["query", "title", "description"]
             feat_names = [name + "_%s_%s_vocabulary" % (vec_type, self.vocabulary_type) for name in feat_names]
+            self.add_svd_warm_starts(df_train, df_test, vec_type, feat_names)
 
-            print("==================================================")
-            print("Generate basic %s features..." % vec_type)
-
-            print("For cross-validation...")
-            for run in range(config.n_runs):
-                # use 33% for training and 67 % for validation so we switch trainInd and validInd
-                for fold, (validInd, trainInd) in enumerate(skf[run]):
-                    print("Run: %d, Fold: %d" % (run + 1, fold + 1))
-                    path = "%s/Run%d/Fold%d" % (config.feat_folder, run + 1, fold + 1)
-                    dfTrain_train_train = df_train.iloc[trainInd].copy()
-                    dfTrain_train_valid = df_train.iloc[validInd].copy()
-                    self.extract_feat(path, dfTrain_train_train, dfTrain_train_valid, vec_type, "valid", feat_names, self.column_names)
-
-            print("Done.")
+        print("==================================================")
+        print("Generate basic %s features..." % ", ".join(self.vec_types))
 
-            print("For training and testing...")
+        # vec_type: "tfidf", "bow"] ; vocabulary_type："common"
+        # 所有 vec_type 的 run/fold 和 All 一起放到进程池
+        tasks = []
+        all_task_index = []
+        for vec_type in self.vec_types:
+            feat_names = ["query", "title", "description"]
+            feat_names = [name + "_%s_%s_vocabulary" % (vec_type, self.vocabulary_type) for name in feat_names]
+            tasks.extend(fold_scheduler.gen_cv_tasks(skf, df_train, self.extract_feat, vec_type, "valid", feat_names, self.column_names,
+                                                     self.vocabulary_type, self.svd_n_components))
             path = "%s/All" % config.feat_folder
-            ## extract feat
-            feat_names = self.extract_feat(path, df_train, df_test, "test", feat_names, self.column_names)
+            all_task_index.append(len(tasks))
+            tasks.append((self.extract_feat, (path, df_train, df_test, vec_type, "test", feat_names, self.column_names,
+                                              self.vocabulary_type, self.svd_n_components)))
+        results = fold_scheduler.run_tasks(tasks)
+
+        for vec_type, task_index in zip(self.vec_types, all_task_index):
+            ## feat names of the All task
+            feat_names = results[task_index]
             ## dump feat name
             ## file to save feat names
             feat_name_file = "%s/basic_%s_and_cosine_sim.feat_name" % (config.feat_folder, vec_type)
             self.dump_feat_name(feat_names, feat_name_file)
 
-            print("All Done.")
+        print("All Done.")
@@ -30,6 +30,8 @@ from sklearn.decomposition import TruncatedSVD
 from competition.feat.nlp.nlp_utils import getTFV
 import competition.conf.model_params_conf as config
 from  competition.feat.base_feat import BaseFeat
+from competition.feat import fold_scheduler
+from competition.feat import feat_store
 
 
 class CooccurenceTfidfFeat(BaseFeat):
@@ -117,19 +119,15 @@ class CooccurenceTfidfFeat(BaseFeat):
             X_tfidf_train = tfv.fit_transform(dfTrain[column_name])
             X_tfidf_test = tfv.transform(dfTest[column_name])
 
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(X_tfidf_train, f, -1)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "wb") as f:
-                cPickle.dump(X_tfidf_test, f, -1)
+            feat_store.dump_feat("%s/train.%s" % (path, feat_name), X_tfidf_train)
+            feat_store.dump_feat("%s/%s.%s" % (path, mode, feat_name), X_tfidf_test)
 
             ## svd
             svd = TruncatedSVD(n_components=self.svd_n_components, n_iter=15)
             X_svd_train = svd.fit_transform(X_tfidf_train)
             X_svd_test = svd.transform(X_tfidf_test)
-            with open("%s/train.%s_individual_svd%d.feat.pkl" % (path, feat_name, self.svd_n_components), "wb") as f:
-                cPickle.dump(X_svd_train, f, -1)
-            with open("%s/%s.%s_individual_svd%d.feat.pkl" % (path, mode, feat_name, self.svd_n_components), "wb") as f:
-                cPickle.dump(X_svd_test, f, -1)
+            feat_store.dump_feat("%s/train.%s_individual_svd%d" % (path, feat_name, self.svd_n_components), X_svd_train)
+            feat_store.dump_feat("%s/%s.%s_individual_svd%d" % (path, mode, feat_name, self.svd_n_components), X_svd_test)
 
     def gen_coocurrence_tfidf_feat(self):
 
@@ -172,30 +170,18 @@ class CooccurenceTfidfFeat(BaseFeat):
         print("Generate co-occurrence tfidf features...")
 
         # gen temp feat
-        self.gen_temp_feat(dfTrain)
-        self.gen_temp_feat(dfTest)
+        self.gen_temp_feat(dfTrain, config.processed_train_data_path)
+        self.gen_temp_feat(dfTest, config.processed_test_data_path)
         # get cooccurrence terms
         self.extract_feat(dfTrain)
         self.extract_feat(dfTest)
 
-        # Cross validation
-        print("For cross-validation...")
-        for run in range(config.n_runs):
-            # use 33% for training and 67 % for validation ,so we switch trainInd and validInd
-            for fold, (validInd, trainInd) in enumerate(skf[run]):
-                print("Run: %d, Fold: %d" % (run + 1, fold + 1))
-                path = "%s/Run%d/Fold%d" % (config.feat_folder, run + 1, fold + 1)
-                X_tfidf_train = dfTrain.iloc[trainInd]
-                X_tfidf_valid = dfTrain.iloc[validInd]
-                self.gen_tfidf_svd_by_feat_column_names(path, X_tfidf_train, X_tfidf_valid, "valid", ngram_range, feat_names,
-                                                        column_names)
-
-        print("Done.")
-
-        # Re-training
-        print("For training and testing...")
+        # Cross validation + Re-training, run/fold 和 All 在进程池中并行
+        print("For cross-validation, training and testing...")
+        tasks = fold_scheduler.gen_cv_tasks(skf, dfTrain, self.gen_tfidf_svd_by_feat_column_names, "valid", ngram_range, feat_names, column_names)
         path = "%s/All" % config.feat_folder
-        self.gen_tfidf_svd_by_feat_column_names(path, dfTrain, dfTest, "test", ngram_range, feat_names, column_names)
+        tasks.append((self.gen_tfidf_svd_by_feat_column_names, (path, dfTrain, dfTest, "test", ngram_range, feat_names, column_names)))
+        fold_scheduler.run_tasks(tasks)
 
         print("Done.")
 
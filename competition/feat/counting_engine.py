@@ -0,0 +1,130 @@
+# coding:utf-8
+"""
+__file__
+
+    counting_engine.py
+
+__description__
+
+    This file provides the array based engine used by CountingFeat.
+
+        1. the unigram columns of query/title/description are encoded with one shared Vocabulary,
+           bigram/trigram are built from the ids by ngram_ids and packed into int64 keys
+
+        2. every statistic is computed for a whole column with numpy:
+            - count / unique count / digit count: bincount over the row index
+            - a's n-gram in b's n-gram: the keys are mapped to dense ids and combined with the row
+              index, np.in1d tests all the (row, n-gram) pairs at once
+            - the positions of a's n-gram in b's n-gram are already sorted inside a row, so
+              min/max/median are picked by offset and mean/std are two bincount passes
+
+__author__
+
+    songquanwang
+
+"""
+
+import numpy as np
+
+from competition.feat.nlp import ngram_ids
+
+# n-gram 列 -> ngram_ids 的 kind
+gram_kinds = {"unigram": "unigram", "bigram": "bigram", "trigram": "trigram"}
+
+
+def try_divide(x, y):
+    """
+    按列的 utils.try_divide：y 为 0 时返回 0
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nonzero = y != 0
+    return np.where(nonzero, x / np.where(nonzero, y, 1.), 0.)
+
+
+class CountingEngine(object):
+    def __init__(self, df, feat_names, grams):
+        """
+        :param df: 包含 <feat_name>_unigram 列（token_cache）
+        :param feat_names: ["query", "title", "description"]
+        :param grams: ["unigram", "bigram", "trigram"]
+        """
+        self.n_rows = df.shape[0]
+        self.vocabulary = ngram_ids.Vocabulary()
+        self.unigrams = dict()
+        for feat_name in feat_names:
+            self.unigrams[feat_name] = self.vocabulary.encode_column(df[feat_name + "_unigram"].values)
+        # key: (feat_name, gram) val: RaggedArray(int64)
+        self.columns = dict()
+        for feat_name in feat_names:
+            for gram in grams:
+                ngrams = ngram_ids.get_ngram_ids(self.unigrams[feat_name], gram_kinds[gram])
+                self.columns[(feat_name, gram)] = ngram_ids.pack_ngram_ids(ngrams, self.vocabulary.bits)
+        # 每个 token 是否是数字
+        self.is_digit = np.array([False] + [token.isdigit() for token in self.vocabulary.tokens[1:]], dtype=bool)
+
+    def get_count(self, feat_name, gram):
+        return self.columns[(feat_name, gram)].get_lengths()
+
+    def get_unique_count(self, feat_name, gram):
+        column = self.columns[(feat_name, gram)]
+        rows = column.get_row_index()
+        order = np.lexsort((column.data, rows))
+        rows, keys = rows[order], column.data[order]
+        # 每一行排序后与前一个不同的 n-gram
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (keys[1:] != keys[:-1])
+        return np.bincount(rows[first], minlength=self.n_rows)
+
+    def get_digit_count(self, feat_name):
+        column = self.unigrams[feat_name]
+        return np.bincount(column.get_row_index(), weights=self.is_digit[column.data], minlength=self.n_rows)
+
+    def get_intersect(self, obs_name, target_name, gram):
+        """
+        obs 的 n-gram 中出现在 target 同一行中的
+        :return: bool mask（与 obs 的 data 对齐）
+        """
+        obs = self.columns[(obs_name, gram)]
+        target = self.columns[(target_name, gram)]
+        keys, inverse = np.unique(np.concatenate([obs.data, target.data]), return_inverse=True)
+        n_keys = max(len(keys), 1)
+        obs_codes = obs.get_row_index() * n_keys + inverse[:len(obs.data)]
+        target_codes = target.get_row_index() * n_keys + inverse[len(obs.data):]
+        return np.in1d(obs_codes, target_codes)
+
+    def get_intersect_count(self, obs_name, target_name, gram):
+        obs = self.columns[(obs_name, gram)]
+        mask = self.get_intersect(obs_name, target_name, gram)
+        return np.bincount(obs.get_row_index(), weights=mask, minlength=self.n_rows)
+
+    def get_position_stats(self, obs_name, target_name, gram):
+        """
+        obs 中出现在 target 的 n-gram 的位置（从 1 开始）的 min/mean/median/max/std，
+        没有时位置为 [0]，与 CountingFeat.get_position_list 相同
+        :return: dict
+        """
+        obs = self.columns[(obs_name, gram)]
+        mask = self.get_intersect(obs_name, target_name, gram)
+        rows = obs.get_row_index()
+        positions = (np.arange(len(obs.data)) - obs.indptr[rows] + 1)[mask].astype(float)
+        rows = rows[mask]
+        count = np.bincount(rows, minlength=self.n_rows)
+        found = count > 0
+        # 每一行第一个位置在 positions 中的下标
+        start = np.zeros(self.n_rows, dtype=np.int64)
+        np.cumsum(count[:-1], out=start[1:])
+        stats = dict((name, np.zeros(self.n_rows, dtype=float)) for name in ["min", "mean", "median", "max", "std"])
+        if not found.any():
+            return stats
+        start_found, count_found = start[found], count[found]
+        stats["min"][found] = positions[start_found]
+        stats["max"][found] = positions[start_found + count_found - 1]
+        stats["median"][found] = (positions[start_found + (count_found - 1) // 2] + positions[start_found + count_found // 2]) / 2.
+        mean = np.bincount(rows, weights=positions, minlength=self.n_rows)[found] / count_found
+        stats["mean"][found] = mean
+        mean_all = np.zeros(self.n_rows, dtype=float)
+        mean_all[found] = mean
+        var = np.bincount(rows, weights=(positions - mean_all[rows]) ** 2, minlength=self.n_rows)[found] / count_found
+        stats["std"][found] = np.sqrt(var)
+        return stats
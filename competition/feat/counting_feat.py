@@ -35,21 +35,23 @@ __author__
 import cPickle
 import abc
 
-import numpy as np
-
 import competition.conf.model_params_conf as  config
-import competition.utils.utils as utils
 from  competition.feat.base_feat import BaseFeat
+from competition.feat import fold_scheduler
+from competition.feat import feat_store
+from competition.feat.counting_engine import CountingEngine, try_divide
 
 
 class CountingFeat(BaseFeat):
     __metaclass__ = abc.ABCMeta
 
+    @staticmethod
     def get_position_list(target, obs):
         """
             Get the list of positions of obs in target
             把在target列表中存在的obs列表的index保存到数组里，index从1开始
             如果obs中没有target中的元素，返回[0]
+            逐行版本，CountingEngine.get_position_stats 按列计算相同的结果
         """
         pos_of_obs_in_target = [0]
         if len(obs) != 0:
@@ -58,37 +60,40 @@ class CountingFeat(BaseFeat):
                 pos_of_obs_in_target = [0]
         return pos_of_obs_in_target
 
-    def extract_digit_count_feat(self, df, feat_names, grams):
+    def extract_digit_count_feat(self, df, feat_names, grams, engine):
         """
          word count and digit count
         :param df:
         :param feat_names:
         :param grams:
+        :param engine: CountingEngine
         :return:
         """
         print "generate word counting features"
-        # 计算包含数字的个数
-        count_digit = lambda x: sum([1. for w in x if w.isdigit()])
         for feat_name in feat_names:
             for gram in grams:
                 ## word count
-                df["count_of_%s_%s" % (feat_name, gram)] = list(df.apply(lambda x: len(x[feat_name + "_" + gram]), axis=1))
-                df["count_of_unique_%s_%s" % (feat_name, gram)] = list(df.apply(lambda x: len(set(x[feat_name + "_" + gram])), axis=1))
-                df["ratio_of_unique_%s_%s" % (feat_name, gram)] = map(utils.try_divide, df["count_of_unique_%s_%s" % (feat_name, gram)], df["count_of_%s_%s" % (feat_name, gram)])
+                count = engine.get_count(feat_name, gram)
+                count_unique = engine.get_unique_count(feat_name, gram)
+                df["count_of_%s_%s" % (feat_name, gram)] = count
+                df["count_of_unique_%s_%s" % (feat_name, gram)] = count_unique
+                df["ratio_of_unique_%s_%s" % (feat_name, gram)] = try_divide(count_unique, count)
 
             ## digit count
-            df["count_of_digit_in_%s" % feat_name] = list(df.apply(lambda x: count_digit(x[feat_name + "_unigram"]), axis=1))
-            df["ratio_of_digit_in_%s" % feat_name] = map(utils.try_divide, df["count_of_digit_in_%s" % feat_name], df["count_of_%s_unigram" % (feat_name)])
+            count_digit = engine.get_digit_count(feat_name)
+            df["count_of_digit_in_%s" % feat_name] = count_digit
+            df["ratio_of_digit_in_%s" % feat_name] = try_divide(count_digit, engine.get_count(feat_name, "unigram"))
 
         ## description missing indicator
-        df["description_missing"] = list(df.apply(lambda x: int(x["description_unigram"] == ""), axis=1))
+        df["description_missing"] = [int(x == "") for x in df["description_unigram"]]
 
-    def extract_interset_digit_count_feat(self, df, feat_names, grams):
+    def extract_interset_digit_count_feat(self, df, feat_names, grams, engine):
         """
         intersect word count
         :param df:
         :param feat_names:
         :param grams:
+        :param engine: CountingEngine
         :return:
         """
         print "generate intersect word counting features"
@@ -98,21 +103,23 @@ class CountingFeat(BaseFeat):
                 for target_name in feat_names:
                     if target_name != obs_name:
                         ## query
-                        df["count_of_%s_%s_in_%s" % (obs_name, gram, target_name)] = list(df.apply(lambda x: sum([1. for w in x[obs_name + "_" + gram] if w in set(x[target_name + "_" + gram])]), axis=1))
-                        df["ratio_of_%s_%s_in_%s" % (obs_name, gram, target_name)] = map(utils.try_divide, df["count_of_%s_%s_in_%s" % (obs_name, gram, target_name)], df["count_of_%s_%s" % (obs_name, gram)])
+                        count = engine.get_intersect_count(obs_name, target_name, gram)
+                        df["count_of_%s_%s_in_%s" % (obs_name, gram, target_name)] = count
+                        df["ratio_of_%s_%s_in_%s" % (obs_name, gram, target_name)] = try_divide(count, engine.get_count(obs_name, gram))
 
             ## some other feat
-            df["title_%s_in_query_div_query_%s" % (gram, gram)] = map(utils.try_divide, df["count_of_title_%s_in_query" % gram], df["count_of_query_%s" % gram])
-            df["title_%s_in_query_div_query_%s_in_title" % (gram, gram)] = map(utils.try_divide, df["count_of_title_%s_in_query" % gram], df["count_of_query_%s_in_title" % gram])
-            df["description_%s_in_query_div_query_%s" % (gram, gram)] = map(utils.try_divide, df["count_of_description_%s_in_query" % gram], df["count_of_query_%s" % gram])
-            df["description_%s_in_query_div_query_%s_in_description" % (gram, gram)] = map(utils.try_divide, df["count_of_description_%s_in_query" % gram], df["count_of_query_%s_in_description" % gram])
+            df["title_%s_in_query_div_query_%s" % (gram, gram)] = try_divide(df["count_of_title_%s_in_query" % gram], df["count_of_query_%s" % gram])
+            df["title_%s_in_query_div_query_%s_in_title" % (gram, gram)] = try_divide(df["count_of_title_%s_in_query" % gram], df["count_of_query_%s_in_title" % gram])
+            df["description_%s_in_query_div_query_%s" % (gram, gram)] = try_divide(df["count_of_description_%s_in_query" % gram], df["count_of_query_%s" % gram])
+            df["description_%s_in_query_div_query_%s_in_description" % (gram, gram)] = try_divide(df["count_of_description_%s_in_query" % gram], df["count_of_query_%s_in_description" % gram])
 
-    def extract_interset_word_pos_feat(self, df, feat_names, grams):
+    def extract_interset_word_pos_feat(self, df, feat_names, grams, engine):
         """
         intersect word position feat
         :param df:
         :param feat_names:
         :param grams:
+        :param engine: CountingEngine
         :return:
         """
         print "generate intersect word position features"
@@ -120,24 +127,13 @@ class CountingFeat(BaseFeat):
             for target_name in feat_names:
                 for obs_name in feat_names:
                     if target_name != obs_name:
-                        pos = list(df.apply(lambda x: self.get_position_list(x[target_name + "_" + gram], obs=x[obs_name + "_" + gram]), axis=1))
-                        ## stats feat on pos
-                        df["pos_of_%s_%s_in_%s_min" % (obs_name, gram, target_name)] = map(np.min, pos)
-                        df["pos_of_%s_%s_in_%s_mean" % (obs_name, gram, target_name)] = map(np.mean, pos)
-                        df["pos_of_%s_%s_in_%s_median" % (obs_name, gram, target_name)] = map(np.median, pos)
-                        df["pos_of_%s_%s_in_%s_max" % (obs_name, gram, target_name)] = map(np.max, pos)
-                        df["pos_of_%s_%s_in_%s_std" % (obs_name, gram, target_name)] = map(np.std, pos)
-                        ## stats feat on normalized_pos
-                        df["normalized_pos_of_%s_%s_in_%s_min" % (obs_name, gram, target_name)] = map(utils.utils.try_divide, df["pos_of_%s_%s_in_%s_min" % (obs_name, gram, target_name)],
-                                                                                                      df["count_of_%s_%s" % (obs_name, gram)])
-                        df["normalized_pos_of_%s_%s_in_%s_mean" % (obs_name, gram, target_name)] = map(utils.try_divide, df["pos_of_%s_%s_in_%s_mean" % (obs_name, gram, target_name)],
-                                                                                                       df["count_of_%s_%s" % (obs_name, gram)])
-                        df["normalized_pos_of_%s_%s_in_%s_median" % (obs_name, gram, target_name)] = map(utils.try_divide, df["pos_of_%s_%s_in_%s_median" % (obs_name, gram, target_name)],
-                                                                                                         df["count_of_%s_%s" % (obs_name, gram)])
-                        df["normalized_pos_of_%s_%s_in_%s_max" % (obs_name, gram, target_name)] = map(utils.try_divide, df["pos_of_%s_%s_in_%s_max" % (obs_name, gram, target_name)],
-                                                                                                      df["count_of_%s_%s" % (obs_name, gram)])
-                        df["normalized_pos_of_%s_%s_in_%s_std" % (obs_name, gram, target_name)] = map(utils.try_divide, df["pos_of_%s_%s_in_%s_std" % (obs_name, gram, target_name)],
-                                                                                                      df["count_of_%s_%s" % (obs_name, gram)])
+                        stats = engine.get_position_stats(obs_name, target_name, gram)
+                        count = engine.get_count(obs_name, gram)
+                        for stat in ["min", "mean", "median", "max", "std"]:
+                            ## stats feat on pos
+                            df["pos_of_%s_%s_in_%s_%s" % (obs_name, gram, target_name, stat)] = stats[stat]
+                            ## stats feat on normalized_pos
+                            df["normalized_pos_of_%s_%s_in_%s_%s" % (obs_name, gram, target_name, stat)] = try_divide(stats[stat], count)
 
     def extract_feat(self, df):
         """
@@ -152,16 +148,14 @@ class CountingFeat(BaseFeat):
         # 生成临时特征
         feat_names = ["query", "title", "description"]
         grams = ["unigram", "bigram", "trigram"]
+        # token id 列（ragged），所有特征按列计算
+        engine = CountingEngine(df, feat_names, grams)
         # word count and digit count
-        print "generate word counting features"
-        # 计算包含数字的个数
-        self.extract_digit_count_feat(df, feat_names, grams)
+        self.extract_digit_count_feat(df, feat_names, grams, engine)
         # intersect word count
-        print "generate intersect word counting features"
-        self.extract_interset_digit_count_feat(df, feat_names, grams)
+        self.extract_interset_digit_count_feat(df, feat_names, grams, engine)
         # intersect word position feat
-        print "generate intersect word position features"
-        self.extract_interset_word_pos_feat(df, feat_names, grams)
+        self.extract_interset_word_pos_feat(df, feat_names, grams, engine)
 
     def gen_count_pos_by_feat_names(self, path, dfTrain, dfTest, mode, feat_names):
         """
@@ -175,10 +169,8 @@ class CountingFeat(BaseFeat):
         for feat_name in feat_names:
             X_train = dfTrain[feat_name]
             X_test = dfTest[feat_name]
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(X_train, f, -1)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "wb") as f:
-                cPickle.dump(X_test, f, -1)
+            feat_store.dump_feat("%s/train.%s" % (path, feat_name), X_train)
+            feat_store.dump_feat("%s/%s.%s" % (path, mode, feat_name), X_test)
 
     def gen_counting_feat(self):
 
@@ -193,6 +185,15 @@ class CountingFeat(BaseFeat):
         # file to save feat names
         feat_name_file = "%s/counting.feat_name" % config.feat_folder
 
+        print("==================================================")
+        print("Generate counting features...")
+
+        self.gen_temp_feat(dfTrain, config.processed_train_data_path)
+        self.gen_temp_feat(dfTest, config.processed_test_data_path)
+        self.extract_feat(dfTrain)
+        self.extract_feat(dfTest)
+
+        # 特征列在 extract_feat 之后才存在
         feat_names = [
             name for name in dfTrain.columns \
             if "count" in name \
@@ -202,29 +203,14 @@ class CountingFeat(BaseFeat):
             ]
         feat_names.append("description_missing")
 
-        print("==================================================")
-        print("Generate counting features...")
-
-        self.gen_temp_feat(dfTrain)
-        self.gen_temp_feat(dfTest)
-        self.extract_feat(dfTrain)
-        self.extract_feat(dfTest)
-
-        print("For cross-validation...")
-        for run in range(config.n_runs):
-            # use 33% for training and 67 % for validation, so we switch trainInd and validInd
-            for fold, (validInd, trainInd) in enumerate(skf[run]):
-                print("Run: %d, Fold: %d" % (run + 1, fold + 1))
-                path = "%s/Run%d/Fold%d" % (config.feat_folder, run + 1, fold + 1)
-                X_train_train = dfTrain.iloc[trainInd]
-                X_train_valid = dfTrain.iloc[validInd]
-                self.gen_count_pos_by_feat_names(path, X_train_train, X_train_valid, "valid", feat_names)
-        print("Done.")
-
-        print("For training and testing...")
+        # run/fold 和 All 在进程池中并行
+        print("For cross-validation, training and testing...")
+        tasks = fold_scheduler.gen_cv_tasks(skf, dfTrain, self.gen_count_pos_by_feat_names, "valid", feat_names)
         path = "%s/All" % config.feat_folder
         # use full version for X_train
-        self.gen_count_pos_by_feat_names(path, dfTrain, dfTest, "test", feat_names)
+        tasks.append((self.gen_count_pos_by_feat_names, (path, dfTrain, dfTest, "test", feat_names)))
+        fold_scheduler.run_tasks(tasks)
+        print("Done.")
 
         ## save feat names
         print("Feature names are stored in %s" % feat_name_file)
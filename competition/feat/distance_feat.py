@@ -36,22 +36,25 @@ from copy import copy
 import abc
 
 import numpy as np
-import pandas as pd
+from scipy.sparse import csr_matrix
 
-from competition.feat.nlp import ngram
 import competition.conf.model_params_conf as  config
-from competition.feat.nlp.nlp_utils import preprocess_data
 from  competition.feat.base_feat import BaseFeat
+from competition.feat import stats_engine
+from competition.feat import fold_scheduler
+from competition.feat import feat_store
 import competition.utils.utils as utils
 
 
 class DistanceFeat(BaseFeat):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, stats_feat_flag=True):
+    def __init__(self, stats_feat_flag=True, stats_block_size=None):
 
         # 是否计算统计特征
         self.stats_feat_flag = stats_feat_flag
+        # 统计特征按块计算的行数，None 表示一次生成完整的距离矩阵
+        self.stats_block_size = stats_block_size
         # stats to extract
         self.quantiles_range = np.arange(0, 1.5, 0.5)
         self.stats_func = [np.mean, np.std]
@@ -84,22 +87,89 @@ class DistanceFeat(BaseFeat):
             d = DistanceFeat.DiceDist(A, B)
         return d
 
+    ##########################
+    ## Sparse set distance ##
+    ##########################
+    @staticmethod
+    def gen_binary_csr(A, B):
+        """
+        把两组 n-gram 列表编码成同一个词表上的 0/1 CSR 矩阵，每一行是一个 n-gram 集合
+        :param A: n-gram 列表的数组
+        :param B: n-gram 列表的数组
+        :return: A_bin, B_bin
+        """
+        vocabulary = dict()
+
+        def encode(lists):
+            indices = []
+            indptr = [0]
+            for lst in lists:
+                for w in set(lst):
+                    indices.append(vocabulary.setdefault(w, len(vocabulary)))
+                indptr.append(len(indices))
+            return np.asarray(indices, dtype=int), np.asarray(indptr, dtype=int)
+
+        indices_a, indptr_a = encode(A)
+        indices_b, indptr_b = encode(B)
+        shape_a = (len(indptr_a) - 1, len(vocabulary))
+        shape_b = (len(indptr_b) - 1, len(vocabulary))
+        A_bin = csr_matrix((np.ones(len(indices_a)), indices_a, indptr_a), shape=shape_a)
+        B_bin = csr_matrix((np.ones(len(indices_b)), indices_b, indptr_b), shape=shape_b)
+        return A_bin, B_bin
+
+    @staticmethod
+    def set_dist_from_intersect(intersect, size_a, size_b, dist="jaccard_coef"):
+        """
+        根据交集大小和集合大小计算 jaccard coef / dice dist，分母为0时为0（同 utils.try_divide）
+        """
+        if dist == "jaccard_coef":
+            numerator = intersect
+            denominator = size_a + size_b - intersect
+        elif dist == "dice_dist":
+            numerator = 2. * intersect
+            denominator = size_a + size_b
+        d = numerator / np.where(denominator == 0, 1., denominator)
+        d[denominator == 0] = 0.
+        return d
+
+    @staticmethod
+    def pairwise_set_dist(A_bin, B_bin, dist="jaccard_coef"):
+        """
+        所有 A 行与 B 行的 jaccard coef / dice dist，交集用一次稀疏矩阵乘法计算
+        :param A_bin: gen_binary_csr 编码的 CSR 矩阵
+        :param B_bin: gen_binary_csr 编码的 CSR 矩阵
+        :return: (A 行数, B 行数) 的矩阵
+        """
+        intersect = np.asarray(A_bin.dot(B_bin.T).todense(), dtype=float)
+        size_a = np.diff(A_bin.indptr)[:, np.newaxis].astype(float)
+        size_b = np.diff(B_bin.indptr)[np.newaxis, :].astype(float)
+        return DistanceFeat.set_dist_from_intersect(intersect, size_a, size_b, dist)
+
+    @staticmethod
+    def rowwise_set_dist(A_bin, B_bin, dist="jaccard_coef"):
+        """
+        第 i 行 A 与第 i 行 B 的 jaccard coef / dice dist
+        :param A_bin: gen_binary_csr 编码的 CSR 矩阵
+        :param B_bin: gen_binary_csr 编码的 CSR 矩阵
+        :return: (行数,) 的数组
+        """
+        intersect = np.asarray(A_bin.multiply(B_bin).sum(axis=1), dtype=float).ravel()
+        size_a = np.diff(A_bin.indptr).astype(float)
+        size_b = np.diff(B_bin.indptr).astype(float)
+        return DistanceFeat.set_dist_from_intersect(intersect, size_a, size_b, dist)
+
     # pairwise distance
     @staticmethod
     def pairwise_jaccard_coef(A, B):
-        coef = np.zeros((A.shape[0], B.shape[0]), dtype=float)
-        for i in range(A.shape[0]):
-            for j in range(B.shape[0]):
-                coef[i, j] = DistanceFeat.JaccardCoef(A[i], B[j])
-        return coef
+        A_bin, B_bin = DistanceFeat.gen_binary_csr(A, B)
+        return DistanceFeat.pairwise_set_dist(A_bin, B_bin, "jaccard_coef")
 
+    @staticmethod
     def pairwise_dice_dist(A, B):
-        d = np.zeros((A.shape[0], B.shape[0]), dtype=float)
-        for i in range(A.shape[0]):
-            for j in range(B.shape[0]):
-                d[i, j] = DistanceFeat.DiceDist(A[i], B[j])
-        return d
+        A_bin, B_bin = DistanceFeat.gen_binary_csr(A, B)
+        return DistanceFeat.pairwise_set_dist(A_bin, B_bin, "dice_dist")
 
+    @staticmethod
     def pairwise_dist(A, B, dist="jaccard_coef"):
         if dist == "jaccard_coef":
             d = DistanceFeat.pairwise_jaccard_coef(A, B)
@@ -119,28 +189,16 @@ class DistanceFeat(BaseFeat):
         :param qids_test:
         :return:
         """
-        stats_feat = 0 * np.ones((len(ids_test), self.stats_feat_num * config.n_classes), dtype=float)
+        # 只编码一次，分块时直接切片 CSR 矩阵
+        X_train_bin, X_test_bin = DistanceFeat.gen_binary_csr(X_train, X_test)
+        if self.stats_block_size:
+            # 分块计算，不生成完整的距离矩阵
+            dist_func = lambda A, B: DistanceFeat.pairwise_set_dist(A, B, dist)
+            return stats_engine.gen_blocked_dist_stats_feat(dist_func, X_train_bin, ids_train, X_test_bin, ids_test, indices_dict, config.n_classes, self.quantiles_range, qids_test,
+                                                            block_size=self.stats_block_size)
         ## pairwise dist
-        distance = DistanceFeat.pairwise_dist(X_test, X_train, dist)
-        for i in range(len(ids_test)):
-            id = ids_test[i]
-            if qids_test is not None:
-                qid = qids_test[i]
-            for j in range(config.n_classes):
-                key = (qid, j + 1) if qids_test is not None else j + 1
-                if indices_dict.has_key(key):
-                    inds = indices_dict[key]
-                    # exclude this sample itself from the list of indices
-                    inds = [ind for ind in inds if id != ids_train[ind]]
-                    distance_tmp = distance[i][inds]
-                    if len(distance_tmp) != 0:
-                        feat = [func(distance_tmp) for func in self.stats_func]
-                        ## quantile
-                        distance_tmp = pd.Series(distance_tmp)
-                        quantiles = distance_tmp.quantile(self.quantiles_range)
-                        feat = np.hstack((feat, quantiles))
-                        stats_feat[i, j * self.stats_feat_num:(j + 1) * self.stats_feat_num] = feat
-        return stats_feat
+        distance = DistanceFeat.pairwise_set_dist(X_test_bin, X_train_bin, dist)
+        return stats_engine.gen_dist_stats_feat(distance, ids_train, ids_test, indices_dict, config.n_classes, self.quantiles_range, qids_test)
 
     def extract_basic_distance_feat(self, df):
         """
@@ -148,39 +206,30 @@ class DistanceFeat(BaseFeat):
         :param df:
         :return:
         """
-        ## unigram
-        print "generate unigram"
-        df["query_unigram"] = list(df.apply(lambda x: preprocess_data(x["query"]), axis=1))
-        df["title_unigram"] = list(df.apply(lambda x: preprocess_data(x["product_title"]), axis=1))
-        df["description_unigram"] = list(df.apply(lambda x: preprocess_data(x["product_description"]), axis=1))
-        ## bigram
-        print "generate bigram"
-        join_str = "_"
-        df["query_bigram"] = list(df.apply(lambda x: ngram.getBigram(x["query_unigram"], join_str), axis=1))
-        df["title_bigram"] = list(df.apply(lambda x: ngram.getBigram(x["title_unigram"], join_str), axis=1))
-        df["description_bigram"] = list(df.apply(lambda x: ngram.getBigram(x["description_unigram"], join_str), axis=1))
-        ## trigram
-        print "generate trigram"
-        join_str = "_"
-        df["query_trigram"] = list(df.apply(lambda x: ngram.getTrigram(x["query_unigram"], join_str), axis=1))
-        df["title_trigram"] = list(df.apply(lambda x: ngram.getTrigram(x["title_unigram"], join_str), axis=1))
-        df["description_trigram"] = list(df.apply(lambda x: ngram.getTrigram(x["description_unigram"], join_str), axis=1))
-
+        # unigram/bigram/trigram 已经由 gen_temp_feat 从 token_cache 读取
         ## jaccard coef/dice dist of n-gram
         print "generate jaccard coef and dice dist for n-gram"
         dists = ["jaccard_coef", "dice_dist"]
         grams = ["unigram", "bigram", "trigram"]
         feat_names = ["query", "title", "description"]
+        set_dist = dict()
+        for gram in grams:
+            for i in range(len(feat_names) - 1):
+                for j in range(i + 1, len(feat_names)):
+                    target_name = feat_names[i]
+                    obs_name = feat_names[j]
+                    # 每一对列只编码一次，jaccard coef/dice dist 共用交集
+                    target_bin, obs_bin = DistanceFeat.gen_binary_csr(df[target_name + "_" + gram].values, df[obs_name + "_" + gram].values)
+                    for dist in dists:
+                        set_dist[(dist, gram, target_name, obs_name)] = DistanceFeat.rowwise_set_dist(target_bin, obs_bin, dist)
+        # 保持原来的列顺序
         for dist in dists:
             for gram in grams:
                 for i in range(len(feat_names) - 1):
                     for j in range(i + 1, len(feat_names)):
                         target_name = feat_names[i]
                         obs_name = feat_names[j]
-                        df["%s_of_%s_between_%s_%s" % (dist, gram, target_name, obs_name)] = \
-                            list(df.apply(
-                                lambda x: DistanceFeat.compute_dist(x[target_name + "_" + gram], x[obs_name + "_" + gram], dist),
-                                axis=1))
+                        df["%s_of_%s_between_%s_%s" % (dist, gram, target_name, obs_name)] = set_dist[(dist, gram, target_name, obs_name)]
 
     def extract_statistical_distance_feat(self, path, dfTrain, dfTest, mode, feat_names):
         """
@@ -194,8 +243,8 @@ class DistanceFeat(BaseFeat):
         """
         new_feat_names = copy(feat_names)
         ## get the indices of pooled samples
-        relevance_indices_dict = self.get_sample_indices_by_relevance(dfTrain)
-        query_relevance_indices_dict = self.get_sample_indices_by_relevance(dfTrain, "qid")
+        relevance_indices_dict = stats_engine.gen_group_indices(self.get_sample_indices_by_relevance(dfTrain))
+        query_relevance_indices_dict = stats_engine.gen_group_indices(self.get_sample_indices_by_relevance(dfTrain, "qid"))
         # very time consuming
         for dist in ["jaccard_coef", "dice_dist"]:
             for name in ["title", "description"]:
@@ -206,23 +255,16 @@ class DistanceFeat(BaseFeat):
                     dist_stats_feat_by_query_relevance_train = self.generate_dist_stats_feat(dist, dfTrain[name + "_" + gram].values, dfTrain["id"].values, dfTrain[name + "_" + gram].values, dfTrain["id"].values,
                                                                                              query_relevance_indices_dict,
                                                                                              dfTrain["qid"].values)
-                    with open("%s/train.%s_%s_%s_stats_feat_by_relevance.feat.pkl" % (path, name, gram, dist), "wb") as f:
-                        cPickle.dump(dist_stats_feat_by_relevance_train, f, -1)
-                    with open("%s/train.%s_%s_%s_stats_feat_by_query_relevance.feat.pkl" % (path, name, gram, dist),
-                              "wb") as f:
-                        cPickle.dump(dist_stats_feat_by_query_relevance_train, f, -1)
+                    feat_store.dump_feat("%s/train.%s_%s_%s_stats_feat_by_relevance" % (path, name, gram, dist), dist_stats_feat_by_relevance_train)
+                    feat_store.dump_feat("%s/train.%s_%s_%s_stats_feat_by_query_relevance" % (path, name, gram, dist), dist_stats_feat_by_query_relevance_train)
                     ## test
                     dist_stats_feat_by_relevance_test = self.generate_dist_stats_feat(dist, dfTrain[name + "_" + gram].values, dfTrain["id"].values, dfTest[name + "_" + gram].values, dfTest["id"].values,
                                                                                       relevance_indices_dict)
                     dist_stats_feat_by_query_relevance_test = self.generate_dist_stats_feat(dist, dfTrain[name + "_" + gram].values, dfTrain["id"].values, dfTest[name + "_" + gram].values, dfTest["id"].values,
                                                                                             query_relevance_indices_dict,
                                                                                             dfTest["qid"].values)
-                    with open("%s/%s.%s_%s_%s_stats_feat_by_relevance.feat.pkl" % (path, mode, name, gram, dist),
-                              "wb") as f:
-                        cPickle.dump(dist_stats_feat_by_relevance_test, f, -1)
-                    with open("%s/%s.%s_%s_%s_stats_feat_by_query_relevance.feat.pkl" % (path, mode, name, gram, dist),
-                              "wb") as f:
-                        cPickle.dump(dist_stats_feat_by_query_relevance_test, f, -1)
+                    feat_store.dump_feat("%s/%s.%s_%s_%s_stats_feat_by_relevance" % (path, mode, name, gram, dist), dist_stats_feat_by_relevance_test)
+                    feat_store.dump_feat("%s/%s.%s_%s_%s_stats_feat_by_query_relevance" % (path, mode, name, gram, dist), dist_stats_feat_by_query_relevance_test)
 
                     ## update feat names
                     new_feat_names.append("%s_%s_%s_stats_feat_by_relevance" % (name, gram, dist))
@@ -231,18 +273,21 @@ class DistanceFeat(BaseFeat):
         return new_feat_names
 
     def gen_distance_by_feat_names(self, path, dfTrain, dfTest, mode, feat_names):
+        """
+        :return: 所有特征名（包括 stats 特征）
+        """
         for feat_name in feat_names:
             X_train = dfTrain[feat_name]
-            dfTest = dfTest[feat_name]
-            with open("%s/train.%s.feat.pkl" % (path, feat_name), "wb") as f:
-                cPickle.dump(X_train, f, -1)
-            with open("%s/%s.%s.feat.pkl" % (path, mode, feat_name), "wb") as f:
-                cPickle.dump(dfTest, f, -1)
-            ## extract statistical distance features
-            if self.stats_feat_flag:
-                dfTrain_copy = dfTrain.copy()
-                dfTest_copy = dfTest.copy()
-                self.extract_statistical_distance_feat(path, dfTrain_copy, dfTest_copy, mode, feat_names)
+            X_test = dfTest[feat_name]
+            feat_store.dump_feat("%s/train.%s" % (path, feat_name), X_train)
+            feat_store.dump_feat("%s/%s.%s" % (path, mode, feat_name), X_test)
+        ## extract statistical distance features
+        # 与 feat_name 无关，每个 run/fold 只计算一次
+        if self.stats_feat_flag:
+            dfTrain_copy = dfTrain.copy()
+            dfTest_copy = dfTest.copy()
+            return self.extract_statistical_distance_feat(path, dfTrain_copy, dfTest_copy, mode, feat_names)
+        return feat_names
 
     def gen_distance_feat(self):
 
@@ -258,37 +303,29 @@ class DistanceFeat(BaseFeat):
         ## file to save feat names
         feat_name_file = "%s/distance.feat_name" % config.feat_folder
 
-        feat_names = [name for name in dfTrain.columns if "jaccard_coef" in name or "dice_dist" in name]
-
         #######################
         ## Generate Features ##
         #######################
         print("==================================================")
         print("Generate distance features...")
 
-        self.gen_temp_feat(dfTrain)
-        self.gen_temp_feat(dfTest)
+        self.gen_temp_feat(dfTrain, config.processed_train_data_path)
+        self.gen_temp_feat(dfTest, config.processed_test_data_path)
         self.extract_basic_distance_feat(dfTrain)
         ## use full version for X_train
         self.extract_basic_distance_feat(dfTest)
 
-        print("For cross-validation...")
-        for run in range(config.n_runs):
-            # use 33% for training and 67 % for validation,so we switch trainInd and validInd
-            for fold, (validInd, trainInd) in enumerate(skf[run]):
-                print("Run: %d, Fold: %d" % (run + 1, fold + 1))
-                path = "%s/Run%d/Fold%d" % (config.feat_folder, run + 1, fold + 1)
-
-                X_train_train = dfTrain.iloc[trainInd]
-                X_train_valid = dfTrain.iloc[validInd]
-                self.gen_distance_by_feat_names(path, X_train_train, X_train_valid, "valid", feat_names)
-
-        print("Done.")
+        # 特征列在 extract_basic_distance_feat 之后才存在
+        feat_names = [name for name in dfTrain.columns if "jaccard_coef" in name or "dice_dist" in name]
 
-        print("For training and testing...")
+        # run/fold 和 All 在进程池中并行
+        print("For cross-validation, training and testing...")
+        tasks = fold_scheduler.gen_cv_tasks(skf, dfTrain, self.gen_distance_by_feat_names, "valid", feat_names)
         path = "%s/All" % config.feat_folder
-
-        self.gen_distance_by_feat_names(path, dfTrain, dfTest, "test", feat_names)
+        tasks.append((self.gen_distance_by_feat_names, (path, dfTrain, dfTest, "test", feat_names)))
+        # All task 的特征名包括 stats 特征
+        feat_names = fold_scheduler.run_tasks(tasks)[-1]
+        print("Done.")
 
         ## save feat names
         print("Feature names are stored in %s" % feat_name_file)
@@ -0,0 +1,181 @@
+# coding:utf-8
+"""
+__file__
+
+    feat_store.py
+
+__description__
+
+    This file provides the feature store used by all the feature generators, it replaces the
+    per-feature cPickle files (train.%s.feat.pkl).
+
+        1. one directory per Run%d/Fold%d and All (config.feat_folder), every feature is stored as
+            - dense:  <mode>.<feat_name>.feat.npy
+            - sparse: <mode>.<feat_name>.feat.data.npy/.indices.npy/.indptr.npy (CSR triplet)
+           the CSR triplet is stored as plain .npy files instead of one .npz archive,
+           because the arrays inside a .npz can not be memory-mapped
+
+        2. every feature has a sidecar <mode>.<feat_name>.feat.json (format, shape, dtype), it is written
+           after the arrays, so a feature is complete only when its json exists. load_manifest() scans the
+           sidecars of a directory, there is no shared manifest file to be updated by the fold workers;
+           check_feats() uses it to verify that the features to combine exist and have the same row count
+
+        3. load_feat() opens the arrays with np.load(mmap_mode='r'), combining hundreds of features
+           doesn't deserialize everything into memory; the old .feat.pkl files can still be read
+
+        4. the combined matrices (train.feat/valid.feat/test.feat) use the same binary layout plus
+           <mode>.feat.label.npy, BaseModel loads them without any text parsing;
+           svmlight is only an export format now
+
+__author__
+
+    songquanwang
+
+"""
+
+import os
+import glob
+import json
+import cPickle
+
+import numpy as np
+from scipy.sparse import issparse, csr_matrix
+from sklearn.datasets import dump_svmlight_file, load_svmlight_file
+
+feat_ext = ".feat"
+meta_ext = ".feat.json"
+csr_parts = ["data", "indices", "indptr"]
+
+
+def get_meta_path(feat_path):
+    return feat_path + meta_ext
+
+
+def _dump_arrays(prefix, X, meta=None):
+    """
+    dense: prefix.npy；sparse: prefix.data.npy/.indices.npy/.indptr.npy；最后写 prefix.json
+    """
+    meta = dict(meta or {})
+    if issparse(X):
+        X = csr_matrix(X)
+        for part in csr_parts:
+            np.save("%s.%s.npy" % (prefix, part), getattr(X, part))
+        meta["format"] = "csr"
+    else:
+        X = np.ascontiguousarray(np.asarray(X))
+        np.save("%s.npy" % prefix, X)
+        meta["format"] = "dense"
+    meta["shape"] = list(X.shape)
+    meta["dtype"] = X.dtype.str
+    with open("%s.json" % prefix, "wb") as f:
+        json.dump(meta, f)
+
+
+def _load_arrays(prefix, mmap_mode):
+    with open("%s.json" % prefix, "rb") as f:
+        meta = json.load(f)
+    if meta["format"] == "csr":
+        data, indices, indptr = [np.load("%s.%s.npy" % (prefix, part), mmap_mode=mmap_mode) for part in csr_parts]
+        return csr_matrix((data, indices, indptr), shape=tuple(meta["shape"]), copy=False), meta
+    return np.load("%s.npy" % prefix, mmap_mode=mmap_mode), meta
+
+
+def dump_feat(feat_path, X):
+    """
+    保存一个特征
+    :param feat_path: 不带后缀的特征路径，例如 "%s/train.%s" % (path, feat_name)
+    :param X: numpy 数组、pandas Series/DataFrame 或者稀疏矩阵
+    :return:
+    """
+    _dump_arrays(feat_path + feat_ext, X)
+
+
+def load_meta(feat_path):
+    with open(get_meta_path(feat_path), "rb") as f:
+        return json.load(f)
+
+
+def load_feat(feat_path, mmap_mode="r"):
+    """
+    读取一个特征
+    :param feat_path: 不带后缀的特征路径
+    :param mmap_mode: np.load 的 mmap_mode，None 表示读入内存
+    :return: numpy 数组（mmap）或者 csr_matrix
+    """
+    if not os.path.exists(get_meta_path(feat_path)):
+        # 旧的 cPickle 格式
+        with open("%s%s.pkl" % (feat_path, feat_ext), "rb") as f:
+            return cPickle.load(f)
+    X, meta = _load_arrays(feat_path + feat_ext, mmap_mode)
+    return X
+
+
+def dump_feat_matrix(feat_file, X, labels, export_svmlight=False):
+    """
+    保存合并后的特征矩阵和 label
+    :param feat_file: 例如 "%s/train.feat" % combined_feat_path
+    :param X:
+    :param labels:
+    :param export_svmlight: 同时导出 svmlight 文本格式到 feat_file（libfm 等外部工具使用）
+    :return:
+    """
+    np.save("%s.label.npy" % feat_file, np.asarray(labels, dtype=float))
+    _dump_arrays(feat_file, X, {"label": True})
+    if export_svmlight:
+        dump_svmlight_file(X, labels, feat_file)
+
+
+def load_feat_matrix(feat_file, mmap_mode=None):
+    """
+    读取合并后的特征矩阵和 label，不需要解析文本
+    :param feat_file: 例如 "%s/train.feat" % combined_feat_path
+    :param mmap_mode: np.load 的 mmap_mode，None 表示读入内存
+    :return: X (csr_matrix), labels
+    """
+    if not os.path.exists("%s.json" % feat_file):
+        # 只有 svmlight 文本格式
+        return load_svmlight_file(feat_file)
+    X, meta = _load_arrays(feat_file, mmap_mode)
+    labels = np.load("%s.label.npy" % feat_file, mmap_mode=mmap_mode)
+    if not issparse(X):
+        X = csr_matrix(X)
+    return X, labels
+
+
+def load_manifest(path):
+    """
+    扫描目录下所有特征的 json
+    :param path: Run%d/Fold%d 或者 All 目录
+    :return: key: 特征路径名，例如 "train.query_tfidf_common_vocabulary" val: meta
+    """
+    manifest = dict()
+    for meta_path in glob.glob("%s/*%s" % (path, meta_ext)):
+        name = os.path.basename(meta_path)[:-len(meta_ext)]
+        with open(meta_path, "rb") as f:
+            manifest[name] = json.load(f)
+    return manifest
+
+
+def check_feats(path, feat_names, modes):
+    """
+    合并之前检查：feat_names 的每个特征都已经生成（json 或旧的 cPickle 文件），同一个 mode 的行数相同
+    :param path: Run%d/Fold%d 或者 All 目录
+    :param feat_names: 特征名
+    :param modes: 例如 ["train", "valid"]
+    :return: manifest
+    """
+    manifest = load_manifest(path)
+    for mode in modes:
+        missing = []
+        n_rows = dict()
+        for feat_name in feat_names:
+            name = "%s.%s" % (mode, feat_name)
+            if name in manifest:
+                n_rows[feat_name] = manifest[name]["shape"][0]
+            elif not os.path.exists("%s/%s%s.pkl" % (path, name, feat_ext)):
+                missing.append(name)
+        if len(missing) > 0:
+            raise ValueError("%d features are missing in %s: %s" % (len(missing), path, ", ".join(missing)))
+        if len(set(n_rows.values())) > 1:
+            raise ValueError("%s features in %s have different row counts: %s" % (mode, path, sorted(n_rows.items())))
+    return manifest
@@ -0,0 +1,104 @@
+# coding:utf-8
+"""
+__file__
+
+    fold_scheduler.py
+
+__description__
+
+    This file provides the scheduler that runs the (generator, run, fold) feature tasks
+    and the final "All" task in a process pool.
+
+        1. a task is (func, args), gen_cv_tasks() builds one task for each run/fold,
+           the fold data is sliced inside the worker by gen_fold_feat()
+
+        2. the task list is kept in a module level variable before the pool is created, the workers
+           are forked and only the task index is sent to them, so the dataframes held by the generators
+           are shared copy-on-write instead of being re-pickled for every task
+
+        3. results are returned in the order of the task list, n_jobs <= 1 (or a platform without fork)
+           runs the tasks serially in the current process
+
+__author__
+
+    songquanwang
+
+"""
+
+import os
+import multiprocessing
+
+import competition.conf.feat_params_conf as feat_params_conf
+import competition.conf.model_params_conf as config
+
+# 由 fork 出的子进程继承，不需要序列化
+_shared_tasks = []
+
+
+def _run_task(task_index):
+    func, args = _shared_tasks[task_index]
+    return func(*args)
+
+
+def gen_fold_feat(func, run, fold, dfTrain, trainInd, validInd, *args):
+    """
+    在 worker 中切分 run/fold 数据，然后调用 func(path, dfTrain_train, dfTrain_valid, *args)
+    """
+    print("Run: %d, Fold: %d" % (run + 1, fold + 1))
+    path = "%s/Run%d/Fold%d" % (config.feat_folder, run + 1, fold + 1)
+    # use 33% for training and 67 % for validation, so we switch trainInd and validInd
+    dfTrain_train = dfTrain.iloc[trainInd].copy()
+    dfTrain_valid = dfTrain.iloc[validInd].copy()
+    return func(path, dfTrain_train, dfTrain_valid, *args)
+
+
+def gen_cv_tasks(skf, dfTrain, func, *args):
+    """
+    为每个 run/fold 生成一个 task
+    :param skf: stratifiedKFold 索引
+    :param dfTrain:
+    :param func: func(path, dfTrain_train, dfTrain_valid, *args)
+    :param args: 其他参数，例如 "valid", feat_names
+    :return: [(func, args)]
+    """
+    tasks = []
+    for run in range(config.n_runs):
+        for fold, (validInd, trainInd) in enumerate(skf[run]):
+            tasks.append((gen_fold_feat, (func, run, fold, dfTrain, trainInd, validInd) + args))
+    return tasks
+
+
+def get_n_jobs(n_jobs=None):
+    """
+    worker 个数：默认使用 feat_params_conf.fold_n_jobs，<=0 表示使用全部 cpu
+    """
+    if n_jobs is None:
+        n_jobs = feat_params_conf.fold_n_jobs
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+    return n_jobs
+
+
+def run_tasks(tasks, n_jobs=None):
+    """
+    运行 tasks，返回每个 task 的结果，顺序与 tasks 相同
+    :param tasks: [(func, args)]
+    :param n_jobs: worker 个数，None 表示使用 feat_params_conf.fold_n_jobs
+    :return: [result]
+    """
+    global _shared_tasks
+    n_jobs = min(get_n_jobs(n_jobs), len(tasks))
+    if n_jobs <= 1 or not hasattr(os, "fork"):
+        return [func(*args) for func, args in tasks]
+
+    _shared_tasks = list(tasks)
+    # 先设置 _shared_tasks 再创建进程池，子进程 fork 时继承
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        # chunksize=1：每个 fold 的耗时差不多，按顺序逐个分配
+        results = pool.map(_run_task, range(len(tasks)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_tasks = []
+    return results
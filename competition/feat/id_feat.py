@@ -24,6 +24,8 @@ import competition.conf.model_params_conf as config
 
 import abc
 from  competition.feat.base_feat import BaseFeat
+from competition.feat import fold_scheduler
+from competition.feat import feat_store
 
 
 class IdFeat(BaseFeat):
@@ -37,10 +39,8 @@ class IdFeat(BaseFeat):
             X_train = lb.fit_transform(dfTrain.iloc[trainInd][id_name])
             # 如果validInt 和trainInt没有相同 则transform() X_train没有的classes_会是零向量
             X_valid = lb.transform(dfTrain.iloc[validInd][id_name])
-            with open("%s/train.%s.feat.pkl" % (path, id_name), "wb") as f:
-                cPickle.dump(X_train, f, -1)
-            with open("%s/valid.%s.feat.pkl" % (path, id_name), "wb") as f:
-                cPickle.dump(X_valid, f, -1)
+            feat_store.dump_feat("%s/train.%s" % (path, id_name), X_train)
+            feat_store.dump_feat("%s/valid.%s" % (path, id_name), X_valid)
 
     @staticmethod
     def gen_id_feat_all(id_names, dfTrain, dfTest, lb):
@@ -49,12 +49,9 @@ class IdFeat(BaseFeat):
         for id_name in id_names:
             X_train = lb.fit_transform(dfTrain[id_name])
             X_test = lb.transform(dfTest[id_name])
-            with open("%s/train.%s.feat.pkl" % (path, id_name), "wb") as f:
-                cPickle.dump(X_train, f, -1)
-            with open("%s/test.%s.feat.pkl" % (path, id_name), "wb") as f:
-                cPickle.dump(X_test, f, -1)
+            feat_store.dump_feat("%s/train.%s" % (path, id_name), X_train)
+            feat_store.dump_feat("%s/test.%s" % (path, id_name), X_test)
 
-    @staticmethod
     def gen_id_feat(self):
         """
         入口函数
@@ -74,18 +71,15 @@ class IdFeat(BaseFeat):
         print("==================================================")
         print("Generate id features...")
 
-        print("For cross-validation...")
+        print("For cross-validation, training and testing...")
+        tasks = []
         for run in range(config.n_runs):
             ## use 33% for training and 67 % for validation so we switch trainInd and validInd
             for fold, (validInd, trainInd) in enumerate(skf[run]):
-                print("Run: %d, Fold: %d" % (run + 1, fold + 1))
-                # 生成 run fold
-                self.gen_id_feat_run_fold(id_names, run, fold, dfTrain, trainInd, validInd, lb)
-
-        print("Done.")
-
-        print("For training and testing...")
-        self.gen_id_feat_all(id_names, dfTrain, dfTest, lb)
+                # 生成 run fold，每个 worker 使用自己的 lb 副本
+                tasks.append((self.gen_id_feat_run_fold, (id_names, run, fold, dfTrain, trainInd, validInd, lb)))
+        tasks.append((self.gen_id_feat_all, (id_names, dfTrain, dfTest, lb)))
+        fold_scheduler.run_tasks(tasks)
         print("Done.")
 
         print("All Done.")
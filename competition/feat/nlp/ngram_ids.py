@@ -0,0 +1,238 @@
+# coding:utf-8
+"""
+__file__
+
+    ngram_ids.py
+
+__description__
+
+    This file provides the integer version of ngram.py.
+
+        1. Vocabulary maps the tokens of a whole column to integer ids (starting from 1, 0 is the padding),
+           a column is stored as a RaggedArray: one int array (data) and the row offsets (indptr)
+
+        2. get_ngram_ids() builds bigram/trigram/fourgram/biterm/triterm (with skip) of a whole column,
+           the result is a RaggedArray whose data is a (n, m) id tuple array, the positions of the
+           n-grams of a row only depend on the row length, they are generated once per length and
+           gathered with numpy; the order and the fallback (e.g. bigram of one word is the unigram)
+           are the same as ngram.py
+
+        3. pack_ngram_ids() packs every id tuple into one int64 (bits per id = vocabulary.bits),
+           tuples of different length never collide because the ids are > 0; to_count_matrix() turns
+           a packed column into a sparse row x n-gram count matrix
+
+__author__
+
+    songquanwang
+
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# key: (kind, L, skip) val: (P, m) 位置数组
+_position_cache = dict()
+
+
+class RaggedArray(object):
+    """
+    不等长的行：第 i 行是 data[indptr[i]:indptr[i + 1]]
+    """
+
+    def __init__(self, data, indptr):
+        self.data = data
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.indptr[i]:self.indptr[i + 1]]
+
+    def get_lengths(self):
+        return np.diff(self.indptr)
+
+    def get_row_index(self):
+        """
+        data 中每个元素所在的行
+        """
+        return np.repeat(np.arange(len(self)), self.get_lengths())
+
+    def take(self, rows):
+        """
+        取出部分行（run/fold 切分）
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.get_lengths()[rows]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        # 每个元素在原 data 中的位置
+        index = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return RaggedArray(self.data[index], indptr)
+
+
+class Vocabulary(object):
+    """
+    token -> id，id 从 1 开始，0 用于补齐
+    """
+
+    def __init__(self):
+        self.token2id = dict()
+        self.tokens = [None]
+
+    def __len__(self):
+        return len(self.tokens) - 1
+
+    @property
+    def bits(self):
+        # 每个 id 需要的位数
+        return max(1, int(len(self.tokens) - 1).bit_length())
+
+    def get_id(self, token):
+        id = self.token2id.get(token)
+        if id is None:
+            id = len(self.tokens)
+            self.token2id[token] = id
+            self.tokens.append(token)
+        return id
+
+    def encode_column(self, rows):
+        """
+        :param rows: 一列 token list，例如 df["query_unigram"]
+        :return: RaggedArray(int32 ids)
+        """
+        get_id = self.get_id
+        lengths = [len(row) for row in rows]
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        data = np.fromiter((get_id(token) for row in rows for token in row), dtype=np.int32, count=indptr[-1])
+        return RaggedArray(data, indptr)
+
+    def decode(self, ids, join_string="_"):
+        """
+        id 或者 id tuple（0 补齐）还原成字符串
+        """
+        ids = np.atleast_1d(ids)
+        return join_string.join(self.tokens[i] for i in ids if i > 0)
+
+
+def _get_positions(kind, L, skip=0):
+    """
+    长度为 L 的一行的 n-gram 由哪些位置组成，顺序和退化规则与 ngram.py 相同
+    :return: list of tuple
+    """
+    if kind == "unigram":
+        return [(i,) for i in range(L)]
+    if kind == "bigram":
+        if L <= 1:
+            return _get_positions("unigram", L)
+        return [(i, i + k) for i in range(L - 1) for k in range(1, skip + 2) if i + k < L]
+    if kind == "trigram":
+        if L <= 2:
+            return _get_positions("bigram", L, skip)
+        return [(i, i + k1, i + k1 + k2) for i in range(L - 2) for k1 in range(1, skip + 2) for k2 in range(1, skip + 2)
+                if i + k1 < L and i + k1 + k2 < L]
+    if kind == "fourgram":
+        if L <= 3:
+            return _get_positions("trigram", L)
+        return [(i, i + 1, i + 2, i + 3) for i in range(L - 3)]
+    if kind == "biterm":
+        if L <= 1:
+            return _get_positions("unigram", L)
+        return [(i, j) for i in range(L - 1) for j in range(i + 1, L)]
+    if kind == "triterm":
+        if L <= 2:
+            return _get_positions("biterm", L)
+        return [(i, j, k) for i in range(L - 2) for j in range(i + 1, L - 1) for k in range(j + 1, L)]
+    raise ValueError("unknown n-gram kind: %s" % kind)
+
+
+def get_positions(kind, L, skip=0):
+    """
+    缓存的位置数组 (P, m)，不足 m 个位置的 n-gram（退化）用 -1 补齐
+    """
+    key = (kind, L, skip)
+    if key not in _position_cache:
+        positions = _get_positions(kind, L, skip)
+        m = max([len(p) for p in positions] or [1])
+        array = -np.ones((len(positions), m), dtype=np.int64)
+        for i, p in enumerate(positions):
+            array[i, :len(p)] = p
+        _position_cache[key] = array
+    return _position_cache[key]
+
+
+ngram_orders = {"unigram": 1, "bigram": 2, "trigram": 3, "fourgram": 4, "biterm": 2, "triterm": 3}
+
+
+def get_ngram_ids(column, kind, skip=0):
+    """
+    一列的 n-gram
+    :param column: RaggedArray(ids)，Vocabulary.encode_column 的结果
+    :param kind: unigram/bigram/trigram/fourgram/biterm/triterm
+    :param skip: bigram/trigram 的 skip
+    :return: RaggedArray，data 是 (n, m) 的 id tuple，退化的 n-gram 用 0 补齐
+    """
+    m = ngram_orders[kind]
+    lengths = column.get_lengths()
+    # 每一行的 n-gram 个数
+    counts = np.zeros(len(lengths), dtype=np.int64)
+    distinct_lengths = np.unique(lengths)
+    for L in distinct_lengths:
+        counts[lengths == L] = len(get_positions(kind, L, skip))
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    # 多补一个 0，位置 -1 取到 0
+    ids = np.append(column.data, 0).astype(column.data.dtype)
+    data = np.zeros((indptr[-1], m), dtype=column.data.dtype)
+    for L in distinct_lengths:
+        positions = get_positions(kind, L, skip)
+        P, width = positions.shape
+        if P == 0:
+            continue
+        rows = np.where(lengths == L)[0]
+        # (rows, P, width) 在 data 中的位置，-1 指向最后补的 0
+        index = column.indptr[rows][:, np.newaxis, np.newaxis] + positions[np.newaxis, :, :]
+        index = np.where(positions[np.newaxis, :, :] < 0, len(ids) - 1, index)
+        out = indptr[rows][:, np.newaxis] + np.arange(P)[np.newaxis, :]
+        data[out.ravel(), :width] = ids[index].reshape((-1, width))
+    return RaggedArray(data, indptr)
+
+
+def pack_ngram_ids(ngrams, bits):
+    """
+    id tuple 压缩成一个 int64：(a, b, c) -> a << 2 * bits | b << bits | c，补齐的 0 跳过
+    :param ngrams: get_ngram_ids 的结果
+    :param bits: Vocabulary.bits
+    :return: RaggedArray(int64)
+    """
+    m = ngrams.data.shape[1]
+    if bits * m > 63:
+        raise ValueError("%d ids of %d bits can not be packed into int64, use the id tuples" % (m, bits))
+    packed = np.zeros(ngrams.data.shape[0], dtype=np.int64)
+    for c in range(m):
+        id = ngrams.data[:, c].astype(np.int64)
+        # 补齐的 0 不移位
+        packed = np.where(id > 0, (packed << bits) | id, packed)
+    return RaggedArray(packed, ngrams.indptr)
+
+
+def to_count_matrix(packed, keys=None):
+    """
+    行 x n-gram 的计数矩阵
+    :param packed: RaggedArray(int64)
+    :param keys: 列对应的 n-gram（排序后的 int64），None 表示使用 packed 中出现的所有 n-gram
+    :return: csr_matrix, keys
+    """
+    rows = packed.get_row_index()
+    if keys is None:
+        keys, columns = np.unique(packed.data, return_inverse=True)
+    else:
+        # 不在 keys 中的 n-gram 忽略
+        columns = np.searchsorted(keys, packed.data)
+        found = columns < len(keys)
+        found[found] = keys[columns[found]] == packed.data[found]
+        rows, columns = rows[found], columns[found]
+    X = csr_matrix((np.ones(len(columns), dtype=np.int64), (rows, columns)), shape=(len(packed), len(keys)))
+    X.sum_duplicates()
+    return X, keys
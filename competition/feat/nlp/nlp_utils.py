@@ -14,8 +14,10 @@ __author__
 
 """
 
+import os
 import re
 import sys
+import cPickle
 
 from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 
@@ -26,6 +28,7 @@ from competition.feat.nlp.replacer import CsvWordReplacer
 
 sys.path.append("../")
 from code_new.param_config import config
+import competition.conf.model_params_conf as model_param_conf
 
 ################
 ## Stop Words ##
@@ -37,17 +40,83 @@ stopwords = set(stopwords)
 ##############
 ## Stemming ##
 ##############
-if config.stemmer_type == "porter":
+# 实际使用的 stemmer 和 stopword 配置（param_config），token_cache 等缓存的 key 以此为准
+stemmer_type = config.stemmer_type
+cooccurrence_word_exclude_stopword = config.cooccurrence_word_exclude_stopword
+if stemmer_type == "porter":
     english_stemmer = nltk.stem.PorterStemmer()
-elif config.stemmer_type == "snowball":
+elif stemmer_type == "snowball":
     english_stemmer = nltk.stem.SnowballStemmer('english')
 
 
+class CachedStemmer(object):
+    """
+    token -> stem 缓存，所有 analyzer 和 stem_tokens 共用；词表很小而 token 出现次数很多
+    缓存达到 max_size 后不再增加新的词
+    """
+
+    def __init__(self, stemmer, max_size):
+        self.stemmer = stemmer
+        self.max_size = max_size
+        self.cache = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, token):
+        try:
+            stem = self.cache[token]
+            self.hits += 1
+            return stem
+        except KeyError:
+            self.misses += 1
+            stem = self.stemmer.stem(token)
+            if len(self.cache) < self.max_size:
+                self.cache[token] = stem
+            return stem
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.cache),
+                "hit_rate": self.hits / float(total) if total > 0 else 0.}
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            cache = cPickle.load(f)
+        for token, stem in cache.iteritems():
+            if len(self.cache) >= self.max_size:
+                break
+            self.cache[token] = stem
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # 先写临时文件再改名
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            cPickle.dump(self.cache, f, -1)
+        os.rename(tmp_path, path)
+
+
+english_stemmer = CachedStemmer(english_stemmer, model_param_conf.stemmer_cache_size)
+# 以实际使用的 stemmer 命名，porter 的缓存不会被 snowball 读取
+stemmer_cache_path = "%s/stemmer.%s.pkl" % (model_param_conf.stemmer_cache_folder, stemmer_type)
+if model_param_conf.stemmer_cache_persist and os.path.exists(stemmer_cache_path):
+    english_stemmer.load(stemmer_cache_path)
+
+
+def save_stemmer_cache():
+    """
+    保存 stemmer 缓存（stemmer_cache_persist 为 True 时），打印命中率
+    """
+    print("Stemmer cache: %s" % english_stemmer.get_stats())
+    if model_param_conf.stemmer_cache_persist:
+        english_stemmer.save(stemmer_cache_path)
+
+
 def stem_tokens(tokens, stemmer):
-    stemmed = []
-    for token in tokens:
-        stemmed.append(stemmer.stem(token))
-    return stemmed
+    stem = stemmer.stem
+    return [stem(token) for token in tokens]
 
 
 #############
@@ -86,7 +155,8 @@ def pos_tag_text(line,
 class StemmedTfidfVectorizer(TfidfVectorizer):
     def build_analyzer(self):
         analyzer = super(TfidfVectorizer, self).build_analyzer()
-        return lambda doc: (english_stemmer.stem(w) for w in analyzer(doc))
+        stem = english_stemmer.stem
+        return lambda doc: (stem(w) for w in analyzer(doc))
 
 
 token_pattern = r"(?u)\b\w\w+\b"
@@ -118,7 +188,8 @@ def getTFV(token_pattern=token_pattern,
 class StemmedCountVectorizer(CountVectorizer):
     def build_analyzer(self):
         analyzer = super(CountVectorizer, self).build_analyzer()
-        return lambda doc: (english_stemmer.stem(w) for w in analyzer(doc))
+        stem = english_stemmer.stem
+        return lambda doc: (stem(w) for w in analyzer(doc))
 
 
 token_pattern = r"(?u)\b\w\w+\b"
@@ -190,31 +261,97 @@ replace_dict = {
 }
 
 
-def clean_text(line, drop_html_flag=False):
-    names = ["query", "product_title", "product_description"]
-    for name in names:
-        l = line[name]
+def get_replace_rules():
+    """
+    clean_text 的替换规则 [(pattern, replacement)]
+    """
+    rules = []
+    ## replace gb
+    for vol in [16, 32, 64, 128, 500]:
+        rules.append(("%d gb" % vol, "%dgb" % vol))
+        rules.append(("%d g" % vol, "%dgb" % vol))
+        rules.append(("%dg " % vol, "%dgb " % vol))
+    ## replace tb
+    for vol in [2]:
+        rules.append(("%d tb" % vol, "%dtb" % vol))
+    ## replace other words
+    rules.extend(replace_dict.items())
+    return rules
+
+
+def get_rule_literal(pattern):
+    """
+    规则匹配的字符串：pattern 中只有分组时，re.sub 与 str.replace 的结果相同；有其他正则符号时返回 None
+    """
+    literal = pattern.replace("(", "").replace(")", "")
+    if any(c in literal for c in ".^$*+?{}[]\\|"):
+        return None
+    return literal
+
+
+class TextCleaner(object):
+    """
+    预编译的文本清洗：
+        1. 替换规则按照 clean_text 原来的顺序依次执行（前面规则的结果会被后面的规则继续替换），
+           只包含字符串的规则使用 str.replace，其他规则预编译
+        2. 按列处理：一列（或者一个 chunk）的文本用 sep 拼接成一个字符串，每个规则对整列只执行一次 sub，
+           规则不会跨过 sep 匹配；同义词替换对整列 split 一次（" sep " 是单独的一个词），结果与逐行处理相同
+    """
+    sep = "\x01"
+    word_sep = " \x01 "
+
+    def __init__(self, rules, replacer):
+        self.rules = []
+        for k, v in rules:
+            literal = get_rule_literal(k)
+            if literal is None or "\\" in v:
+                self.rules.append((re.compile(k), v, None))
+            else:
+                self.rules.append((None, v, literal))
+        self.replacer = replacer
+
+    def replace(self, l):
+        for pattern, v, literal in self.rules:
+            if literal is None:
+                l = pattern.sub(v, l)
+            else:
+                l = l.replace(literal, v)
+        return l
+
+    def replace_synonym(self, l):
+        return " ".join(self.replacer.replace(l.split(" ")))
+
+    def clean(self, l, drop_html_flag=False):
         if drop_html_flag:
             l = drop_html(l)
-        l = l.lower()
-        ## replace gb
-        for vol in [16, 32, 64, 128, 500]:
-            l = re.sub("%d gb" % vol, "%dgb" % vol, l)
-            l = re.sub("%d g" % vol, "%dgb" % vol, l)
-            l = re.sub("%dg " % vol, "%dgb " % vol, l)
-        ## replace tb
-        for vol in [2]:
-            l = re.sub("%d tb" % vol, "%dtb" % vol, l)
-
-        ## replace other words
-        for k, v in replace_dict.items():
-            l = re.sub(k, v, l)
-        l = l.split(" ")
-
+        return self.replace_synonym(self.replace(l.lower()))
+
+    def clean_column(self, values, drop_html_flag=False):
+        """
+        按列清洗
+        :param values: 一列文本
+        :return: list
+        """
+        if drop_html_flag:
+            values = [drop_html(l) for l in values]
+        values = [l.lower() for l in values]
+        if len(values) == 0:
+            return []
+        if any(self.sep in l for l in values):
+            return [self.replace_synonym(self.replace(l)) for l in values]
+        values = self.replace(self.sep.join(values)).split(self.sep)
         ## replace synonyms
-        l = replacer.replace(l)
-        l = " ".join(l)
-        line[name] = l
+        return self.replace_synonym(self.word_sep.join(values)).split(self.word_sep)
+
+
+text_cleaner = TextCleaner(get_replace_rules(), replacer)
+# clean_text 处理的列
+clean_text_names = ["query", "product_title", "product_description"]
+
+
+def clean_text(line, drop_html_flag=False):
+    for name in clean_text_names:
+        line[name] = text_cleaner.clean(line[name], drop_html_flag)
     return line
 
 
@@ -0,0 +1,211 @@
+# coding:utf-8
+"""
+__file__
+
+    stats_engine.py
+
+__description__
+
+    This file provides a vectorized engine for the distance/similarity stats features
+    used by BasicTfidfFeat and DistanceFeat.
+
+        1. the pooled sample indices of each group, grouped by
+            - median_relevance (#4)
+            - query (qid) & median_relevance (#4)
+           are converted to index arrays only once
+
+        2. all the rows sharing one pool are reduced at once with sorted numpy operations,
+           the sample itself is excluded from the pool by id with a boolean mask
+
+        3. the stats are mean, std and the quantiles in quantiles_range (min/median/max by default),
+           i.e., the same layout as stats_func = [np.mean, np.std] followed by pd.Series.quantile
+
+        4. row_cosine_sim() computes the cosine similarity of the aligned rows of two matrices
+           (csr or dense) in one pass: elementwise product, row sum and norm division
+
+__author__
+
+    songquanwang
+
+"""
+
+import numpy as np
+from scipy.sparse import issparse, csr_matrix
+
+
+def row_sum_of_product(X, Y):
+    """
+    每一行 X[i] . Y[i]
+    """
+    if issparse(X) or issparse(Y):
+        return np.asarray(csr_matrix(X).multiply(csr_matrix(Y)).sum(axis=1)).ravel()
+    return np.einsum("ij,ij->i", np.asarray(X), np.asarray(Y))
+
+
+def row_cosine_sim(X, Y):
+    """
+    X 和 Y 对应行的余弦相似度，范数为 0 的行相似度为 0（与 cosine_similarity 相同）
+    :param X: (n, d) csr 或 dense
+    :param Y: (n, d) csr 或 dense
+    :return: (n,) 相似度
+    """
+    if X.shape != Y.shape:
+        raise ValueError("row cosine similarity of matrices with different shapes %s and %s" % (X.shape, Y.shape))
+    dot = row_sum_of_product(X, Y)
+    norm = np.sqrt(row_sum_of_product(X, X)) * np.sqrt(row_sum_of_product(Y, Y))
+    sim = np.zeros(X.shape[0], dtype=float)
+    nonzero = norm > 0
+    sim[nonzero] = dot[nonzero] / norm[nonzero]
+    return sim
+
+
+def gen_group_indices(indices_dict):
+    """
+    把 get_sample_indices_by_relevance 返回的 list 转成 int 数组，每个分组只转换一次
+    :param indices_dict: key: median_relevance or (qid, median_relevance) val: list of sample indices
+    :return: key: same as indices_dict val: array of sample indices
+    """
+    group_indices = dict()
+    for key, inds in indices_dict.items():
+        group_indices[key] = np.asarray(inds, dtype=int)
+    return group_indices
+
+
+def gen_row_groups(n_rows, n_classes, group_indices, qids=None):
+    """
+    按照 pool 把行分组，同一个 pool 的行一起计算
+    :param n_rows: 行数
+    :param n_classes: 类别个数
+    :param group_indices: gen_group_indices 的返回值
+    :param qids: 每一行的 qid；None 表示按 median_relevance 分组
+    :return: [(类别序号 j, 行号数组 rows, pool 序号数组 inds)]
+    """
+    groups = []
+    if qids is None:
+        rows = np.arange(n_rows)
+        for j in range(n_classes):
+            key = j + 1
+            if key in group_indices:
+                groups.append((j, rows, group_indices[key]))
+    else:
+        qids = np.asarray(qids)
+        uniq_qids, inverse = np.unique(qids, return_inverse=True)
+        # 同一个 qid 的行排在一起
+        order = np.argsort(inverse, kind="mergesort")
+        bounds = np.searchsorted(inverse[order], np.arange(len(uniq_qids) + 1))
+        for q, qid in enumerate(uniq_qids):
+            rows = order[bounds[q]:bounds[q + 1]]
+            for j in range(n_classes):
+                key = (qid, j + 1)
+                if key in group_indices:
+                    groups.append((j, rows, group_indices[key]))
+    return groups
+
+
+def reduce_group_stats(dist, excluded, quantiles_range):
+    """
+    对每一行未被排除的距离计算 mean std 和分位数（线性插值，与 pd.Series.quantile 相同）
+    :param dist: (n_rows, n_pool) 距离/相似度
+    :param excluded: (n_rows, n_pool) bool，True 表示该样本是本行自身，需要排除
+    :param quantiles_range: 分位数
+    :return: feat (n_rows, 2 + len(quantiles_range)), valid (n_rows,) 有效值个数是否大于0
+    """
+    n_rows, n_pool = dist.shape
+    n_valid = n_pool - excluded.sum(axis=1)
+    valid = n_valid > 0
+    denom = np.maximum(n_valid, 1).astype(float)
+    feat = np.zeros((n_rows, 2 + len(quantiles_range)), dtype=float)
+    if n_rows == 0 or n_pool == 0:
+        return feat, valid
+
+    ## mean/std
+    masked = np.where(excluded, 0., dist)
+    mean = masked.sum(axis=1) / denom
+    dev = np.where(excluded, 0., dist - mean[:, np.newaxis])
+    std = np.sqrt((dev ** 2).sum(axis=1) / denom)
+    feat[:, 0] = mean
+    feat[:, 1] = std
+
+    ## quantile: 排除的样本置为 inf，排序后排在每行最后
+    sorted_dist = np.where(excluded, np.inf, dist)
+    sorted_dist.sort(axis=1)
+    row_index = np.arange(n_rows)
+    last = np.maximum(n_valid - 1, 0)
+    for k, q in enumerate(quantiles_range):
+        pos = q * last
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        lo_val = sorted_dist[row_index, lo]
+        hi_val = sorted_dist[row_index, hi]
+        quantile = lo_val + (hi_val - lo_val) * (pos - lo)
+        # lo == hi 时避免 inf - inf
+        quantile = np.where(lo == hi, lo_val, quantile)
+        feat[:, 2 + k] = quantile
+    return feat, valid
+
+
+def gen_dist_stats_feat(dist, ids_train, ids_test, indices_dict, n_classes, quantiles_range, qids_test=None, default=0.):
+    """
+    根据 test*train 的距离矩阵生成 stats 特征
+    :param dist: (len(ids_test), len(ids_train)) 距离/相似度矩阵
+    :param ids_train:
+    :param ids_test:
+    :param indices_dict: 类别（或 qid+类别）键值字典，可以是 gen_group_indices 的返回值
+    :param n_classes:
+    :param quantiles_range:
+    :param qids_test: 类别+qid 时每一行的 qid
+    :param default: 没有 pool 样本时的默认值
+    :return: len(ids_test) 行 stats_feat_num*n_classes 列的矩阵
+    """
+    stats_feat_num = 2 + len(quantiles_range)
+    ids_train = np.asarray(ids_train)
+    ids_test = np.asarray(ids_test)
+    stats_feat = default * np.ones((len(ids_test), stats_feat_num * n_classes), dtype=float)
+    for j, rows, inds in gen_row_groups(len(ids_test), n_classes, indices_dict, qids_test):
+        if len(inds) == 0:
+            continue
+        dist_tmp = dist[np.ix_(rows, inds)]
+        # exclude this sample itself from the pool
+        excluded = ids_test[rows][:, np.newaxis] == ids_train[inds][np.newaxis, :]
+        feat, valid = reduce_group_stats(dist_tmp, excluded, quantiles_range)
+        stats_feat[rows[valid], j * stats_feat_num:(j + 1) * stats_feat_num] = feat[valid]
+    return stats_feat
+
+
+def gen_blocked_dist_stats_feat(dist_func, X_train, ids_train, X_test, ids_test, indices_dict, n_classes, quantiles_range, qids_test=None, default=0.,
+                                block_size=1000):
+    """
+    streaming 版本：不生成完整的 test*train 距离矩阵
+    每个分组的行按 block_size 分块，每块只和该分组 pool 中的 train 行计算距离，然后马上归约成 stats
+    峰值内存是 block_size * pool 大小，而不是 len(ids_test) * len(ids_train)
+    :param dist_func: dist_func(X_test_block, X_train_pool) 返回 (block 行数, pool 大小) 的距离/相似度矩阵
+    :param X_train:
+    :param ids_train:
+    :param X_test:
+    :param ids_test:
+    :param indices_dict: 类别（或 qid+类别）键值字典，可以是 gen_group_indices 的返回值
+    :param n_classes:
+    :param quantiles_range:
+    :param qids_test: 类别+qid 时每一行的 qid
+    :param default: 没有 pool 样本时的默认值
+    :param block_size: 每块的行数
+    :return: len(ids_test) 行 stats_feat_num*n_classes 列的矩阵
+    """
+    stats_feat_num = 2 + len(quantiles_range)
+    ids_train = np.asarray(ids_train)
+    ids_test = np.asarray(ids_test)
+    stats_feat = default * np.ones((len(ids_test), stats_feat_num * n_classes), dtype=float)
+    for j, rows, inds in gen_row_groups(len(ids_test), n_classes, indices_dict, qids_test):
+        if len(inds) == 0:
+            continue
+        # pool 只取一次
+        X_pool = X_train[inds]
+        ids_pool = ids_train[inds]
+        for start in range(0, len(rows), block_size):
+            rows_block = rows[start:start + block_size]
+            dist_block = np.asarray(dist_func(X_test[rows_block], X_pool), dtype=float)
+            # exclude this sample itself from the pool
+            excluded = ids_test[rows_block][:, np.newaxis] == ids_pool[np.newaxis, :]
+            feat, valid = reduce_group_stats(dist_block, excluded, quantiles_range)
+            stats_feat[rows_block[valid], j * stats_feat_num:(j + 1) * stats_feat_num] = feat[valid]
+    return stats_feat
@@ -0,0 +1,186 @@
+# coding:utf-8
+"""
+__file__
+
+    svd_service.py
+
+__description__
+
+    This file provides the SVD service used by the bow/tfidf svd features.
+
+        1. every matrix is factorized only once at the largest rank (max(svd_n_components)), the
+           components are sorted by singular value, the smaller ranks are the first n rows, so
+           svd100 and svd150 share one factorization
+
+        2. randomized solver: Gaussian range finder with svd_n_oversamples extra columns and
+           svd_n_iter QR-normalized power iterations, then an exact SVD of the small projected matrix
+
+        3. the components/singular values are cached in memory and in svd_cache_folder, the key is the
+           md5 of the input matrix (CSR triplet + shape) and the solver parameters
+
+        4. warm start: the All factorization of a matrix (e.g. tfidf common) is registered by
+           add_warm_start() before the run/fold tasks are forked, the run/fold factorization of the same
+           matrix starts its range finder from the All components (aligned by the global vocabulary columns)
+           and uses svd_warm_start_n_iter power iterations instead of svd_n_iter
+
+__author__
+
+    songquanwang
+
+"""
+
+import os
+import hashlib
+
+import numpy as np
+from scipy import linalg
+from scipy.sparse import issparse, csr_matrix
+
+import competition.conf.model_params_conf as config
+
+
+def get_fingerprint(X):
+    """
+    矩阵内容的 md5
+    """
+    md5 = hashlib.md5()
+    if issparse(X):
+        X = csr_matrix(X)
+        if not X.has_sorted_indices:
+            # load_feat 的 mmap 数组只读，排序在副本上进行
+            X = X.sorted_indices()
+        # 下标统一为 int64，vstack/load_feat 的 int32/int64 不影响结果
+        for a in [X.data, X.indices.astype(np.int64), X.indptr.astype(np.int64)]:
+            md5.update(np.ascontiguousarray(a).tostring())
+    else:
+        md5.update(np.ascontiguousarray(X).tostring())
+    md5.update("%s;%s" % (X.shape, X.dtype))
+    return md5.hexdigest()
+
+
+def randomized_svd(X, n_components, n_oversamples, n_iter, random_state, init=None):
+    """
+    X 的前 n_components 个奇异值和右奇异向量
+    :param X: (n, d) 稀疏或稠密矩阵
+    :param init: (k0, d) 初始子空间（warm start），替换前 k0 个随机列
+    :return: components (n_components, d), singular_values (n_components,)
+    """
+    n_random = min(n_components + n_oversamples, min(X.shape))
+    rng = np.random.RandomState(random_state)
+    Q = rng.normal(size=(X.shape[1], n_random))
+    if init is not None:
+        k0 = min(init.shape[0], n_random)
+        Q[:, :k0] = init[:k0].T
+    Q = np.asarray(X.dot(Q))
+    for i in range(n_iter):
+        Q = linalg.qr(Q, mode="economic")[0]
+        Q = np.asarray(X.dot(np.asarray(X.T.dot(Q))))
+    Q = linalg.qr(Q, mode="economic")[0]
+    # B = Q.T X (n_random, d)
+    B = np.asarray(X.T.dot(Q)).T
+    _, s, Vt = linalg.svd(B, full_matrices=False)
+    Vt, s = Vt[:n_components], s[:n_components]
+    # 每个成分绝对值最大的元素为正，结果与随机数无关
+    signs = np.sign(Vt[np.arange(Vt.shape[0]), np.argmax(np.abs(Vt), axis=1)])
+    signs[signs == 0] = 1.
+    return Vt * signs[:, np.newaxis], s
+
+
+class SVDService(object):
+    def __init__(self, max_n_components, n_iter=None, n_oversamples=None, warm_start_n_iter=None, random_state=None, cache_folder=None):
+        """
+        :param max_n_components: 分解的秩，所有 n_components <= max_n_components
+        :param n_iter: 默认 config.svd_n_iter
+        :param n_oversamples: 默认 config.svd_n_oversamples
+        :param warm_start_n_iter: 默认 config.svd_warm_start_n_iter
+        :param random_state: 默认 config.svd_random_state
+        :param cache_folder: None 表示使用 config（svd_cache_persist 为 False 时不持久化）
+        """
+        self.max_n_components = max_n_components
+        self.n_iter = config.svd_n_iter if n_iter is None else n_iter
+        self.n_oversamples = config.svd_n_oversamples if n_oversamples is None else n_oversamples
+        self.warm_start_n_iter = config.svd_warm_start_n_iter if warm_start_n_iter is None else warm_start_n_iter
+        self.random_state = config.svd_random_state if random_state is None else random_state
+        if cache_folder is None and config.svd_cache_persist:
+            cache_folder = config.svd_cache_folder
+        self.cache_folder = cache_folder
+        # key: get_key() val: (components, singular_values)
+        self.results = dict()
+        # key: warm start 名字 val: (columns, components, All 矩阵的 fingerprint)
+        self.warm_starts = dict()
+
+    def get_init(self, name, columns):
+        """
+        All 的 components 按照 columns（全局 vocabulary 的列）对齐到当前矩阵，All 中没有的词为 0
+        """
+        if name not in self.warm_starts or columns is None:
+            return None
+        all_columns, components, _ = self.warm_starts[name]
+        columns = np.asarray(columns)
+        index = np.searchsorted(all_columns, columns)
+        index[index == len(all_columns)] = 0
+        found = all_columns[index] == columns
+        init = np.zeros((components.shape[0], len(columns)), dtype=components.dtype)
+        init[:, found] = components[:, index[found]]
+        return init
+
+    def get_key(self, fingerprint, init, n_iter):
+        md5 = hashlib.md5(fingerprint)
+        md5.update("%d;%d;%d;%d" % (self.max_n_components, self.n_oversamples, n_iter, self.random_state))
+        if init is not None:
+            md5.update(get_fingerprint(init))
+        return md5.hexdigest()
+
+    def get_cache_path(self, key):
+        return "%s/%s.npz" % (self.cache_folder, key)
+
+    def fit(self, X, name=None, columns=None):
+        """
+        分解 X（秩 max_n_components），有 name 的 warm start 时从 All 的 components 开始
+        :param X:
+        :param name: warm start 名字，例如 "tfidf_common"
+        :param columns: X 的列在全局 vocabulary 中的位置（升序）
+        :return: components (max_n_components, d), singular_values
+        """
+        fingerprint = get_fingerprint(X)
+        init = None
+        # All 的矩阵本身不使用 warm start
+        if name in self.warm_starts and self.warm_starts[name][2] != fingerprint:
+            init = self.get_init(name, columns)
+        n_iter = self.n_iter if init is None else self.warm_start_n_iter
+        key = self.get_key(fingerprint, init, n_iter)
+        if key in self.results:
+            return self.results[key]
+        if self.cache_folder is not None and os.path.exists(self.get_cache_path(key)):
+            cached = np.load(self.get_cache_path(key))
+            self.results[key] = (cached["components"], cached["singular_values"])
+            return self.results[key]
+        components, singular_values = randomized_svd(X, self.max_n_components, self.n_oversamples, n_iter, self.random_state, init)
+        self.results[key] = (components, singular_values)
+        if self.cache_folder is not None:
+            if not os.path.exists(self.cache_folder):
+                try:
+                    os.makedirs(self.cache_folder)
+                except OSError:
+                    # 其他 fold worker 已经创建
+                    pass
+            # 先写临时文件再改名，其他 worker 不会读到一半的文件
+            tmp_path = "%s.%d.npz" % (self.get_cache_path(key)[:-4], os.getpid())
+            np.savez(tmp_path, components=components, singular_values=singular_values)
+            os.rename(tmp_path, self.get_cache_path(key))
+        return self.results[key]
+
+    def add_warm_start(self, name, X, columns):
+        """
+        分解 All 的矩阵并登记为 name 的 warm start（在 fork fold worker 之前调用）
+        """
+        components = self.fit(X)[0]
+        self.warm_starts[name] = (np.asarray(columns), components, get_fingerprint(X))
+
+    def transform(self, X, components, n_components):
+        """
+        X 投影到前 n_components 个成分，与 TruncatedSVD.transform 相同
+        """
+        if n_components > components.shape[0]:
+            raise ValueError("n_components=%d is larger than the fitted rank %d" % (n_components, components.shape[0]))
+        return np.asarray(X.dot(components[:n_components].T))
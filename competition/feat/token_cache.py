@@ -0,0 +1,131 @@
+# coding:utf-8
+"""
+__file__
+
+    token_cache.py
+
+__description__
+
+    This file provides the shared tokenization stage for all the feature generators.
+
+        1. unigram/bigram/trigram of query/title/description are generated only once after preprocess()
+
+        2. the n-gram columns are persisted to a content-addressed cache, the key is the md5 of
+            - the processed data file (train.processed.csv.pkl/test.processed.csv.pkl)
+            - the tokenizer config (token pattern, stemmer, stopword and join string)
+
+        3. every generator (CountingFeat, DistanceFeat, CooccurenceTfidfFeat) loads the n-gram columns
+           from the cache instead of re-running the NLP pass on the full corpus
+
+__author__
+
+    songquanwang
+
+"""
+
+import os
+import cPickle
+import hashlib
+
+import pandas as pd
+
+import competition.conf.model_params_conf as config
+from competition.feat.nlp import ngram
+from competition.feat.nlp import nlp_utils
+from competition.feat.nlp.nlp_utils import preprocess_data, token_pattern, save_stemmer_cache
+
+# 原始列名 -> n-gram 列名前缀
+column_names = ["query", "product_title", "product_description"]
+feat_names = ["query", "title", "description"]
+grams = ["unigram", "bigram", "trigram"]
+join_str = "_"
+
+
+def get_tokenizer_conf():
+    """
+    影响 n-gram 结果的配置，作为缓存 key 的一部分；stemmer/stopword 取 nlp_utils 实际使用的配置
+    """
+    return [
+        ("token_pattern", token_pattern),
+        ("stemmer_type", nlp_utils.stemmer_type),
+        ("exclude_stopword", nlp_utils.cooccurrence_word_exclude_stopword),
+        ("join_str", join_str),
+        ("grams", ",".join(grams)),
+    ]
+
+
+def get_cache_key(data_path):
+    """
+    根据预处理后数据文件的内容和 tokenizer 配置生成缓存 key
+    :param data_path: config.processed_train_data_path / config.processed_test_data_path
+    :return: md5 hex
+    """
+    md5 = hashlib.md5()
+    with open(data_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    for k, v in get_tokenizer_conf():
+        md5.update("%s=%s;" % (k, v))
+    return md5.hexdigest()
+
+
+def get_cache_path(data_path):
+    return "%s/%s.tokens.pkl" % (config.token_cache_folder, get_cache_key(data_path))
+
+
+def gen_tokens(df):
+    """
+    生成 unigram/bigram/trigram 列，按列处理，不使用 df.apply(axis=1)
+    :param df:
+    :return: 只包含 n-gram 列的 DataFrame，index 与 df 相同
+    """
+    tokens = pd.DataFrame(index=df.index)
+    for column_name, feat_name in zip(column_names, feat_names):
+        print "generate %s n-gram" % feat_name
+        unigram = [preprocess_data(x) for x in df[column_name].values]
+        tokens["%s_unigram" % feat_name] = unigram
+        tokens["%s_bigram" % feat_name] = [ngram.getBigram(x, join_str) for x in unigram]
+        tokens["%s_trigram" % feat_name] = [ngram.getTrigram(x, join_str) for x in unigram]
+    return tokens
+
+
+def load_tokens(data_path, df=None):
+    """
+    从缓存读取 n-gram 列，缓存不存在时生成并保存
+    :param data_path: 预处理后的数据文件，df 为 None 时从这里读取
+    :param df: 已经读取的预处理后数据
+    :return: 只包含 n-gram 列的 DataFrame
+    """
+    cache_path = get_cache_path(data_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return cPickle.load(f)
+    if df is None:
+        with open(data_path, "rb") as f:
+            df = cPickle.load(f)
+    tokens = gen_tokens(df)
+    if not os.path.exists(config.token_cache_folder):
+        os.makedirs(config.token_cache_folder)
+    # 先写临时文件再改名，避免读到写了一半的缓存
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        cPickle.dump(tokens, f, -1)
+    if os.path.exists(cache_path):
+        os.remove(tmp_path)
+    else:
+        os.rename(tmp_path, cache_path)
+    return tokens
+
+
+def gen_token_cache():
+    """
+    preprocess() 之后运行一次，为 train/test 生成 n-gram 缓存
+    """
+    print("==================================================")
+    print("Generate token cache...")
+    for data_path in [config.processed_train_data_path, config.processed_test_data_path]:
+        load_tokens(data_path)
+        print("Tokens are stored in %s" % get_cache_path(data_path))
+    # 特征生成时读取的 stemmer 缓存
+    save_stemmer_cache()
+    print("Done.")
@@ -0,0 +1,234 @@
+# coding:utf-8
+"""
+__file__
+
+    vectorizer_cache.py
+
+__description__
+
+    This file provides the shared bow/tfidf stage of BasicTfidfFeat.
+
+        1. the text columns (query/title/description and all_text) of train + test are tokenized only once:
+           one CountVectorizer without min_df/max_df is fitted on all_text (every n-gram of a column is also
+           an n-gram of all_text), the global doc-term count matrices are kept in memory and shared by the
+           forked fold workers
+
+        2. a run/fold (or All) never re-tokenizes the text:
+            - the document frequency of the training rows is the column sum of the global matrix, when
+              the training rows are the majority it is computed as global df - df of the held-out rows
+            - min_df/max_df pruning on the df gives the same (sorted) vocabulary as vec.fit()
+            - X_train/X_test are column slices of the global count matrices, tfidf is applied by a
+              TfidfTransformer with the parameters of the vectorizer (same result as getTFV().fit_transform())
+
+        3. the fitted vocabulary (terms) and idf are persisted in vectorizer_cache_folder, the key is
+           (md5 of the training ids, md5 of the text and the vectorizer parameters, vec_type, ngram_range,
+           vocabulary_type, column), re-preprocessed text or new min_df/max_df/norm/... never reuse an old entry
+
+__author__
+
+    songquanwang
+
+"""
+
+import os
+import cPickle
+import hashlib
+import numbers
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+
+import competition.conf.model_params_conf as config
+from competition.feat.nlp import nlp_utils
+from competition.feat.nlp.nlp_utils import getBOW
+
+
+def get_rows_hash(ids):
+    """
+    训练行集合的 md5（与行的顺序无关）
+    """
+    return hashlib.md5(np.sort(np.asarray(ids, dtype=np.int64)).tostring()).hexdigest()
+
+
+def get_text_hash(df, column_names):
+    """
+    所有行的 id 和文本的 md5
+    """
+    md5 = hashlib.md5()
+    md5.update(np.asarray(df["id"].values, dtype=np.int64).tostring())
+    for column_name in column_names:
+        for text in df[column_name].values:
+            md5.update(text.encode("utf-8") if isinstance(text, unicode) else str(text))
+            md5.update("\x00")
+    return md5.hexdigest()
+
+
+def get_vectorizer_conf(vec):
+    """
+    影响 vocabulary/idf 的 vectorizer 参数（vocabulary 除外）和 nlp_utils 实际使用的 stemmer
+    """
+    params = vec.get_params()
+    params.pop("vocabulary", None)
+    return "%s;%s;%s" % (type(vec).__name__, sorted((k, repr(v)) for k, v in params.items()), nlp_utils.stemmer_type)
+
+
+def get_doc_count(n_docs, df):
+    """
+    vectorizer 的 min_df/max_df 转换为文档数，与 CountVectorizer.fit 相同
+    """
+    return df if isinstance(df, numbers.Integral) else df * n_docs
+
+
+class VectorizerCache(object):
+    def __init__(self, df, column_names, ngram_range, text_column="all_text", cache_folder=None):
+        """
+        :param df: train + test 的 id 列、column_names 列和 text_column 列
+        :param column_names: ["query", "product_title", "product_description"]
+        :param ngram_range:
+        :param text_column: common vocabulary 使用的合并文本列
+        :param cache_folder: 持久化 vocabulary/idf 的目录，None 表示使用 config
+        """
+        self.ngram_range = ngram_range
+        self.text_column = text_column
+        if cache_folder is None and config.vectorizer_cache_persist:
+            cache_folder = config.vectorizer_cache_folder
+        self.cache_folder = cache_folder
+        print "tokenize %s for the vectorizer cache" % ", ".join([text_column] + list(column_names))
+        vec = getBOW(ngram_range=ngram_range, min_df=1, max_df=1.0)
+        # key: 列名 val: 全部行的 doc-term 计数矩阵（csr）
+        self.count_matrices = {text_column: vec.fit_transform(df[text_column]).tocsr()}
+        for column_name in column_names:
+            self.count_matrices[column_name] = vec.transform(df[column_name]).tocsr()
+        self.term2index = vec.vocabulary_
+        self.terms = np.empty(len(self.term2index), dtype=object)
+        for term, index in self.term2index.iteritems():
+            self.terms[index] = term
+        self.id_index = pd.Index(df["id"].values)
+        # 文本变化（重新 preprocess）后持久化的 vocabulary/idf 失效
+        self.text_hash = get_text_hash(df, [text_column] + list(column_names))
+        # 全部行的 document frequency，按需计算
+        self.doc_freqs = dict()
+        # key: (cache key, vocabulary 列名) val: vocabulary 在全局矩阵中的列
+        self.vocabularies = dict()
+
+    def get_rows(self, ids):
+        rows = self.id_index.get_indexer(np.asarray(ids))
+        if (rows < 0).any():
+            raise ValueError("%d ids are not in the vectorizer cache" % (rows < 0).sum())
+        return rows
+
+    def get_doc_freq(self, column_name, rows):
+        """
+        rows 的 document frequency；rows 超过一半时用全局 df 减去其余行的 df
+        """
+        X = self.count_matrices[column_name]
+        if len(rows) * 2 <= X.shape[0]:
+            return np.bincount(X[rows].indices, minlength=X.shape[1])
+        if column_name not in self.doc_freqs:
+            self.doc_freqs[column_name] = np.bincount(X.indices, minlength=X.shape[1])
+        mask = np.ones(X.shape[0], dtype=bool)
+        mask[rows] = False
+        return self.doc_freqs[column_name] - np.bincount(X[mask].indices, minlength=X.shape[1])
+
+    def get_key(self, vec, train_ids, vec_type, vocabulary_type):
+        conf_hash = hashlib.md5("%s;%s" % (self.text_hash, get_vectorizer_conf(vec))).hexdigest()
+        return "%s_%s_%s_%d_%d_%s" % (get_rows_hash(train_ids), conf_hash, vec_type, self.ngram_range[0], self.ngram_range[1], vocabulary_type)
+
+    def get_cache_path(self, key, column_name):
+        return "%s/%s.%s.pkl" % (self.cache_folder, key, column_name)
+
+    def load_entry(self, key, column_name):
+        """
+        读取持久化的 vocabulary（terms）和 idf，没有时返回 None
+        """
+        if self.cache_folder is None:
+            return None
+        path = self.get_cache_path(key, column_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            entry = cPickle.load(f)
+        columns = [self.term2index.get(term) for term in entry["terms"]]
+        if None in columns:
+            # 数据已经变化
+            return None
+        entry["columns"] = np.asarray(columns, dtype=np.int64)
+        return entry
+
+    def dump_entry(self, key, column_name, columns, idf):
+        if self.cache_folder is None:
+            return
+        if not os.path.exists(self.cache_folder):
+            try:
+                os.makedirs(self.cache_folder)
+            except OSError:
+                # 其他 fold worker 已经创建
+                pass
+        path = self.get_cache_path(key, column_name)
+        # 先写临时文件再改名，其他 worker 不会读到一半的文件
+        with open("%s.%d" % (path, os.getpid()), "wb") as f:
+            cPickle.dump({"terms": list(self.terms[columns]), "idf": idf}, f, -1)
+        os.rename("%s.%d" % (path, os.getpid()), path)
+
+    def get_vocabulary(self, vec, key, column_name, rows):
+        """
+        与 vec.fit(column) 相同的 vocabulary：按照 min_df/max_df 过滤训练行的 df
+        :return: vocabulary 在全局矩阵中的列（升序，即 vocabulary_ 的顺序）
+        """
+        if (key, column_name) not in self.vocabularies:
+            doc_freq = self.get_doc_freq(column_name, rows)
+            max_doc_count = get_doc_count(len(rows), vec.max_df)
+            min_doc_count = get_doc_count(len(rows), vec.min_df)
+            if max_doc_count < min_doc_count:
+                raise ValueError("max_df corresponds to < documents than min_df")
+            columns = np.where((doc_freq > 0) & (doc_freq >= min_doc_count) & (doc_freq <= max_doc_count))[0]
+            if len(columns) == 0:
+                raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+            self.vocabularies[(key, column_name)] = columns
+        return self.vocabularies[(key, column_name)]
+
+    def get_entry(self, vec, vec_type, vocabulary_type, column_name, train_ids):
+        """
+        column 的 vocabulary 列和 idf（持久化的或者由训练行的 df 得到）
+            - common: vocabulary 由 text_column 的训练行得到，column 使用固定的 vocabulary
+            - individual: vocabulary 由 column 的训练行得到
+        :return: key, entry
+        """
+        key = self.get_key(vec, train_ids, vec_type, vocabulary_type)
+        entry = self.load_entry(key, column_name)
+        if entry is None:
+            vocabulary_column = self.text_column if vocabulary_type == "common" else column_name
+            entry = {"columns": self.get_vocabulary(vec, key, vocabulary_column, self.get_rows(train_ids)), "idf": None}
+        return key, entry
+
+    def get_columns(self, vec, vec_type, vocabulary_type, column_name, train_ids):
+        """
+        fit_transform 结果的列在全局 vocabulary 中的位置（升序），用于对齐不同训练行的矩阵
+        """
+        return self.get_entry(vec, vec_type, vocabulary_type, column_name, train_ids)[1]["columns"]
+
+    def fit_transform(self, vec, vec_type, vocabulary_type, column_name, train_ids, test_ids):
+        """
+        与 vec（getTFV/getBOW）的 fit_transform(train)/transform(test) 相同
+        :return: X_train, X_test
+        """
+        train_rows, test_rows = self.get_rows(train_ids), self.get_rows(test_ids)
+        key, entry = self.get_entry(vec, vec_type, vocabulary_type, column_name, train_ids)
+        X = self.count_matrices[column_name][:, entry["columns"]]
+        X_train, X_test = X[train_rows], X[test_rows]
+        if isinstance(vec, TfidfVectorizer):
+            tfidf = TfidfTransformer(norm=vec.norm, use_idf=vec.use_idf, smooth_idf=vec.smooth_idf, sublinear_tf=vec.sublinear_tf)
+            X_train = X_train.astype(vec.dtype)
+            X_test = X_test.astype(vec.dtype)
+            if entry["idf"] is None:
+                X_train = tfidf.fit_transform(X_train)
+                if vec.use_idf:
+                    entry["idf"] = tfidf.idf_
+            else:
+                tfidf.idf_ = entry["idf"]
+                X_train = tfidf.transform(X_train)
+            X_test = tfidf.transform(X_test)
+        if "terms" not in entry:
+            self.dump_entry(key, column_name, entry["columns"], entry["idf"])
+        return X_train, X_test
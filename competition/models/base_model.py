@@ -3,10 +3,15 @@ __author__ = 'songquanwang'
 
 import abc
 import csv
+import os
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
-from sklearn.datasets import load_svmlight_file
 import xgboost as xgb
 from hyperopt import STATUS_OK
 from scipy.sparse import hstack
@@ -15,11 +20,24 @@ import competition.conf.model_params_conf as model_param_conf
 import competition.utils.utils as utils
 import competition.conf.model_library_config as config
 import competition.conf.model_library_config as model_conf
+from competition.feat import feat_store
+from competition.models import pred_store
+
+
+class SetObj(object):
+    """
+    一个 run/fold（或者 All）的数据集：路径、X、labels、weight、info、cdf 以及 DMatrix
+    """
+    pass
 
 
 class BaseModel(object):
     __metaclass__ = abc.ABCMeta
 
+    # 进程内的数据集缓存，所有模型共用，hyperopt 每次 trial 只有 param 不同，数据集不需要重新读取
+    # key: (feat_folder, run, fold)，All 的 run/fold 为 0 val: (文件修改时间, SetObj)
+    set_obj_cache = OrderedDict()
+
     def __init__(self, param_space, feat_folder, feat_name):
         self.param_space = param_space
         self.feat_folder = feat_folder
@@ -30,17 +48,17 @@ class BaseModel(object):
         self.log_handler = open(log_file, 'wb')
         self.writer = csv.writer(self.log_handler)
 
-    def init_all_path(self):
+    def init_all_path(self, matrix):
         path = "%s/All" % (self.feat_folder)
-        self.feat_train_path = "%s/train.feat" % path
-        self.feat_test_path = "%s/test.feat" % path
+        matrix.feat_train_path = "%s/train.feat" % path
+        matrix.feat_test_path = "%s/test.feat" % path
 
-        self.weight_train_path = "%s/train.feat.weight" % path
+        matrix.weight_train_path = "%s/train.feat.weight" % path
 
-        self.info_train_path = "%s/train.info" % path
-        self.info_test_path = "%s/test.info" % path
+        matrix.info_train_path = "%s/train.info" % path
+        matrix.info_test_path = "%s/test.info" % path
 
-        self.cdf_test_path = "%s/test.cdf" % path
+        matrix.cdf_test_path = "%s/test.cdf" % path
 
     def init_run_fold_path(self, run, fold, matrix):
         path = "%s/Run%d/Fold%d" % (self.feat_folder, run, fold)
@@ -72,12 +90,61 @@ class BaseModel(object):
 
         return raw_pred_valid_path, rank_pred_valid_path
 
+    @staticmethod
+    def get_file_stamp(paths):
+        """
+        文件修改时间，二进制特征矩阵以最后写入的 json 为准
+        """
+        stamp = []
+        for path in paths:
+            if os.path.exists(path + ".json"):
+                path = path + ".json"
+            stamp.append(os.path.getmtime(path) if os.path.exists(path) else None)
+        return tuple(stamp)
+
+    def get_cached_set_obj(self, key, paths, gen_set_obj):
+        """
+        LRU 缓存：文件没有变化时直接返回缓存的 SetObj，否则调用 gen_set_obj 重新生成
+        :param key: (feat_folder, run, fold)
+        :param paths: 数据集依赖的文件
+        :param gen_set_obj: 生成 SetObj 的函数
+        :return:
+        """
+        cache = BaseModel.set_obj_cache
+        stamp = self.get_file_stamp(paths)
+        if key in cache:
+            cached_stamp, set_obj = cache.pop(key)
+            if cached_stamp == stamp:
+                # 放到最后，表示最近使用
+                cache[key] = (cached_stamp, set_obj)
+                return set_obj
+        set_obj = gen_set_obj()
+        cache[key] = (stamp, set_obj)
+        while len(cache) > model_param_conf.set_obj_cache_size:
+            cache.popitem(last=False)
+        return set_obj
+
+    def get_set_obj_all(self):
+        matrix = SetObj()
+        self.init_all_path(matrix)
+        paths = [matrix.feat_train_path, matrix.feat_test_path, matrix.weight_train_path, matrix.info_train_path, matrix.info_test_path,
+                 matrix.cdf_test_path]
+        return self.get_cached_set_obj((self.feat_folder, 0, 0), paths, self.gen_set_obj_all)
+
+    def get_set_obj_run_fold(self, run, fold):
+        matrix = SetObj()
+        self.init_run_fold_path(run, fold, matrix)
+        paths = [matrix.feat_train_path, matrix.feat_valid_path, matrix.weight_train_path, matrix.weight_valid_path, matrix.info_train_path,
+                 matrix.info_valid_path, matrix.cdf_valid_path]
+        return self.get_cached_set_obj((self.feat_folder, run, fold), paths, lambda: self.gen_set_obj_run_fold(run, fold))
+
     def gen_set_obj_all(self):
         # init the path
-        self.init_all_path()
+        matrix = SetObj()
+        self.init_all_path(matrix)
         # feat
-        X_train, labels_train = load_svmlight_file(self.feat_train_path)
-        X_test, labels_test = load_svmlight_file(self.feat_test_path)
+        X_train, labels_train = feat_store.load_feat_matrix(matrix.feat_train_path, model_param_conf.feat_mmap_mode)
+        X_test, labels_test = feat_store.load_feat_matrix(matrix.feat_test_path, model_param_conf.feat_mmap_mode)
         # 延展array
         if X_test.shape[1] < X_train.shape[1]:
             X_test = hstack([X_test, np.zeros((X_test.shape[0], X_train.shape[1] - X_test.shape[1]))])
@@ -86,26 +153,24 @@ class BaseModel(object):
         X_train = X_train.tocsr()
         X_test = X_test.tocsr()
         # 赋给成员变量
-        self.X_train, self.labels_train, self.X_test, self.labels_test = X_train, labels_train, X_test, labels_test
+        matrix.X_train, matrix.labels_train, matrix.X_test, matrix.labels_test = X_train, labels_train, X_test, labels_test
         # weight
-        self.weight_train = np.loadtxt(self.weight_train_path, dtype=float)
+        matrix.weight_train = np.loadtxt(matrix.weight_train_path, dtype=float)
         # info
-        self.info_train = pd.read_csv(self.info_train_path)
-        self.info_test = pd.read_csv(self.info_test_path)
+        matrix.info_train = pd.read_csv(matrix.info_train_path)
+        matrix.info_test = pd.read_csv(matrix.info_test_path)
+        matrix.id_test = matrix.info_test["id"]
         # cdf
-        self.cdf_test = np.loadtxt(self.cdf_test_path, dtype=float)
+        matrix.cdf_test = np.loadtxt(matrix.cdf_test_path, dtype=float)
         # number
-        self.numTrain = self.info_train.shape[0]
-        self.numTest = self.info_test.shape[0]
+        matrix.numTrain = matrix.info_train.shape[0]
+        matrix.numTest = matrix.info_test.shape[0]
 
         # 对数据进行自举法抽样；因为ratio=1 且bootstrap_replacement=false 说明没有用到，就使用的是全量数据
-        index_base, index_meta = utils.bootstrap_all(model_param_conf.bootstrap_replacement, self.numTrain, model_param_conf.bootstrap_ratio)
-        self.dtrain = xgb.DMatrix(X_train[index_base], label=labels_train[index_base], weight=self.weight_train[index_base])
-        self.dtest = xgb.DMatrix(X_test, label=labels_test)
-        # watchlist
-        self.watchlist = []
-        if model_param_conf.verbose_level >= 2:
-            self.watchlist = [(self.dtrain_base, 'train')]
+        index_base, index_meta = utils.bootstrap_all(model_param_conf.bootstrap_replacement, matrix.numTrain, model_param_conf.bootstrap_ratio)
+        matrix.index_base = index_base
+        self.init_dmatrix_pool(matrix)
+        return matrix
 
     def gen_set_obj_run_fold(self, run, fold):
         """
@@ -115,12 +180,13 @@ class BaseModel(object):
         :return:
         """
         # init the path
-        self.init_run_fold_path(self, run, fold)
-        matrix = self.run_fold_matrix[run][fold]
+        matrix = SetObj()
+        self.init_run_fold_path(run, fold, matrix)
+        self.run_fold_matrix[run - 1][fold - 1] = matrix
 
         # feat
-        X_train, labels_train = load_svmlight_file(matrix.feat_train_path)
-        X_valid, labels_valid = load_svmlight_file(matrix.feat_valid_path)
+        X_train, labels_train = feat_store.load_feat_matrix(matrix.feat_train_path, model_param_conf.feat_mmap_mode)
+        X_valid, labels_valid = feat_store.load_feat_matrix(matrix.feat_valid_path, model_param_conf.feat_mmap_mode)
         # 延展array
         if X_valid.shape[1] < X_train.shape[1]:
             X_valid = hstack([X_valid, np.zeros((X_valid.shape[0], X_train.shape[1] - X_valid.shape[1]))])
@@ -141,17 +207,64 @@ class BaseModel(object):
         # number
         matrix.numTrain = matrix.info_train.shape[0]
         matrix.numValid = matrix.info_valid.shape[0]
+        # relevance as in [1,2,3,4]
+        matrix.Y_valid = matrix.info_valid["median_relevance"].values
 
         # 对数据进行自举法抽样；因为ratio=1 且bootstrap_replacement=false 说明没有用到，就使用的是全量数据
         index_base, index_meta = utils.bootstrap_all(model_param_conf.bootstrap_replacement, matrix.numTrain, model_param_conf.bootstrap_ratio)
-        matrix.dtrain = xgb.DMatrix(X_train[index_base], label=labels_train[index_base], weight=matrix.weight_train[index_base])
-        matrix.dvalid = xgb.DMatrix(X_valid, label=labels_valid)
-        # watchlist
+        matrix.index_base = index_base
+        self.init_dmatrix_pool(matrix)
+        return matrix
+
+    @staticmethod
+    def gen_dmatrix(set_obj):
+        """
+        set_obj 的一组 DMatrix：dtrain、dvalid（run/fold）或 dtest（All）以及 watchlist
+        :param set_obj:
+        :return:
+        """
+        matrix = SetObj()
+        index_base = set_obj.index_base
+        matrix.dtrain = xgb.DMatrix(set_obj.X_train[index_base], label=set_obj.labels_train[index_base], weight=set_obj.weight_train[index_base])
         matrix.watchlist = []
-        if model_param_conf.verbose_level >= 2:
-            matrix.watchlist = [(matrix.dtrain_base, 'train'), (matrix.dvalid_base, 'valid')]
+        if hasattr(set_obj, "X_valid"):
+            matrix.dvalid = xgb.DMatrix(set_obj.X_valid, label=set_obj.labels_valid)
+            if model_param_conf.verbose_level >= 2:
+                matrix.watchlist = [(matrix.dtrain, 'train'), (matrix.dvalid, 'valid')]
+        else:
+            matrix.dtest = xgb.DMatrix(set_obj.X_test, label=set_obj.labels_test)
+            if model_param_conf.verbose_level >= 2:
+                matrix.watchlist = [(matrix.dtrain, 'train')]
         return matrix
 
+    @staticmethod
+    def init_dmatrix_pool(set_obj):
+        """
+        set_obj 的 DMatrix 池，先生成一组，串行训练只使用这一组
+        """
+        set_obj.dmatrix_lock = threading.Lock()
+        set_obj.dmatrix_pool = [BaseModel.gen_dmatrix(set_obj)]
+
+    @staticmethod
+    @contextmanager
+    def use_dmatrix(set_obj):
+        """
+        借用 set_obj 的一组 DMatrix，用完放回池中
+        xgboost 训练时会在 DMatrix 内部延迟生成列访问、分位数等状态，同时训练的任务不能共用一个 DMatrix：
+        池中没有空闲的 DMatrix 时生成新的一组，每个 set_obj 最多生成并行线程数组
+        :param set_obj:
+        :return:
+        """
+        with set_obj.dmatrix_lock:
+            matrix = set_obj.dmatrix_pool.pop() if set_obj.dmatrix_pool else None
+        if matrix is None:
+            matrix = BaseModel.gen_dmatrix(set_obj)
+        try:
+            yield matrix
+        finally:
+            with set_obj.dmatrix_lock:
+                set_obj.dmatrix_pool.append(matrix)
+
     def out_put_run_fold(self, run, fold, feat_name, trial_counter, X_train, Y_valid, pred_raw, pred_rank, kappa_valid):
         """
 
@@ -175,81 +288,141 @@ class BaseModel(object):
         dfPred = pd.DataFrame({"target": Y_valid, "prediction": pred_rank})
         dfPred.to_csv(rank_pred_valid_path, index=False, header=True, columns=["target", "prediction"])
 
-    def out_put_all(self, feat_name, trial_counter, kappa_cv_mean, kappa_cv_std, pred_raw, pred_rank):
+    def out_put_all(self, set_obj, feat_name, trial_counter, kappa_cv_mean, kappa_cv_std, pred_raw, pred_rank):
 
         raw_pred_test_path, rank_pred_test_path, subm_path = self.get_output_all_path(feat_name, trial_counter, kappa_cv_mean, kappa_cv_std)
         ## write
-        output = pd.DataFrame({"id": self.id_test, "prediction": pred_raw})
+        output = pd.DataFrame({"id": set_obj.id_test, "prediction": pred_raw})
         output.to_csv(raw_pred_test_path, index=False)
 
         ## write
-        output = pd.DataFrame({"id": self.id_test, "prediction": pred_rank})
+        output = pd.DataFrame({"id": set_obj.id_test, "prediction": pred_rank})
         output.to_csv(rank_pred_test_path, index=False)
+        # 集成使用的二进制预测值
+        pred_store.dump_test_pred(model_param_conf.output_path, "%s_[Id@%d]" % (feat_name, trial_counter), set_obj.id_test, pred_rank)
 
         ## write score pred--原来代码有错：应该是pred_raw 因为pred_raw是多次装袋后平均预测值，不应该是其中一次装袋的预测值
-        pred_score = utils.getScore(pred_raw, self.cdf_test)
-        output = pd.DataFrame({"id": self.id_test, "prediction": pred_score})
+        pred_score = utils.getScore(pred_raw, set_obj.cdf_test)
+        output = pd.DataFrame({"id": set_obj.id_test, "prediction": pred_score})
         output.to_csv(subm_path, index=False)
 
-    def gen_bagging(self, set_obj, all):
+    @staticmethod
+    def get_n_workers(param):
         """
-        分袋整合预测结果
+        run/fold/bag 并行的线程数：cpu 预算 / 每个模型内部的线程数（nthread/n_jobs）
+        :param param:
+        :return:
+        """
+        cpu_budget = model_conf.cpu_budget
+        if cpu_budget <= 0:
+            cpu_budget = multiprocessing.cpu_count() // max(1, model_conf.hyperopt_n_jobs)
+        n_inner = param.get("nthread", param.get("n_jobs", 1))
+        return max(1, int(cpu_budget // max(1, n_inner)))
+
+    @staticmethod
+    def map_jobs(func, jobs, n_workers):
+        """
+        线程池执行 jobs，结果顺序与 jobs 相同；xgboost/sklearn 训练时会释放 GIL，
+        set_obj 的 X/labels 只读共用，xgboost 的 DMatrix 每个同时运行的任务各用一组（use_dmatrix）
+        :param func:
+        :param jobs: [args]
+        :param n_workers:
+        :return:
+        """
+        if n_workers <= 1 or len(jobs) <= 1:
+            return [func(*job) for job in jobs]
+        pool = ThreadPool(min(n_workers, len(jobs)))
+        try:
+            return pool.map(lambda job: func(*job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def reduce_bagging(self, set_obj, preds, all):
+        """
+        整合每个 bag 的预测结果
         :param set_obj:
+        :param preds: 每个 bag 的预测值
         :param all:
         :return:
         """
-        preds_bagging = np.zeros((self.numTest, model_param_conf.bagging_size), dtype=float)
-        for n in range(model_param_conf.bagging_size):
-            # 调用 每个子类的train_predict方法，多态
-            pred = self.train_predict(self, set_obj, all)
-            pred_test = pred
-            preds_bagging[:, n] = pred_test
-            if not all:
-                # 每次会把当前bagging的结果累计进来 求均值
-                pred_raw = np.mean(preds_bagging[:, :(pred + 1)], axis=1)
-                # 为什么需要两次argsort？
-                pred_rank = pred_raw.argsort().argsort()
-                pred_score, cutoff = utils.getScore(pred_rank, self.cdf_valid, valid=True)
-                kappa_valid = utils.quadratic_weighted_kappa(pred_score, self.Y_valid)
-
+        preds_bagging = np.column_stack(preds)
         pred_raw = np.mean(preds_bagging, axis=1)
+        # 为什么需要两次argsort？
         pred_rank = pred_raw.argsort().argsort()
         if all:
             return pred_raw, pred_rank
-        else:
-            return pred_raw, pred_rank, kappa_valid
+        pred_score, cutoff = utils.getScore(pred_rank, set_obj.cdf_valid, valid=True)
+        kappa_valid = utils.quadratic_weighted_kappa(pred_score, set_obj.Y_valid)
+        return pred_raw, pred_rank, kappa_valid
+
+    def gen_bagging(self, set_obj, all, n_workers=1):
+        """
+        分袋整合预测结果
+        :param set_obj:
+        :param all:
+        :param n_workers: bag 并行的线程数
+        :return:
+        """
+        # 调用 每个子类的train_predict方法，多态
+        jobs = [(set_obj, all)] * model_param_conf.bagging_size
+        preds = self.map_jobs(self.train_predict, jobs, n_workers)
+        return self.reduce_bagging(set_obj, preds, all)
 
-    def hyperopt_obj(self, param, feat_folder, feat_name, trial_counter):
+    def hyperopt_obj(self, param, feat_folder, feat_name, trial_counter=None, log=True):
         """
         最优化方法 hyperopt_obj
         :param feat_folder:
         :param feat_name:
-        :param trial_counter:
+        :param trial_counter: None 表示串行 fmin，使用 self.trial_counter + 1
+        :param log: 是否记录参数文件；并行搜索时由主进程按 trial 顺序调用 log_param
         :return:
         """
+        if trial_counter is None:
+            trial_counter = self.trial_counter + 1
+        self.param = param
+        n_workers = self.get_n_workers(param)
         # 定义kappa交叉验证结构
         kappa_cv = np.zeros((config.n_runs, config.n_folds), dtype=float)
+        # (run, fold, bag) 训练任务一起放到线程池
+        run_fold_set_objs = []
+        jobs = []
         for run in range(1, config.n_runs + 1):
             for fold in range(1, config.n_folds + 1):
-                # 生成 run_fold_set_obj
-                set_obj = self.gen_set_obj_run_fold(self, run, fold)
-                # bagging结果
-                pred_raw, pred_rank, kappa_valid = self.gen_bagging(self, set_obj, all=False)
-                # 输出文件
-                kappa_cv[run - 1, fold - 1] = kappa_valid
-                # 生成没run fold的结果
-                self.out_put_run_fold(run, fold, feat_name, trial_counter, set_obj.X_train, set_obj.Y_valid, pred_raw, pred_rank, kappa_valid)
+                # 生成 run_fold_set_obj，文件没有变化时使用缓存
+                set_obj = self.get_set_obj_run_fold(run, fold)
+                set_obj.param = param
+                run_fold_set_objs.append((run, fold, set_obj))
+                jobs.extend([(set_obj, False)] * model_param_conf.bagging_size)
+        preds = self.map_jobs(self.train_predict, jobs, n_workers)
+        # 按 run/fold 顺序整合
+        Y_valid_list, pred_rank_list = [], []
+        for i, (run, fold, set_obj) in enumerate(run_fold_set_objs):
+            # bagging结果
+            preds_run_fold = preds[i * model_param_conf.bagging_size:(i + 1) * model_param_conf.bagging_size]
+            pred_raw, pred_rank, kappa_valid = self.reduce_bagging(set_obj, preds_run_fold, all=False)
+            # 输出文件
+            kappa_cv[run - 1, fold - 1] = kappa_valid
+            # 生成没run fold的结果
+            self.out_put_run_fold(run, fold, feat_name, trial_counter, set_obj.X_train, set_obj.Y_valid, pred_raw, pred_rank, kappa_valid)
+            Y_valid_list.append(set_obj.Y_valid)
+            pred_rank_list.append(pred_rank)
+        # 所有 run/fold 的预测值保存为一个二进制文件，集成时一次读取
+        pred_store.dump_valid_pred(model_param_conf.output_path, "%s_[Id@%d]" % (feat_name, trial_counter), Y_valid_list, pred_rank_list)
         # kappa_cv run*fold*bagging_size 均值和方差
         kappa_cv_mean, kappa_cv_std = np.mean(kappa_cv), np.std(kappa_cv)
         if model_param_conf.verbose_level >= 1:
             print("              Mean: %.6f" % kappa_cv_mean)
             print("              Std: %.6f" % kappa_cv_std)
         # # bagging结果
-        pred_raw, pred_rank = self.gen_bagging(self, set_obj, all=True)
+        set_obj = self.get_set_obj_all()
+        set_obj.param = param
+        pred_raw, pred_rank = self.gen_bagging(set_obj, True, n_workers)
         # 生成提交结果
-        self.out_put_all(feat_folder, feat_name, trial_counter, kappa_cv_mean, kappa_cv_std, pred_raw, pred_rank)
+        self.out_put_all(set_obj, feat_name, trial_counter, kappa_cv_mean, kappa_cv_std, pred_raw, pred_rank)
         # 记录参数文件
-        self.log_param(param, feat_name, kappa_cv_mean, kappa_cv_std)
+        if log:
+            self.log_param(param, feat_name, kappa_cv_mean, kappa_cv_std)
         # 根据交叉验证的平均值作为模型好坏标准
         return {'loss': -kappa_cv_mean, 'attachments': {'std': kappa_cv_std}, 'status': STATUS_OK}
 
@@ -1,17 +1,29 @@
 # coding=utf-8
 __author__ = 'songquanwang'
 
+import threading
+
 import numpy as np
 
 import xgboost as xgb
 from competition.models.base_model import BaseModel
 import competition.conf.model_params_conf as model_param_conf
+import competition.conf.model_library_config as model_library_config
 import competition.utils.utils as utils
 
 
 class GbdtModelImp(BaseModel):
     def __init__(self, param_space, feat_folder, feat_name):
         super(GbdtModelImp, self).__init__(param_space, feat_folder, feat_name)
+        # 每个 run/fold/bag 早停时的最优轮数，All 使用均值
+        self.best_num_rounds = []
+        # 创建每个 set_obj 的 base booster 锁
+        self.booster_lock = threading.Lock()
+
+    def hyperopt_obj(self, param, feat_folder, feat_name, trial_counter=None, log=True):
+        # 每个 trial 重新记录最优轮数
+        self.best_num_rounds = []
+        return super(GbdtModelImp, self).hyperopt_obj(param, feat_folder, feat_name, trial_counter, log)
 
     def train_predict(self, set_obj, all=False):
         """
@@ -22,7 +34,7 @@ class GbdtModelImp(BaseModel):
         if self.param["task"] in ["regression", "ranking"]:
             pred = self.reg_rank_predict(set_obj, all)
         elif self.param["task"] in ["softmax"]:
-            pred = self.soft_max_predict(set_obj)
+            pred = self.soft_max_predict(set_obj, all)
         elif self.param["task"] in ["softkappa"]:
             pred = self.soft_softkappa_predict(set_obj, all)
         elif self.param["task"] in ["ebc"]:
@@ -32,105 +44,112 @@ class GbdtModelImp(BaseModel):
 
         return pred
 
+    def get_num_round(self, all):
+        """
+        run/fold 使用 param['num_round']；开启早停时 All 使用 run/fold 最优轮数的均值
+        """
+        num_round = int(self.param['num_round'])
+        if all and model_library_config.xgb_early_stopping_rounds and len(self.best_num_rounds) > 0:
+            num_round = int(np.round(np.mean(self.best_num_rounds)))
+        return max(1, num_round)
+
+    def get_base_booster(self, set_obj, dtrain, num_round, obj):
+        """
+        warm start：同一个 set_obj 的所有 bag 共用一个训练了 num_round 轮的 base booster，每个 trial 只训练一次
+        """
+        with self.booster_lock:
+            if not hasattr(set_obj, "base_booster_lock"):
+                set_obj.base_booster_lock = threading.Lock()
+        # 不同 run/fold 的 base booster 可以同时训练
+        with set_obj.base_booster_lock:
+            if getattr(set_obj, "base_booster_param", None) is not self.param or getattr(set_obj, "base_booster_round", None) != num_round:
+                set_obj.base_booster = xgb.train(self.param, dtrain, num_round, obj=obj)
+                set_obj.base_booster_param = self.param
+                set_obj.base_booster_round = num_round
+            return set_obj.base_booster
+
+    def train_booster(self, set_obj, all, obj=None, feval=None):
+        """
+        训练 xgboost 并预测 valid/test
+            1. run/fold 开启早停（xgb_early_stopping_rounds）时以 valid kappa（feval）早停，记录最优轮数
+            2. bagging_size > 1 且 xgb_warm_start_ratio > 0 时，bag 从共用的 base booster 继续训练（xgb_model）
+            3. warm start 时不早停：不同版本 xgboost 的 best_iteration/best_ntree_limit 对 xgb_model 是相对还是
+               绝对轮数不一致，早停只用于从头训练的 booster，最优轮数和 ntree_limit 都是绝对轮数
+        :param set_obj:
+        :param all:
+        :param obj: 自定义目标函数
+        :param feval: feval(preds, dtrain, cdf)
+        :return: 原始预测值
+        """
+        cdf = set_obj.cdf_test if all else set_obj.cdf_valid
+        evalerror = None
+        if feval is not None:
+            evalerror = lambda preds, dtrain: feval(preds, dtrain, cdf)
+        num_round = self.get_num_round(all)
+        # 并行的 run/fold/bag 任务不共用 DMatrix
+        with self.use_dmatrix(set_obj) as matrix:
+            dpredict = matrix.dtest if all else matrix.dvalid
+            evals = list(matrix.watchlist)
+
+            xgb_model = None
+            base_round = int(num_round * model_library_config.xgb_warm_start_ratio)
+            if model_param_conf.bagging_size > 1 and 0 < base_round < num_round:
+                xgb_model = self.get_base_booster(set_obj, matrix.dtrain, base_round, obj)
+                num_round -= base_round
+
+            early_stopping_rounds = None
+            if not all and xgb_model is None and model_library_config.xgb_early_stopping_rounds:
+                # 早停以 evals 的最后一个（valid）为准
+                evals = [e for e in evals if e[1] != 'valid'] + [(matrix.dvalid, 'valid')]
+                early_stopping_rounds = model_library_config.xgb_early_stopping_rounds
+
+            bst = xgb.train(self.param, matrix.dtrain, num_round, evals, obj=obj, feval=evalerror,
+                            early_stopping_rounds=early_stopping_rounds, xgb_model=xgb_model)
+            ntree_limit = 0
+            if early_stopping_rounds is not None and hasattr(bst, "best_iteration"):
+                # 从头训练，best_iteration 即绝对轮数
+                best_num_round = bst.best_iteration + 1
+                self.best_num_rounds.append(best_num_round)
+                ntree_limit = best_num_round * int(self.param.get("num_parallel_tree", 1))
+            return bst.predict(dpredict, ntree_limit=ntree_limit)
+
     def reg_rank_predict(self, set_obj, all=False):
         # regression & pairwise ranking with xgboost
-        if all == False:
-            evalerror_regrank_valid = lambda preds, dtrain: utils.evalerror_regrank_cdf(preds, dtrain,
-                                                                                        set_obj.cdf_valid)
-            bst = xgb.train(set_obj.param, set_obj.dtrain_base, self.param['num_round'], set_obj.watchlist,
-                            feval=evalerror_regrank_valid)
-            pred = bst.predict(set_obj.dvalid_base)
-        else:
-            evalerror_regrank_test = lambda preds, dtrain: utils.evalerror_regrank_cdf(preds, dtrain, utils.cdf_test)
-            bst = xgb.train(set_obj.param, set_obj.dtrain, set_obj.param['num_round'], utils.watchlist,
-                            feval=evalerror_regrank_test)
-            pred = bst.predict(set_obj.dtest)
+        pred = self.train_booster(set_obj, all, feval=utils.evalerror_regrank_cdf)
         return pred
 
     def soft_max_predict(self, set_obj, all=False):
         ## softmax regression with xgboost
-        if all == False:
-            evalerror_softmax_valid = lambda preds, dtrain: utils.evalerror_softmax_cdf(preds, dtrain,
-                                                                                        set_obj.cdf_valid)
-            bst = xgb.train(set_obj.param, set_obj.dtrain_base, self.param['num_round'], set_obj.watchlist,
-                            feval=evalerror_softmax_valid)
-            # (6688, 4)
-            pred = bst.predict(set_obj.dvalid_base)
-            w = np.asarray(range(1, model_param_conf.num_of_class + 1))
-            # 加权相乘 ？累加
-            pred = pred * w[np.newaxis, :]
-            pred = np.sum(pred, axis=1)
-        else:
-            evalerror_softmax_test = lambda preds, dtrain: utils.evalerror_softmax_cdf(preds, dtrain, set_obj.cdf_test)
-            bst = xgb.train(set_obj.param, set_obj.dtrain, set_obj.param['num_round'], set_obj.watchlist,
-                            feval=evalerror_softmax_test)
-            pred = bst.predict(set_obj.dtest)
-            w = np.asarray(range(1, model_param_conf.num_of_class + 1))
-            pred = pred * w[np.newaxis, :]
-            pred = np.sum(pred, axis=1)
+        # (6688, 4)
+        pred = self.train_booster(set_obj, all, feval=utils.evalerror_softmax_cdf)
+        w = np.asarray(range(1, model_param_conf.num_of_class + 1))
+        # 加权相乘 ？累加
+        pred = pred * w[np.newaxis, :]
+        pred = np.sum(pred, axis=1)
         return pred
 
     def soft_softkappa_predict(self, set_obj, all=False):
         ## softkappa with xgboost
-        if all == False:
-            evalerror_softkappa_valid = lambda preds, dtrain: utils.evalerror_softkappa_cdf(preds, dtrain,
-                                                                                            set_obj.cdf_valid)
-            obj = lambda preds, dtrain: utils.softkappaObj(preds, dtrain, hess_scale=self.param['hess_scale'])
-            bst = xgb.train(set_obj.param, set_obj.dtrain_base, self.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_softkappa_valid)
-            pred = utils.softmax(bst.predict(set_obj.dvalid_base))
-            w = np.asarray(range(1, model_param_conf.num_of_class + 1))
-            pred = pred * w[np.newaxis, :]
-            pred = np.sum(pred, axis=1)
-        else:
-            evalerror_softkappa_test = lambda preds, dtrain: utils.evalerror_softkappa_cdf(preds, dtrain,
-                                                                                           set_obj.cdf_test)
-            obj = lambda preds, dtrain: utils.softkappaObj(preds, set_obj.dtrain,
-                                                           hess_scale=set_obj.param['hess_scale'])
-            bst = xgb.train(set_obj.param, set_obj.dtrain, set_obj.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_softkappa_test)
-            pred = utils.softmax(bst.predict(set_obj.dtest))
-            w = np.asarray(range(1, model_param_conf.num_of_class + 1))
-            pred = pred * w[np.newaxis, :]
-            pred = np.sum(pred, axis=1)
+        obj = lambda preds, dtrain: utils.softkappaObj(preds, dtrain, hess_scale=self.param['hess_scale'])
+        pred = utils.softmax(self.train_booster(set_obj, all, obj=obj, feval=utils.evalerror_softkappa_cdf))
+        w = np.asarray(range(1, model_param_conf.num_of_class + 1))
+        pred = pred * w[np.newaxis, :]
+        pred = np.sum(pred, axis=1)
         return pred
 
     def ebc_predict(self, set_obj, all=False):
         # ebc with xgboost
-        if all == False:
-            evalerror_ebc_valid = lambda preds, dtrain: utils.evalerror_ebc_cdf(preds, dtrain, set_obj.cdf_valid,
-                                                                                model_param_conf.ebc_hard_threshold)
-            obj = lambda preds, dtrain: utils.ebcObj(preds, dtrain)
-            bst = xgb.train(set_obj.param, set_obj.dtrain_base, self.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_ebc_valid)
-            pred = utils.sigmoid(bst.predict(set_obj.dvalid_base))
-            pred = utils.applyEBCRule(pred, hard_threshold=utils.ebc_hard_threshold)
-        else:
-            evalerror_ebc_test = lambda preds, dtrain: utils.evalerror_ebc_cdf(preds, dtrain, set_obj.cdf_test,
-                                                                               model_param_conf.ebc_hard_threshold)
-            obj = lambda preds, dtrain: utils.ebcObj(preds, dtrain)
-            bst = xgb.train(set_obj.param, set_obj.dtrain, set_obj.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_ebc_test)
-            pred = utils.sigmoid(bst.predict(set_obj.dtest))
-            pred = utils.applyEBCRule(pred, hard_threshold=utils.ebc_hard_threshold)
+        feval = lambda preds, dtrain, cdf: utils.evalerror_ebc_cdf(preds, dtrain, cdf, model_param_conf.ebc_hard_threshold)
+        obj = lambda preds, dtrain: utils.ebcObj(preds, dtrain)
+        pred = utils.sigmoid(self.train_booster(set_obj, all, obj=obj, feval=feval))
+        pred = utils.applyEBCRule(pred, hard_threshold=model_param_conf.ebc_hard_threshold)
         return pred
 
     def cocr_predict(self, set_obj, all=False):
         ## cocr with xgboost
-        if all == False:
-            evalerror_cocr_valid = lambda preds, dtrain: utils.evalerror_cocr_cdf(preds, dtrain, set_obj.cdf_valid)
-            obj = lambda preds, dtrain: utils.cocrObj(preds, set_obj.dtrain)
-            bst = xgb.train(set_obj.param, set_obj.dtrain_base, set_obj.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_cocr_valid)
-            pred = bst.predict(set_obj.dvalid_base)
-            pred = utils.applyCOCRRule(pred)
-        else:
-            evalerror_cocr_test = lambda preds, dtrain: utils.evalerror_cocr_cdf(preds, dtrain, set_obj.cdf_test)
-            obj = lambda preds, dtrain: utils.cocrObj(preds, dtrain)
-            bst = xgb.train(set_obj.param, set_obj.dtrain, set_obj.param['num_round'], set_obj.watchlist, obj=obj,
-                            feval=evalerror_cocr_test)
-            pred = bst.predict(set_obj.dtest)
-            pred = utils.applyCOCRRule(pred)
+        obj = lambda preds, dtrain: utils.cocrObj(preds, dtrain)
+        pred = self.train_booster(set_obj, all, obj=obj, feval=utils.evalerror_cocr_cdf)
+        pred = utils.applyCOCRRule(pred)
         return pred
 
     @staticmethod
@@ -0,0 +1,140 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    parallel hyperopt search used by model_manager
+
+        1. batched TPE suggest: tpe.suggest only returns one trial per call (after n_startup_jobs),
+           each search asks for its batch one trial at a time, every suggested trial is inserted as
+           a pending trial (infinite loss) before the next call, so the batch members differ;
+           the trials of all the searches (one search per feat_name) are evaluated together by
+           a pool of local worker processes
+
+        2. the models are created before the pool forks, only (feat_name, param, trial_counter)
+           is sent to the workers; the workers don't write the hyperopt log
+
+        3. the results are written back to each search's Trials in trial order, and log_param
+           is called by the main process only, so the CSV log stays consistent
+"""
+
+import multiprocessing
+
+import numpy as np
+from hyperopt import tpe, Trials, space_eval
+from hyperopt.base import Domain, spec_from_misc, JOB_STATE_DONE
+
+import competition.conf.model_library_config as model_library_config
+
+# feat_name -> (model, feat_folder)，在进程池 fork 之前设置，子进程继承
+_models = dict()
+
+
+def _run_trial(task):
+    feat_name, param, trial_counter = task
+    model, feat_folder = _models[feat_name]
+    return model.hyperopt_obj(param, feat_folder, feat_name, trial_counter, log=False)
+
+
+class TrialSearch(object):
+    """
+    一个 feat_name 的 batched TPE 搜索
+    """
+
+    def __init__(self, model, param_space, feat_folder, feat_name, seed=model_library_config.hyperopt_random_seed):
+        self.model = model
+        self.param_space = param_space
+        self.feat_folder = feat_folder
+        self.feat_name = feat_name
+        self.max_evals = param_space["max_evals"]
+        # fn 不会被调用，trial 由 worker 计算
+        self.domain = Domain(lambda p: None, param_space)
+        self.trials = Trials()
+        self.rstate = np.random.RandomState(seed)
+        self.n_suggested = 0
+        # tid -> param
+        self.pending = dict()
+
+    def is_done(self):
+        return self.n_suggested >= self.max_evals and len(self.pending) == 0
+
+    def suggest(self, n):
+        """
+        用已经完成的 trials 生成 n 个新的 trial
+        :param n:
+        :return: [(feat_name, param, trial_counter)]
+        """
+        n = min(n, self.max_evals - self.n_suggested)
+        if n <= 0:
+            return []
+        docs = []
+        # 每次只分配一个 id，trial_counter 连续
+        for i in range(n):
+            new_ids = self.trials.new_trial_ids(1)
+            self.trials.refresh()
+            new_docs = tpe.suggest(new_ids, self.domain, self.trials, self.rstate.randint(2 ** 31 - 1))
+            # 作为 pending trial 插入，下一次 suggest 可以看到
+            self.trials.insert_trial_docs(new_docs)
+            self.trials.refresh()
+            docs.extend(new_docs)
+        self.n_suggested += len(docs)
+
+        tasks = []
+        for doc in docs:
+            tid = doc["tid"]
+            param = space_eval(self.param_space, spec_from_misc(doc["misc"]))
+            self.pending[tid] = param
+            # trial_counter 从 1 开始，与串行 fmin 相同
+            tasks.append((self.feat_name, param, tid + 1))
+        return tasks
+
+    def record(self, tid, result):
+        """
+        把 worker 的结果写回 Trials，并记录参数文件
+        :param tid:
+        :param result: hyperopt_obj 的返回值
+        :return:
+        """
+        param = self.pending.pop(tid)
+        result = dict(result)
+        attachments = result.pop("attachments", {})
+        for doc in self.trials._dynamic_trials:
+            if doc["tid"] == tid:
+                doc["result"] = result
+                doc["state"] = JOB_STATE_DONE
+                for k, v in attachments.items():
+                    self.trials.trial_attachments(doc)[k] = v
+                break
+        self.trials.refresh()
+        kappa_cv_mean, kappa_cv_std = -result["loss"], attachments.get("std")
+        self.model.log_param(param, self.feat_name, kappa_cv_mean, kappa_cv_std)
+
+
+def search(searches, n_jobs):
+    """
+    多个 feat_name 的搜索共用一个进程池
+    :param searches: [TrialSearch]
+    :param n_jobs: worker 个数
+    :return: [(best_params, trials)]，顺序与 searches 相同
+    """
+    global _models
+    _models = dict((s.feat_name, (s.model, s.feat_folder)) for s in searches)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        while True:
+            active = [s for s in searches if not s.is_done()]
+            if len(active) == 0:
+                break
+            # 每一轮把 n_jobs 个 trial 平均分给还没有结束的搜索
+            batch_size = int(np.ceil(float(n_jobs) / len(active)))
+            tasks = []
+            for s in active:
+                tasks.extend(s.suggest(batch_size))
+            results = pool.map(_run_trial, tasks, chunksize=1)
+            # 按 trial 顺序写回
+            search_dict = dict((s.feat_name, s) for s in searches)
+            for (feat_name, param, trial_counter), result in zip(tasks, results):
+                search_dict[feat_name].record(trial_counter - 1, result)
+    finally:
+        pool.close()
+        pool.join()
+        _models = dict()
+    return [(s.trials.argmin, s.trials) for s in searches]
@@ -5,6 +5,8 @@ import os
 from hyperopt import fmin, tpe, Trials
 import numpy as np
 
+from competition.models import hyperopt_pool
+
 from competition.models.gbdt.gbdt_model_imp import GbdtModelImp
 from competition.models.keras.keras_dnn_model_imp import KerasDnnModelImp
 from competition.models.libfm.libfm_model_imp import LibfmModelImp
@@ -36,29 +38,49 @@ def create_model(param_space, feat_folder, feat_name):
         raise Exception('暂时不支持改模型!')
 
 
-def make_predict_by_models(specified_models):
+def search_best_params(model, param_space, feat_folder, feat_name):
+    """
+    串行搜索：fmin 逐个计算 trial
+    :return: best_params, trials
+    """
+    print("************************************************************")
+    print("Search for the best params")
+    # global trial_counter
+    trials = Trials()
+    objective = lambda p: model.hyperopt_obj(p, feat_folder, feat_name)
+    best_params = fmin(objective, param_space, algo=tpe.suggest, trials=trials, max_evals=param_space["max_evals"])
+    return best_params, trials
+
+
+def make_predict_by_models(specified_models, n_jobs=model_library_config.hyperopt_n_jobs):
     """
     使用指定的模型预测结果
     :param specified_models:
-    :return:best_kappa_mean, best_kappa_std
+    :param n_jobs: 并行 trial 的进程数，1 表示串行；>1 时所有模型的搜索一起在进程池中进行
+    :return:best_kappa_mean, best_kappa_std 所有模型中最好的结果
     """
     log_path = "%s/Log" % config.output_path
     if not os.path.exists(log_path):
         os.makedirs(log_path)
     # 判断传入参数中的models是不是已经配置的models
+    searches = []
     for feat_name in specified_models:
         if feat_name not in model_library_config.feat_names:
             continue
         feat_folder, param_space = model_library_config.model_config[feat_name]
         model = create_model(param_space, feat_folder, feat_name)
         model.log_header()
+        searches.append(hyperopt_pool.TrialSearch(model, param_space, feat_folder, feat_name))
 
+    if n_jobs > 1:
         print("************************************************************")
-        print("Search for the best params")
-        # global trial_counter
-        trials = Trials()
-        objective = lambda p: model.hyperopt_obj(p, feat_folder, feat_name)
-        best_params = fmin(objective, param_space, algo=tpe.suggest, trials=trials, max_evals=param_space["max_evals"])
+        print("Search for the best params with %d workers" % n_jobs)
+        results = hyperopt_pool.search(searches, n_jobs)
+    else:
+        results = [search_best_params(s.model, s.param_space, s.feat_folder, s.feat_name) for s in searches]
+
+    best_kappa_mean, best_kappa_std = None, None
+    for best_params, trials in results:
         # 把best_params包含的数字属性转成int
         for f in model_library_config.int_feat:
             if best_params.has_key(f):
@@ -69,11 +91,13 @@ def make_predict_by_models(specified_models):
             print "        %s: %s" % (k, v)
         # 获取尝试的losses
         trial_kappas = -np.asarray(trials.losses(), dtype=float)
-        best_kappa_mean = max(trial_kappas)
+        kappa_mean = max(trial_kappas)
         # where返回两个维度的坐标
-        ind = np.where(trial_kappas == best_kappa_mean)[0][0]
+        ind = np.where(trial_kappas == kappa_mean)[0][0]
         # 找到最优参数的std
-        best_kappa_std = trials.trial_attachments(trials.trials[ind])['std']
+        kappa_std = trials.trial_attachments(trials.trials[ind])['std']
         print("Kappa stats")
-        print("        Mean: %.6f\n        Std: %.6f" % (best_kappa_mean, best_kappa_std))
-        return best_kappa_mean, best_kappa_std
+        print("        Mean: %.6f\n        Std: %.6f" % (kappa_mean, kappa_std))
+        if best_kappa_mean is None or kappa_mean > best_kappa_mean:
+            best_kappa_mean, best_kappa_std = kappa_mean, kappa_std
+    return best_kappa_mean, best_kappa_std
@@ -0,0 +1,101 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    binary prediction repository shared by BaseModel and ensemble selection
+
+        1. BaseModel writes one .npy file per model (feat_name_[Id@trial_counter]) next to the csv files:
+            - Pred/valid.pred.<model>.npy: (2, sum(numValid)) target and rank prediction of all the
+              run/fold in run/fold order
+            - Pred/test.pred.<model>.npy: (2, numTest) id and rank prediction
+
+        2. ensemble selection fills the (model, run, fold, n) tensor from the valid files with one
+           boolean mask assignment per model, the csv files are only read for older outputs
+
+        3. the test predictions are cached in the process, every bag reuses them
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# key: (model_folder, model) val: (id_test, pred)
+_test_pred_cache = dict()
+
+
+def get_valid_path(model_folder, model):
+    return "%s/Pred/valid.pred.%s.npy" % (model_folder, model)
+
+
+def get_test_path(model_folder, model):
+    return "%s/Pred/test.pred.%s.npy" % (model_folder, model)
+
+
+def _save(path, arrays):
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # 其他 hyperopt worker 已经创建
+            pass
+    np.save(path, np.vstack([np.asarray(a, dtype=float) for a in arrays]))
+
+
+def dump_valid_pred(model_folder, model, Y_valid_list, pred_list):
+    """
+    保存一个模型所有 run/fold 的 valid 预测值
+    :param model_folder:
+    :param model: feat_name_[Id@trial_counter]
+    :param Y_valid_list: 按照 run/fold 顺序的 label
+    :param pred_list: 按照 run/fold 顺序的预测值
+    :return:
+    """
+    _save(get_valid_path(model_folder, model), [np.concatenate(Y_valid_list), np.concatenate(pred_list)])
+
+
+def dump_test_pred(model_folder, model, id_test, pred):
+    _save(get_test_path(model_folder, model), [id_test, pred])
+
+
+def load_valid_preds(model_folder, model_list, numValidMatrix, pred_list_valid, Y_list_valid):
+    """
+    读取所有模型的 valid 预测值
+    :param model_folder:
+    :param model_list:
+    :param numValidMatrix: (run, fold) valid 行数
+    :param pred_list_valid: 引用 (model, run, fold, n)
+    :param Y_list_valid: 引用 (run, fold, n)
+    :return: 没有 .npy 文件的模型下标，需要读取 csv
+    """
+    # run/fold 顺序展开后，mask 为 True 的位置与拼接后的预测值一一对应
+    mask = np.arange(pred_list_valid.shape[-1])[np.newaxis, np.newaxis, :] < numValidMatrix[:, :, np.newaxis]
+    missing = []
+    for model_id, model in enumerate(model_list):
+        path = get_valid_path(model_folder, model)
+        if not os.path.exists(path):
+            missing.append(model_id)
+            continue
+        target, pred = np.load(path)
+        if pred.shape[0] != mask.sum():
+            raise ValueError("%s has %d rows, valid.info has %d rows" % (path, pred.shape[0], mask.sum()))
+        pred_list_valid[model_id][mask] = pred
+        Y_list_valid[mask] = target
+    return missing
+
+
+def load_test_pred(model_folder, model):
+    """
+    读取一个模型的 test 预测值，进程内缓存
+    :return: id_test (int), pred
+    """
+    key = (model_folder, model)
+    if key not in _test_pred_cache:
+        path = get_test_path(model_folder, model)
+        if os.path.exists(path):
+            id_test, pred = np.load(path)
+        else:
+            dfPred = pd.read_csv("%s/All/test.pred.%s.csv" % (model_folder, model), dtype=float)
+            id_test, pred = dfPred["id"].values, dfPred["prediction"].values
+        _test_pred_cache[key] = (np.asarray(id_test, dtype=int), pred)
+    return _test_pred_cache[key]
@@ -17,14 +17,38 @@ __author__
 """
 
 import cPickle
+import multiprocessing
 
 import numpy as np
 import pandas as pd
 
-from competition.feat.nlp.nlp_utils import clean_text
+from competition.feat.nlp.nlp_utils import text_cleaner, clean_text_names
 import competition.conf.model_params_conf as config
 
 
+def _clean_chunk(values):
+    return text_cleaner.clean_column(values, drop_html_flag=config.drop_html_flag)
+
+
+def clean_df(df, pool=None):
+    """
+    按列清洗 query/product_title/product_description，每列切分成 chunk 后交给进程池
+    :param df:
+    :param pool: None 表示串行
+    :return:
+    """
+    chunk_size = config.preprocess_chunk_size
+    for name in clean_text_names:
+        values = list(df[name].values)
+        chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+        if pool is None:
+            cleaned = map(_clean_chunk, chunks)
+        else:
+            cleaned = pool.map(_clean_chunk, chunks, chunksize=1)
+        df[name] = [l for chunk in cleaned for l in chunk]
+    return df
+
+
 def preprocess():
     """
     1.load  train and test data
@@ -72,9 +96,17 @@ def preprocess():
     dfTest["qid"] = map(lambda q: qid_dict[q], dfTest["query"])
 
     ## clean text
-    clean = lambda line: clean_text(line, drop_html_flag=config.drop_html_flag)
-    dfTrain = dfTrain.apply(clean, axis=1)
-    dfTest = dfTest.apply(clean, axis=1)
+    n_jobs = config.preprocess_n_jobs
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        dfTrain = clean_df(dfTrain, pool)
+        dfTest = clean_df(dfTest, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     print("Done.")
 
@@ -0,0 +1,91 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    CountingEngine against the row-wise counting features
+
+        python -m unittest competition.tests.test_counting_engine
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from competition.feat.nlp import ngram
+from competition.feat.counting_engine import CountingEngine
+from competition.feat import counting_engine
+from competition.utils.utils import try_divide
+
+feat_names = ["query", "title", "description"]
+grams = ["unigram", "bigram", "trigram"]
+
+
+def get_position_list(target, obs):
+    """
+    CountingFeat.get_position_list
+    """
+    pos_of_obs_in_target = [0]
+    if len(obs) != 0:
+        pos_of_obs_in_target = [j for j, w in enumerate(obs, start=1) if w in target]
+        if len(pos_of_obs_in_target) == 0:
+            pos_of_obs_in_target = [0]
+    return pos_of_obs_in_target
+
+
+def gen_df(n, seed):
+    # token 中没有 "_"，字符串 n-gram 不会冲突
+    rng = np.random.RandomState(seed)
+    words = ["a", "b", "c", "d", "12", "3", "x"]
+    df = pd.DataFrame()
+    for feat_name in feat_names:
+        unigram = [list(rng.choice(words, rng.randint(0, 9))) for i in range(n)]
+        df[feat_name + "_unigram"] = unigram
+        df[feat_name + "_bigram"] = [ngram.getBigram(x, "_") for x in unigram]
+        df[feat_name + "_trigram"] = [ngram.getTrigram(x, "_") for x in unigram]
+    return df
+
+
+class CountingEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.df = gen_df(500, 2015)
+        self.engine = CountingEngine(self.df, feat_names, grams)
+
+    def test_count(self):
+        for feat_name in feat_names:
+            for gram in grams:
+                column = self.df[feat_name + "_" + gram]
+                np.testing.assert_array_equal(self.engine.get_count(feat_name, gram), [len(x) for x in column])
+                np.testing.assert_array_equal(self.engine.get_unique_count(feat_name, gram), [len(set(x)) for x in column])
+            expected = [sum([1. for w in x if w.isdigit()]) for x in self.df[feat_name + "_unigram"]]
+            np.testing.assert_array_equal(self.engine.get_digit_count(feat_name), expected)
+
+    def test_intersect_count(self):
+        for gram in grams:
+            for obs_name in feat_names:
+                for target_name in feat_names:
+                    if target_name == obs_name:
+                        continue
+                    expected = [sum([1. for w in obs if w in set(target)])
+                                for obs, target in zip(self.df[obs_name + "_" + gram], self.df[target_name + "_" + gram])]
+                    np.testing.assert_array_equal(self.engine.get_intersect_count(obs_name, target_name, gram), expected)
+
+    def test_position_stats(self):
+        stats_func = [("min", np.min), ("mean", np.mean), ("median", np.median), ("max", np.max), ("std", np.std)]
+        for gram in grams:
+            for target_name in feat_names:
+                for obs_name in feat_names:
+                    if target_name == obs_name:
+                        continue
+                    pos = [get_position_list(target, obs)
+                           for obs, target in zip(self.df[obs_name + "_" + gram], self.df[target_name + "_" + gram])]
+                    stats = self.engine.get_position_stats(obs_name, target_name, gram)
+                    for stat, func in stats_func:
+                        np.testing.assert_allclose(stats[stat], map(func, pos), rtol=0, atol=1e-12)
+
+    def test_try_divide(self):
+        x, y = np.array([1, 0, 3, 2]), np.array([2, 0, 0, 4])
+        np.testing.assert_array_equal(counting_engine.try_divide(x, y), map(try_divide, x, y))
+
+
+if __name__ == "__main__":
+    unittest.main()
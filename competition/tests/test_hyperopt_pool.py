@@ -0,0 +1,80 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    batched TPE suggest of hyperopt_pool
+
+        python -m unittest competition.tests.test_hyperopt_pool
+"""
+
+import sys
+import types
+import unittest
+
+from hyperopt import hp, STATUS_OK
+
+# model_library_config 需要完整的模型参数配置，这里只需要随机种子
+if "competition.conf.model_library_config" not in sys.modules:
+    import competition.conf
+
+    model_library_config = types.ModuleType("competition.conf.model_library_config")
+    model_library_config.hyperopt_random_seed = 2015
+    sys.modules["competition.conf.model_library_config"] = model_library_config
+    competition.conf.model_library_config = model_library_config
+
+from competition.models import hyperopt_pool
+
+
+class FakeModel(object):
+    def __init__(self):
+        self.logged = []
+
+    def hyperopt_obj(self, param, feat_folder, feat_name, trial_counter=None, log=True):
+        kappa = 1. - (param["x"] - 0.3) ** 2
+        return {"loss": -kappa, "status": STATUS_OK, "attachments": {"std": 0.}}
+
+    def log_param(self, param, feat_name, kappa_cv_mean, kappa_cv_std):
+        self.logged.append((param, kappa_cv_mean))
+
+
+def get_search(max_evals):
+    param_space = {"x": hp.uniform("x", 0., 1.), "max_evals": max_evals}
+    return hyperopt_pool.TrialSearch(FakeModel(), param_space, "feat_folder", "feat_name")
+
+
+class TrialSearchTest(unittest.TestCase):
+    def test_batch_size_after_startup_jobs(self):
+        # tpe 的 n_startup_jobs 是 20，之后 tpe.suggest 每次只返回一个 trial
+        search = get_search(50)
+        batch_sizes, trial_counters = [], []
+        while not search.is_done():
+            tasks = search.suggest(8)
+            batch_sizes.append(len(tasks))
+            for feat_name, param, trial_counter in tasks:
+                trial_counters.append(trial_counter)
+                search.record(trial_counter - 1, search.model.hyperopt_obj(param, "feat_folder", feat_name, trial_counter))
+        self.assertEqual(batch_sizes, [8, 8, 8, 8, 8, 8, 2])
+        # trial_counter 连续，没有空缺
+        self.assertEqual(trial_counters, range(1, 51))
+        self.assertEqual(len(search.trials.trials), 50)
+        self.assertEqual(len(search.model.logged), 50)
+
+    def test_batch_members_differ(self):
+        search = get_search(40)
+        for tasks in [search.suggest(20)]:
+            for feat_name, param, trial_counter in tasks:
+                search.record(trial_counter - 1, search.model.hyperopt_obj(param, "feat_folder", feat_name, trial_counter))
+        # startup 之后的 batch 使用 tpe，pending trial 让同一个 batch 的参数不同
+        xs = [param["x"] for feat_name, param, trial_counter in search.suggest(8)]
+        self.assertEqual(len(xs), 8)
+        self.assertEqual(len(set(xs)), 8)
+
+    def test_search(self):
+        searches = [get_search(25)]
+        (best, trials), = hyperopt_pool.search(searches, 4)
+        self.assertEqual(len(trials.trials), 25)
+        self.assertEqual(sorted(t["tid"] for t in trials.trials), range(25))
+        self.assertTrue(all(t["result"]["status"] == STATUS_OK for t in trials.trials))
+
+
+if __name__ == "__main__":
+    unittest.main()
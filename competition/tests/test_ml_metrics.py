@@ -0,0 +1,46 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    kappa metrics of ml_metrics
+
+        python -m unittest competition.tests.test_ml_metrics
+"""
+
+import unittest
+
+import numpy as np
+
+from competition.utils import ml_metrics
+
+rater_a = [1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3]
+rater_b = [1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2]
+
+
+class KappaTest(unittest.TestCase):
+    def test_docstring_examples(self):
+        self.assertAlmostEqual(ml_metrics.quadratic_weighted_kappa(rater_a, rater_b), 0.6666666666666666, places=12)
+        self.assertAlmostEqual(ml_metrics.linear_weighted_kappa(rater_a, rater_b), 0.5714285714285714, places=12)
+
+    def test_batch(self):
+        rng = np.random.RandomState(2015)
+        for n in [12, 100, 1000]:
+            labels = rng.randint(1, 5, size=n)
+            preds = rng.randint(1, 5, size=(8, n))
+            # 一行与 label 相同
+            preds[0] = labels
+            kappas = ml_metrics.batch_quadratic_weighted_kappa(labels, preds)
+            expected = [ml_metrics.quadratic_weighted_kappa(labels, pred) for pred in preds]
+            np.testing.assert_allclose(kappas, expected, rtol=0, atol=1e-12)
+            self.assertAlmostEqual(kappas[0], 1.0, places=12)
+
+    def test_batch_rating_range(self):
+        rng = np.random.RandomState(2015)
+        labels = rng.randint(2, 4, size=50)
+        preds = rng.randint(2, 4, size=(4, 50))
+        kappas = ml_metrics.batch_quadratic_weighted_kappa(labels, preds, 1, 4)
+        expected = [ml_metrics.quadratic_weighted_kappa(labels, pred, 1, 4) for pred in preds]
+        np.testing.assert_allclose(kappas, expected, rtol=0, atol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
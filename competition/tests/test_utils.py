@@ -0,0 +1,137 @@
+# coding=utf-8
+__author__ = 'songquanwang'
+"""
+    decoding methods and customized objectives of utils
+
+        python -m unittest competition.tests.test_utils
+"""
+
+import unittest
+
+import numpy as np
+
+from competition.utils import utils
+
+cdf = np.array([0.07348703, 0.22564841, 0.38818444, 1.])
+
+
+def get_score_argsort(pred, cdf, valid=False):
+    """
+    原来的 getScore：pred.argsort() 后按照 cdf 切片赋值
+    """
+    num = pred.shape[0]
+    output = np.asarray([4] * num, dtype=int)
+    rank = pred.argsort()
+    output[rank[:int(num * cdf[0] - 1)]] = 1
+    output[rank[int(num * cdf[0]):int(num * cdf[1] - 1)]] = 2
+    output[rank[int(num * cdf[1]):int(num * cdf[2] - 1)]] = 3
+    if valid:
+        cutoff = [pred[rank[int(num * cdf[i] - 1)]] for i in range(3)]
+        return output, cutoff
+    return output
+
+
+class GetScoreTest(unittest.TestCase):
+    def check(self, pred):
+        output, cutoff = utils.getScore(pred, cdf, valid=True)
+        expected, expected_cutoff = get_score_argsort(pred, cdf, valid=True)
+        np.testing.assert_array_equal(output, expected)
+        np.testing.assert_array_equal(cutoff, expected_cutoff)
+        np.testing.assert_array_equal(utils.getScore(pred, cdf), expected)
+
+    def test_continuous(self):
+        rng = np.random.RandomState(2015)
+        for num in [1, 2, 5, 16, 17, 100, 1000]:
+            self.check(rng.rand(num))
+
+    def test_ties(self):
+        # 树较少的 xgboost 预测值有大量相同值，相同值跨过分割位置时与原来的 argsort 顺序相同
+        rng = np.random.RandomState(2015)
+        for num in [5, 16, 17, 40, 100, 1000]:
+            for n_values in [1, 2, 3, 5, 20]:
+                self.check(rng.randint(n_values, size=num).astype(float))
+
+    def test_batch(self):
+        rng = np.random.RandomState(2015)
+        preds = np.vstack([rng.rand(6, 200), rng.randint(4, size=(6, 200))])
+        output = utils.getScoreBatch(preds, cdf)
+        for i in range(preds.shape[0]):
+            np.testing.assert_array_equal(output[i], get_score_argsort(preds[i], cdf))
+
+
+class FakeDMatrix(object):
+    def __init__(self, labels, weights):
+        self.labels = labels
+        self.weights = weights
+
+    def get_label(self):
+        return self.labels
+
+    def get_weight(self):
+        return self.weights
+
+
+def softkappa_obj_loop(preds, dtrain, hess_scale=0.000125):
+    """
+    原来逐个类别循环的 softkappaObj（final version）
+    """
+    labels = dtrain.get_label() + 1
+    labels = np.asarray(labels, dtype=int)
+    preds = utils.softmax(preds)
+    M = preds.shape[0]
+    N = preds.shape[1]
+    weights = dtrain.get_weight()
+    O = 0.0
+    for j in range(N):
+        wj = (labels - (j + 1.)) ** 2
+        O += np.sum(wj * preds[:, j])
+    hist_label = np.bincount(labels)[1:]
+    hist_pred = hist_label
+    E = 0.0
+    for i in range(N):
+        for j in range(N):
+            E += pow(i - j, 2.0) * hist_label[i] * hist_pred[j]
+    grad = np.zeros((M, N))
+    hess = np.zeros((M, N))
+    for n in range(N):
+        dO = np.zeros((M))
+        for j in range(N):
+            indicator = float(n == j)
+            dO += ((labels - (j + 1.)) ** 2) * preds[:, n] * (indicator - preds[:, j])
+        dE = np.zeros((M))
+        grad[:, n] = -M * (dO * E - O * dE) / (E ** 2)
+        d2O = np.zeros((M))
+        for j in range(N):
+            indicator = float(n == j)
+            d2O += ((labels - (j + 1.)) ** 2) * preds[:, n] * (1 - 2. * preds[:, n]) * (indicator - preds[:, j])
+        d2E = np.zeros((M))
+        hess[:, n] = -M * ((d2O * E - O * d2E) * (E ** 2) - (dO * E - O * dE) * 2. * E * dE) / (E ** 4)
+    grad *= -1.
+    hess *= -1.
+    scale = hess_scale / np.mean(abs(hess))
+    hess *= scale
+    hess = np.abs(hess)
+    grad *= weights[:, np.newaxis]
+    hess *= weights[:, np.newaxis]
+    grad.shape = (M * N)
+    hess.shape = (M * N)
+    return grad, hess
+
+
+class SoftkappaObjTest(unittest.TestCase):
+    def test_loop(self):
+        rng = np.random.RandomState(2015)
+        for M in [4, 50, 1000]:
+            labels = np.concatenate([np.arange(4), rng.randint(4, size=M - 4)]).astype(float)
+            weights = rng.rand(M) + 0.5
+            preds = rng.randn(M, 4)
+            dtrain = FakeDMatrix(labels, weights)
+            for hess_scale in [0.000125, 0.01]:
+                grad, hess = utils.softkappaObj(preds.copy(), dtrain, hess_scale=hess_scale)
+                expected_grad, expected_hess = softkappa_obj_loop(preds.copy(), dtrain, hess_scale=hess_scale)
+                np.testing.assert_allclose(grad, expected_grad, rtol=1e-10, atol=1e-15)
+                np.testing.assert_allclose(hess, expected_hess, rtol=1e-10, atol=1e-15)
+
+
+if __name__ == "__main__":
+    unittest.main()
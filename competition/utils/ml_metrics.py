@@ -9,6 +9,9 @@ __description__
     This file provides functions to compute quadratic weighted kappa.
     It is adopted from https://github.com/benhamner/Metrics/tree/master/Python/ml_metrics
 
+    confusion matrix and histogram are computed with np.bincount, the weight matrices are cached
+    per rating range, batch_quadratic_weighted_kappa scores many prediction vectors at once
+
 __author__
 
     Chenglong Chen < c.chenglong@gmail.com >
@@ -17,24 +20,53 @@ __author__
 
 import numpy as np
 
+# key: (num_ratings, weight_type) val: 权重矩阵
+_weight_matrix_cache = dict()
+
+
+def get_rating_range(rater_a, rater_b, min_rating=None, max_rating=None):
+    if min_rating is None:
+        min_rating = min(np.min(rater_a), np.min(rater_b))
+    if max_rating is None:
+        max_rating = max(np.max(rater_a), np.max(rater_b))
+    return int(min_rating), int(max_rating)
+
+
+def get_weight_matrix(num_ratings, weight_type="quadratic"):
+    """
+    权重矩阵，按照 rating 个数缓存
+        quadratic: [(i-j)/(num-1)]^2
+        linear: |i-j|/(num-1)
+        kappa: i != j
+    """
+    key = (num_ratings, weight_type)
+    if key not in _weight_matrix_cache:
+        diff = np.subtract.outer(np.arange(num_ratings), np.arange(num_ratings)).astype(float)
+        if weight_type == "quadratic":
+            weight = diff ** 2 / (num_ratings - 1) ** 2
+        elif weight_type == "linear":
+            weight = np.abs(diff) / (num_ratings - 1)
+        else:
+            weight = (diff != 0).astype(float)
+        _weight_matrix_cache[key] = weight
+    return _weight_matrix_cache[key]
+
 
 def confusion_matrix(rater_a, rater_b, min_rating=None, max_rating=None):
     """
     Returns the confusion matrix between rater's ratings
     矩阵坐标代表 差别，矩阵值代表 该差别的权重（次数）
     [0,0]/[1,1]/[2,2]...[N,N]占比越大越好
+    a*R+b 编码后用 np.bincount 计数
     """
     assert (len(rater_a) == len(rater_b))
-    if min_rating is None:
-        min_rating = min(rater_a + rater_b)
-    if max_rating is None:
-        max_rating = max(rater_a + rater_b)
+    rater_a = np.asarray(rater_a, dtype=int)
+    rater_b = np.asarray(rater_b, dtype=int)
+    min_rating, max_rating = get_rating_range(rater_a, rater_b, min_rating, max_rating)
     num_ratings = int(max_rating - min_rating + 1)
-    conf_mat = [[0 for i in range(num_ratings)]
-                for j in range(num_ratings)]
-    for a, b in zip(rater_a, rater_b):
-        conf_mat[a - min_rating][b - min_rating] += 1
-    return conf_mat
+    codes = (rater_a - min_rating) * num_ratings + (rater_b - min_rating)
+    conf_mat = np.bincount(codes, minlength=num_ratings * num_ratings)
+    return conf_mat.reshape((num_ratings, num_ratings))
 
 
 def histogram(ratings, min_rating=None, max_rating=None):
@@ -43,16 +75,66 @@ def histogram(ratings, min_rating=None, max_rating=None):
      0 1 2 4  频数数组
     [100,33,44,89]
     """
+    ratings = np.asarray(ratings, dtype=int)
     if min_rating is None:
-        min_rating = min(ratings)
+        min_rating = np.min(ratings)
     if max_rating is None:
-        max_rating = max(ratings)
+        max_rating = np.max(ratings)
     num_ratings = int(max_rating - min_rating + 1)
     # 1 2 3 4 --> 0 0 0 0
-    hist_ratings = [0 for x in range(num_ratings)]
-    for r in ratings:
-        hist_ratings[r - min_rating] += 1
-    return hist_ratings
+    return np.bincount(ratings - int(min_rating), minlength=num_ratings)
+
+
+def weighted_kappa(rater_a, rater_b, min_rating=None, max_rating=None, weight_type="quadratic"):
+    """
+    weighted kappa：1 - sum(W*O) / sum(W*E)，O 为实际频数，E 为理论频数
+    """
+    assert (len(rater_a) == len(rater_b))
+    min_rating, max_rating = get_rating_range(rater_a, rater_b, min_rating, max_rating)
+    conf_mat = confusion_matrix(rater_a, rater_b, min_rating, max_rating)
+    num_ratings = conf_mat.shape[0]
+    # 比较的label总数
+    num_scored_items = float(len(rater_a))
+    hist_rater_a = conf_mat.sum(axis=1)
+    hist_rater_b = conf_mat.sum(axis=0)
+    # 理论频数
+    expected_count = np.outer(hist_rater_a, hist_rater_b) / num_scored_items
+    weight = get_weight_matrix(num_ratings, weight_type)
+    # 权重 * 实际频数
+    numerator = (weight * conf_mat).sum() / num_scored_items
+    # 权重 * 期望频数
+    denominator = (weight * expected_count).sum() / num_scored_items
+    return 1.0 - numerator / denominator
+
+
+def batch_quadratic_weighted_kappa(rater_a, raters_b, min_rating=None, max_rating=None):
+    """
+    一次计算多个预测向量的 quadratic weighted kappa
+    :param rater_a: (n,) label
+    :param raters_b: (n_models, n) 每一行是一个预测向量
+    :param min_rating:
+    :param max_rating:
+    :return: (n_models,) kappa
+    """
+    rater_a = np.asarray(rater_a, dtype=int)
+    raters_b = np.atleast_2d(np.asarray(raters_b, dtype=int))
+    n_models, n = raters_b.shape
+    assert (len(rater_a) == n)
+    min_rating, max_rating = get_rating_range(rater_a, raters_b, min_rating, max_rating)
+    num_ratings = int(max_rating - min_rating + 1)
+    num_cells = num_ratings * num_ratings
+    # 每一行的编码加上 行号 * R^2，一次 bincount 得到所有的 confusion matrix
+    codes = (rater_a - min_rating)[np.newaxis, :] * num_ratings + (raters_b - min_rating)
+    codes += (np.arange(n_models) * num_cells)[:, np.newaxis]
+    conf_mat = np.bincount(codes.ravel(), minlength=n_models * num_cells).reshape((n_models, num_ratings, num_ratings))
+    num_scored_items = float(n)
+    hist_rater_a = conf_mat.sum(axis=2)
+    hist_rater_b = conf_mat.sum(axis=1)
+    expected_count = hist_rater_a[:, :, np.newaxis] * hist_rater_b[:, np.newaxis, :] / num_scored_items
+    weight = get_weight_matrix(num_ratings, "quadratic")
+    numerator = (weight[np.newaxis] * conf_mat).sum(axis=(1, 2)) / num_scored_items
+    denominator = (weight[np.newaxis] * expected_count).sum(axis=(1, 2)) / num_scored_items
+    return 1.0 - numerator / denominator
 
 
 # 代码中采用的这种方式
@@ -82,39 +164,8 @@ def quadratic_weighted_kappa(rater_a, rater_b, min_rating=None, max_rating=None)
 
     0.6666666666666666
     """
-    rater_a = np.array(rater_a, dtype=int)
-    rater_b = np.array(rater_b, dtype=int)
-    assert (len(rater_a) == len(rater_b))
-    if min_rating is None:
-        min_rating = min(min(rater_a), min(rater_b))
-    if max_rating is None:
-        max_rating = max(max(rater_a), max(rater_b))
-    conf_mat = confusion_matrix(rater_a, rater_b,
-                                min_rating, max_rating)
-    # 1 2 3 4 四个品类
-    num_ratings = len(conf_mat)
-    # 比较的label总数
-    num_scored_items = float(len(rater_a))
-
-    hist_rater_a = histogram(rater_a, min_rating, max_rating)
-    hist_rater_b = histogram(rater_b, min_rating, max_rating)
-
-    numerator = 0.0
-    denominator = 0.0
-
-    for i in range(num_ratings):
-        for j in range(num_ratings):
-            # 理论频数
-            expected_count = (hist_rater_a[i] * hist_rater_b[j]
-                              / num_scored_items)
-            # 权重 [（i-j)/(num-1)]^2
-            d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-            # 权重 * 实际频数
-            numerator += d * conf_mat[i][j] / num_scored_items
-            # 权重 * 期望频数
-            denominator += d * expected_count / num_scored_items
-
-    return 1.0 - numerator / denominator
+    # 权重 [（i-j)/(num-1)]^2
+    return weighted_kappa(rater_a, rater_b, min_rating, max_rating, "quadratic")
 
 
 def linear_weighted_kappa(rater_a, rater_b, min_rating=None, max_rating=None):
@@ -142,31 +193,7 @@ def linear_weighted_kappa(rater_a, rater_b, min_rating=None, max_rating=None):
     rater_b = [1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2]
     0.5714285714285714
     """
-    assert (len(rater_a) == len(rater_b))
-    if min_rating is None:
-        min_rating = min(rater_a + rater_b)
-    if max_rating is None:
-        max_rating = max(rater_a + rater_b)
-    conf_mat = confusion_matrix(rater_a, rater_b,
-                                min_rating, max_rating)
-    num_ratings = len(conf_mat)
-    num_scored_items = float(len(rater_a))
-
-    hist_rater_a = histogram(rater_a, min_rating, max_rating)
-    hist_rater_b = histogram(rater_b, min_rating, max_rating)
-
-    numerator = 0.0
-    denominator = 0.0
-
-    for i in range(num_ratings):
-        for j in range(num_ratings):
-            expected_count = (hist_rater_a[i] * hist_rater_b[j]
-                              / num_scored_items)
-            d = abs(i - j) / float(num_ratings - 1)
-            numerator += d * conf_mat[i][j] / num_scored_items
-            denominator += d * expected_count / num_scored_items
-
-    return 1.0 - numerator / denominator
+    return weighted_kappa(rater_a, rater_b, min_rating, max_rating, "linear")
 
 
 def kappa(rater_a, rater_b, min_rating=None, max_rating=None):
@@ -190,34 +217,7 @@ def kappa(rater_a, rater_b, min_rating=None, max_rating=None):
     is the minimum possible rating, and max_rating is the maximum possible
     rating
     """
-    assert (len(rater_a) == len(rater_b))
-    if min_rating is None:
-        min_rating = min(rater_a + rater_b)
-    if max_rating is None:
-        max_rating = max(rater_a + rater_b)
-    conf_mat = confusion_matrix(rater_a, rater_b,
-                                min_rating, max_rating)
-    num_ratings = len(conf_mat)
-    num_scored_items = float(len(rater_a))
-
-    hist_rater_a = histogram(rater_a, min_rating, max_rating)
-    hist_rater_b = histogram(rater_b, min_rating, max_rating)
-
-    numerator = 0.0
-    denominator = 0.0
-
-    for i in range(num_ratings):
-        for j in range(num_ratings):
-            expected_count = (hist_rater_a[i] * hist_rater_b[j]
-                              / num_scored_items)
-            if i == j:
-                d = 0.0
-            else:
-                d = 1.0
-            numerator += d * conf_mat[i][j] / num_scored_items
-            denominator += d * expected_count / num_scored_items
-
-    return 1.0 - numerator / denominator
+    return weighted_kappa(rater_a, rater_b, min_rating, max_rating, "kappa")
 
 
 def mean_quadratic_weighted_kappa(kappas, weights=None):
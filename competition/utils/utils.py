@@ -203,6 +203,16 @@ def softkappaObj(preds, dtrain):
     return grad, hess
 
 
+#### (i-j)^2 weight matrix of N classes
+_squared_diff_cache = dict()
+
+
+def getSquaredDiffMatrix(N):
+    if N not in _squared_diff_cache:
+        _squared_diff_cache[N] = np.subtract.outer(np.arange(N), np.arange(N)).astype(float) ** 2
+    return _squared_diff_cache[N]
+
+
 #### directly optimized kappa (final version)
 # since we use the cdf for finding cutoff which results in the same distribution between training/validaion
 # so the denominator is kind of fixed
@@ -214,53 +224,26 @@ def softkappaObj(preds, dtrain, hess_scale=0.000125):
     M = preds.shape[0]
     N = preds.shape[1]
     weights = dtrain.get_weight()
-    ## compute O (enumerator)
-    O = 0.0
-    for j in range(N):
-        wj = (labels - (j + 1.)) ** 2
-        O += np.sum(wj * preds[:, j])
+    W = getSquaredDiffMatrix(N)
+    # (M, N): wj = (labels - (j + 1.)) ** 2
+    W_label = W[labels - 1]
 
     ## compute E (denominator)
-    hist_label = np.bincount(labels)[1:]
+    hist_label = np.bincount(labels, minlength=N + 1)[1:]
     # hist_pred = np.sum(preds, axis=0)
     hist_pred = hist_label
-    E = 0.0
-    for i in range(N):
-        for j in range(N):
-            E += pow(i - j, 2.0) * hist_label[i] * hist_pred[j]
+    E = np.dot(np.dot(hist_label, W), hist_pred)
 
     ## compute gradient and hessian
-    grad = np.zeros((M, N))
-    hess = np.zeros((M, N))
-    for n in range(N):
-        ## first-order derivative: dO / dy_mn
-        dO = np.zeros((M))
-        for j in range(N):
-            indicator = float(n == j)
-            dO += ((labels - (j + 1.)) ** 2) * preds[:, n] * (indicator - preds[:, j])
-        ## first-order derivative: dE / dy_mn
-        dE = np.zeros((M))
-        # for k in range(N):
-        #    for l in range(N):
-        #        indicator = float(n == k)
-        #        dE += pow(k-l, 2.0) * hist_label[l] * preds[:,n] * (indicator - preds[:,k])
-        ## the grad
-        grad[:, n] = -M * (dO * E - O * dE) / (E ** 2)
-
-        ## second-order derivative: d^2O / d (y_mn)^2
-        d2O = np.zeros((M))
-        for j in range(N):
-            indicator = float(n == j)
-            d2O += ((labels - (j + 1.)) ** 2) * preds[:, n] * (1 - 2. * preds[:, n]) * (indicator - preds[:, j])
-
-        ## second-order derivative: d^2E / d (y_mn)^2
-        d2E = np.zeros((M))
-        # for k in range(N):
-        #    for l in range(N):
-        #        indicator = float(n == k)
-        #        d2E += pow(k-l, 2.0) * hist_label[l] * preds[:,n] * (1 - 2.*preds[:,n]) * (indicator - preds[:,k])
-        ## the hess
-        hess[:, n] = -M * ((d2O * E - O * d2E) * (E ** 2) - (dO * E - O * dE) * 2. * E * dE) / (E ** 4)
+    # sum_j wj * p_mj
+    WP = np.sum(W_label * preds, axis=1)[:, np.newaxis]
+    ## first-order derivative: dO / dy_mn = p_mn * (w_mn - sum_j w_mj * p_mj)
+    dO = preds * (W_label - WP)
+    ## second-order derivative: d^2O / d (y_mn)^2 = (1 - 2 * p_mn) * dO / dy_mn
+    d2O = (1 - 2. * preds) * dO
+    ## dE / dy_mn = 0, d^2E / d (y_mn)^2 = 0 (the denominator is fixed)
+    grad = -M * dO / E
+    hess = -M * d2O / E
 
     grad *= -1.
     hess *= -1.
@@ -283,20 +266,91 @@ def softkappaObj(preds, dtrain, hess_scale=0.000125):
 #####################
 #### decoding method for ranking and regression
 # cdf array([ 0.07348703,  0.22564841,  0.38818444,  1.        ]) 对pred 由小到大排序索引后，按照 cdf比例 对 pred 进行赋值 1 2 3 4
-def getScore(pred, cdf, valid=False):
-    num = pred.shape[0]
-    output = np.asarray([4] * num, dtype=int)
-    # 排序
+def getScoreRankSlices(num, cdf):
+    """
+    1 2 3 在排序后的位置区间 [start, stop)，与 rank[:int(num * cdf[0] - 1)] 等切片完全相同
+    （位置 int(num * cdf[i] - 1) 上的样本保持 4）
+    """
+    bounds = [(None, int(num * cdf[0] - 1)),
+              (int(num * cdf[0]), int(num * cdf[1] - 1)),
+              (int(num * cdf[1]), int(num * cdf[2] - 1))]
+    return [slice(start, stop).indices(num)[:2] for start, stop in bounds]
+
+
+def getRankMask(preds, kth_values, k):
+    """
+    排序后位置 < k 的样本
+    与第 k 个值相同的样本同时出现在位置 k 的两侧时（tied），哪些排在 k 之前取决于排序方法，mask 不可用
+    :param preds: (n_models, num)
+    :param kth_values: (n_models,) 第 k 个顺序统计量
+    :param k:
+    :return: mask (n_models, num) bool, tied (n_models,) bool
+    """
+    n_models, num = preds.shape
+    if k <= 0:
+        return np.zeros(preds.shape, dtype=bool), np.zeros(n_models, dtype=bool)
+    if k >= num:
+        return np.ones(preds.shape, dtype=bool), np.zeros(n_models, dtype=bool)
+    less = preds < kth_values[:, np.newaxis]
+    return less, less.sum(axis=1) < k
+
+
+def getScoreArgsort(pred, slices):
+    """
+    原来的解码方法：pred.argsort()（quicksort，相同的值顺序不稳定）后按照位置区间赋值 1 2 3
+    """
+    output = np.asarray([4] * pred.shape[0], dtype=int)
     rank = pred.argsort()
-    output[rank[:int(num * cdf[0] - 1)]] = 1
-    output[rank[int(num * cdf[0]):int(num * cdf[1] - 1)]] = 2
-    output[rank[int(num * cdf[1]):int(num * cdf[2] - 1)]] = 3
+    for score, (start, stop) in zip([1, 2, 3], slices):
+        output[rank[start:stop]] = score
+    return output
+
+
+def getScoreBatch(preds, cdf, valid=False):
+    """
+    一次解码多个预测向量：np.partition 找到分割位置的顺序统计量，然后按照阈值赋值 1 2 3 4，O(num)
+    相同的预测值跨过分割位置的行，结果与相同值的先后顺序有关，这些行使用原来的 argsort 解码，结果与 getScoreArgsort 完全相同
+    :param preds: (n_models, num)
+    :param cdf:
+    :param valid: 同时返回每一行的 cutoff
+    :return: (n_models, num) int
+    """
+    preds = np.atleast_2d(np.asarray(preds))
+    n_models, num = preds.shape
+    slices = getScoreRankSlices(num, cdf)
+    # cutoff 的位置：负数与 rank[-1] 的含义相同
+    cutoff_pos = [int(num * cdf[i] - 1) % num for i in range(3)]
+    bounds = sorted(set([k for s in slices for k in s if 0 < k < num]))
+    kth = sorted(set(bounds + cutoff_pos))
+    part = np.partition(preds, kth, axis=1)
+    masks = dict((k, getRankMask(preds, part[:, k], k)) for k in bounds)
+    get_mask = lambda k: masks[k][0] if k in masks else getRankMask(preds, None, k)[0]
+
+    output = np.empty(preds.shape, dtype=int)
+    output.fill(4)
+    for score, (start, stop) in zip([1, 2, 3], slices):
+        if start < stop:
+            output[get_mask(stop) & ~get_mask(start)] = score
+    # 原始 xgboost 预测值（树较少时）经常有相同值
+    tied = np.zeros(n_models, dtype=bool)
+    for k in bounds:
+        tied |= masks[k][1]
+    for i in np.where(tied)[0]:
+        output[i] = getScoreArgsort(preds[i], slices)
     if valid:
-        cutoff = [pred[rank[int(num * cdf[i] - 1)]] for i in range(3)]
+        cutoff = part[:, cutoff_pos]
         return output, cutoff
     return output
 
 
+def getScore(pred, cdf, valid=False):
+    # 不做完整排序，使用 getScoreBatch 的 partition 解码
+    if valid:
+        output, cutoff = getScoreBatch(pred[np.newaxis, :], cdf, valid=True)
+        return output[0], list(cutoff[0])
+    return getScoreBatch(pred[np.newaxis, :], cdf)[0]
+
+
 #### get test score using cutoff found in the validation set
 def getTestScore(pred, cutoff):
     num = pred.shape[0]